@@ -1,11 +1,15 @@
-from flask import Flask, request, jsonify, abort, make_response, send_file
+from flask import Flask, Response, request, jsonify, abort, make_response, stream_with_context, g
 from werkzeug.exceptions import HTTPException
 import os
 import sys
+import math
 import time
 import rq
 import json
-import io
+import gzip
+import hashlib
+import zlib
+import zipfile
 from functools import wraps
 import base64
 import traceback
@@ -14,10 +18,10 @@ import redis
 from redis.retry import Retry
 from redis.exceptions import TimeoutError, ConnectionError
 from redis.backoff import FullJitterBackoff
-from datetime import datetime
-from contextlib import contextmanager
 
-from . import form_management
+from . import form_management, metrics, settings_store
+from .cache import TTLCache
+from .log import queue_logger
 
 DOTENVFILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
 dotenv.load_dotenv(dotenv_path=DOTENVFILE)
@@ -26,6 +30,26 @@ ERROR_LOG = os.environ.get("ERROR_LOG")
 ACCESS_LOG = os.environ.get("ACCESS_LOG")
 SETTINGS_JOB_TIMEOUT = os.environ.get("SETTINGS_JOB_TIMEOUT", 600)
 REDIS_URL = os.environ["REDIS_URL"]
+RESULTS_CHUNK_SIZE = 100
+FEEDBACK_CHUNK_SIZE = 256 * 1024
+EVENTS_POLL_INTERVAL = 1
+EVENTS_RECONCILE_INTERVAL = 10
+EVENTS_KEEPALIVE_INTERVAL = 15
+CANCEL_TTL = 3600
+CREDENTIALS_CACHE_TTL = float(os.environ.get("CREDENTIALS_CACHE_TTL") or 60)
+CREDENTIALS_CACHE_SIZE = int(os.environ.get("CREDENTIALS_CACHE_SIZE") or 1024)
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT") or 20)
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST") or RATE_LIMIT)
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES") or 0)
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT") or 0)
+LOG_FLUSH_SIZE = int(os.environ.get("LOG_FLUSH_SIZE") or 64 * 1024)
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL") or 1)
+SJF_WEIGHT = float(os.environ.get("SJF_WEIGHT") or 0)
+QUEUE_LIMITS = {name: int(os.environ.get(f"{name.upper()}_QUEUE_LIMIT") or 0) for name in ("high", "low", "batch")}
+USER_JOB_LIMIT = int(os.environ.get("USER_JOB_LIMIT") or 0)
+RETRY_AFTER_MAX = int(os.environ.get("RETRY_AFTER_MAX") or 3600)
+DRAIN_WINDOW = 5
+SJF_INDEX_KEY = "autotest:sjf:low"
 
 REDIS_CONNECTION = redis.Redis.from_url(
     REDIS_URL,
@@ -34,16 +58,100 @@ REDIS_CONNECTION = redis.Redis.from_url(
     health_check_interval=1,
 )
 
+REQUEST_DURATION = metrics.Histogram("autotest_request_duration_seconds", "Time taken to handle a request")
+REDIS_DURATION = metrics.Histogram("autotest_redis_roundtrip_seconds", "Time taken to receive a reply from redis")
+JOBS_ENQUEUED = metrics.Counter("autotest_jobs_enqueued_total", "Number of jobs enqueued")
+METRICS = [REQUEST_DURATION, REDIS_DURATION, JOBS_ENQUEUED]
+METRICS_QUEUES = ["high", "low", "batch", "settings"]
+BATCH_QUEUES_KEY = "autotest:batch_queues"
+# counters incremented by the workers (see autotest_server._store_result, autotest_server._store_feedback_file
+# and autotest_server.result_cache)
+STORED_METRICS = {
+    "results_stored": "Number of test results stored",
+    "result_bytes": "Size in bytes of the test results stored",
+    "result_uncompressed_bytes": "Size in bytes of the test results stored before compression",
+    "feedback_files_stored": "Number of feedback files stored",
+    "feedback_bytes": "Size in bytes of the feedback files stored",
+    "result_cache_hits": "Number of test runs whose results were found in the result cache",
+    "result_cache_misses": "Number of test runs whose results were not found in the result cache",
+}
+
+REDIS_CONNECTION.connection_pool.connection_class = metrics.timed_connection_class(
+    REDIS_CONNECTION.connection_pool.connection_class, REDIS_DURATION
+)
+
+_LOG_SETTINGS = {
+    "max_bytes": LOG_MAX_BYTES,
+    "backup_count": LOG_BACKUP_COUNT,
+    "flush_size": LOG_FLUSH_SIZE,
+    "flush_interval": LOG_FLUSH_INTERVAL,
+}
+ACCESS_LOGGER = queue_logger("autotest_client.access", ACCESS_LOG, sys.stdout, **_LOG_SETTINGS)
+ERROR_LOGGER = queue_logger("autotest_client.error", ERROR_LOG, sys.stderr, **_LOG_SETTINGS)
+
+CREDENTIALS_CACHE = TTLCache(maxsize=CREDENTIALS_CACHE_SIZE, ttl=CREDENTIALS_CACHE_TTL)
+SCHEMA_CACHE = TTLCache(maxsize=1, ttl=float("inf"))
+
+# Token bucket rate limiter. The bucket for each user holds at most max(burst, rate) tokens and is refilled at
+# a rate of <rate> tokens per minute (overridden per user by autotest:ratelimit:<api_key>:limit). Each request
+# takes a token and is rejected if there are none left.
+#   KEYS: [bucket, user limit]  ARGV: [default rate, burst]
+RATE_LIMIT_SCRIPT = REDIS_CONNECTION.register_script("""
+local rate = tonumber(redis.call("GET", KEYS[2]) or ARGV[1])
+if rate <= 0 then
+    return 0
+end
+local burst = math.max(tonumber(ARGV[2]), rate)
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate / 60)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "timestamp", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst * 60 / rate) + 1)
+return allowed
+""")
+
+# Insert a job in the low queue so that the queue stays ordered by score (see _expected_runtime). The index sorted set
+# holds the score of each job; jobs whose score is in the past can never be overtaken by a new job so they are removed
+# from the index, as are jobs that have already left the queue.
+#   KEYS: [queue, index]  ARGV: [job id, score, now]
+SJF_SCRIPT = REDIS_CONNECTION.register_script("""
+redis.call("LREM", KEYS[1], -1, ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", "(" .. ARGV[3])
+local successors = redis.call("ZRANGEBYSCORE", KEYS[2], "(" .. ARGV[2], "+inf")
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+for _, successor in ipairs(successors) do
+    if redis.call("LINSERT", KEYS[1], "BEFORE", successor, ARGV[1]) > 0 then
+        return 1
+    end
+    redis.call("ZREM", KEYS[2], successor)
+end
+redis.call("RPUSH", KEYS[1], ARGV[1])
+return 0
+""")
+
 app = Flask(__name__)
 
 
-@contextmanager
-def _open_log(log, mode="a", fallback=sys.stdout):
-    if log:
-        with open(log, mode) as f:
-            yield f
-    else:
-        yield fallback
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _observe_duration(response):
+    if "request_start" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        duration = time.perf_counter() - g.request_start
+        REQUEST_DURATION.observe(duration, route=route, method=request.method, status=str(response.status_code))
+    return response
 
 
 @app.errorhandler(Exception)
@@ -52,34 +160,38 @@ def _handle_error(e):
     error = str(e)
     if isinstance(e, HTTPException):
         code = e.code
-    with _open_log(ERROR_LOG, fallback=sys.stderr) as f:
-        try:
-            api_key = request.headers.get("Api-Key")
-        except Exception:
-            api_key = "ERROR: user not found"
-        f.write(f"{datetime.now()}\n\tuser: {api_key}\n\t{traceback.format_exc()}\n")
-        f.flush()
+    try:
+        api_key = request.headers.get("Api-Key")
+    except Exception:
+        api_key = "ERROR: user not found"
+    ERROR_LOGGER.error(str(e), extra={"user": api_key, "traceback": traceback.format_exc()})
     if not app.debug:
         error = str(e).replace(api_key, "[client-api-key]")
     return jsonify(message=error), code
 
 
 def _check_rate_limit(api_key):
-    key = f"autotest:ratelimit:{api_key}:{datetime.now().minute}"
-    n_requests = REDIS_CONNECTION.get(key) or 0
-    user_limit = REDIS_CONNECTION.get(f"autotest:ratelimit:{api_key}:limit") or 20  # TODO: make default configurable
-    if int(n_requests) > int(user_limit):
+    keys = [f"autotest:ratelimit:{api_key}", f"autotest:ratelimit:{api_key}:limit"]
+    if not RATE_LIMIT_SCRIPT(keys=keys, args=[RATE_LIMIT, RATE_LIMIT_BURST], client=REDIS_CONNECTION):
         abort(make_response(jsonify(message="Too many requests"), 429))
-    else:
-        with REDIS_CONNECTION.pipeline() as pipe:
-            pipe.incr(key)
-            pipe.expire(key, 59)
-            pipe.execute()
+
+
+def _has_credentials(api_key):
+    """
+    Return True if credentials have been registered for api_key. Positive results are cached in this process
+    so that most authorized requests do not need to query redis.
+    """
+    if CREDENTIALS_CACHE.get(api_key):
+        return True
+    registered = REDIS_CONNECTION.hexists("autotest:user_credentials", api_key)
+    if registered:
+        CREDENTIALS_CACHE.set(api_key, True)
+    return registered
 
 
 def _authorize_user():
     api_key = request.headers.get("Api-Key")
-    if api_key is None or (REDIS_CONNECTION.hgetall("autotest:user_credentials") or {}).get(api_key.encode()) is None:
+    if api_key is None or not _has_credentials(api_key):
         abort(make_response(jsonify(message="Unauthorized"), 401))
     _check_rate_limit(api_key)
     return api_key
@@ -87,10 +199,10 @@ def _authorize_user():
 
 def _authorize_settings(user, settings_id=None, **_kw):
     if settings_id:
-        settings_ = REDIS_CONNECTION.hget("autotest:settings", settings_id)
-        if settings_ is None:
+        meta = settings_store.get_metadata(REDIS_CONNECTION, settings_id, "user")
+        if meta is None:
             abort(make_response(jsonify(message="Settings not found"), 404))
-        if json.loads(settings_).get("_user") != user:
+        if meta["user"] != user:
             abort(make_response(jsonify(message="Unauthorized"), 401))
 
 
@@ -103,6 +215,31 @@ def _authorize_tests(tests_id=None, settings_id=None, **_kw):
             abort(make_response(jsonify(message="Unauthorized"), 401))
 
 
+def _get_schema():
+    """
+    Return the test settings schema. The parsed schema is cached in this process and is only read from redis again
+    when autotest:schema_version changes.
+    """
+    return _load_schema(REDIS_CONNECTION.get("autotest:schema_version"))
+
+
+def _load_schema(version):
+    """Return the test settings schema with the given version (see _get_schema)"""
+    schema_ = None if version is None else SCHEMA_CACHE.get(version)
+    if schema_ is None:
+        schema_ = json.loads(REDIS_CONNECTION.get("autotest:schema") or "{}")
+        if version is not None:
+            SCHEMA_CACHE.set(version, schema_)
+    return schema_
+
+
+def _not_modified(etag):
+    """Return a 304 (Not Modified) response for a resource with the given etag"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 def _update_settings(settings_id, user):
     test_settings = request.json.get("settings") or {}
     file_url = request.json.get("file_url")
@@ -113,14 +250,19 @@ def _update_settings(settings_id, user):
             raise Exception(".. not allowed in uploaded file path")
         if os.path.isabs(filename):
             raise Exception("uploaded files cannot include an absolute path")
-    error = form_management.validate_against_schema(test_settings, schema(), test_files)
+    error = form_management.validate_against_schema(test_settings, _get_schema(), test_files)
     if error:
         abort(make_response(jsonify(message=error), 422))
 
-    test_settings["_user"] = user
-    test_settings["_last_access"] = int(time.time())
-    test_settings["_env_status"] = "setup"
-    REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
+    test_settings, _ = settings_store.split_metadata(test_settings)
+    meta = {
+        "user": user,
+        "last_access": int(time.time()),
+        "env_status": "setup",
+    }
+    with REDIS_CONNECTION.pipeline() as pipe:
+        settings_store.write_settings(pipe, settings_id, test_settings, meta, delete=("error", "files"))
+        pipe.execute()
 
     queue = rq.Queue("settings", connection=REDIS_CONNECTION)
     data = {"user": user, "settings_id": settings_id, "test_settings": test_settings, "file_url": file_url}
@@ -130,18 +272,384 @@ def _update_settings(settings_id, user):
         job_id=f"settings_{settings_id}",
         timeout=SETTINGS_JOB_TIMEOUT,
     )
+    JOBS_ENQUEUED.inc(queue="settings")
+
+
+def _batch_queue_name(user):
+    """
+    Return the name of the queue that batches of tests enqueued by user are put in. Workers share their time fairly
+    between these queues (see autotest_server.fair_share).
+    """
+    return f"batch:{hashlib.sha256(user.encode()).hexdigest()[:16]}"
+
+
+def _recorded_runtimes(settings_id, requested):
+    """
+    Return a dict mapping the index of each test group in requested to a tuple of the average of its recorded run
+    times (in seconds) and the number of recorded runs. Test groups that have not been run yet are omitted.
+    """
+    runtimes = REDIS_CONNECTION.hgetall(settings_store.runtimes_key(settings_id))
+    recorded = {}
+    for i in requested:
+        count = int(runtimes.get(f"{i}:count".encode(), 0))
+        if count:
+            recorded[i] = (float(runtimes[f"{i}:total".encode()]) / count, count)
+    return recorded
+
+
+def _expected_runtime(groups, requested, recorded):
+    """
+    Return the expected time (in seconds) taken to run the test groups with indices in requested: the average of
+    their recorded run times, or their timeout if they have not been run yet.
+
+    When SJF_WEIGHT is set, jobs in the low queue are ordered by the time they were enqueued plus SJF_WEIGHT times
+    their expected run time so that quicker tests are run first but no job is overtaken by jobs enqueued more than
+    SJF_WEIGHT times the difference in their expected run times later.
+    """
+    return sum(recorded[i][0] if i in recorded else groups[i][1] for i in requested)
+
+
+def _drain_key(queue_name, minute):
+    """Return the key of the number of jobs dequeued from queue_name during minute (see autotest_server.fair_share)"""
+    return f"autotest:drained:{queue_name}:{minute}"
+
+
+def _retry_after(queue_name, queue, n_jobs):
+    """
+    Return the number of seconds a client should wait before trying to enqueue n_jobs jobs in queue again, or None
+    if they can be enqueued now.
+
+    Jobs are not accepted if they would make the queue named queue_name longer than its limit in QUEUE_LIMITS (all
+    batch queues count towards the limit of the batch queue) or, for batches, if the user would have more than
+    USER_JOB_LIMIT jobs waiting or running. The time to wait is estimated from the number of jobs workers took from
+    the queue over the last DRAIN_WINDOW minutes.
+    """
+    queue_limit = QUEUE_LIMITS.get(queue_name, 0)
+    user_limit = USER_JOB_LIMIT if queue_name == "batch" else 0
+    if not (queue_limit or user_limit):
+        return None
+    names = [queue.name]
+    if queue_name == "batch" and queue_limit:
+        names = list({"batch", queue.name, *(name.decode() for name in REDIS_CONNECTION.smembers(BATCH_QUEUES_KEY))})
+    minute = int(time.time() // 60)
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.llen(rq.Queue(name, connection=REDIS_CONNECTION).key)
+        pipe.zcard(queue.started_job_registry.key)
+        pipe.mget([_drain_key(queue_name, minute - i) for i in range(DRAIN_WINDOW)])
+        *lengths, running, drained = pipe.execute()
+    excess = 0
+    if queue_limit:
+        excess = max(excess, sum(lengths) + n_jobs - queue_limit)
+    if user_limit:
+        excess = max(excess, lengths[names.index(queue.name)] + running + n_jobs - user_limit)
+    if excess <= 0:
+        return None
+    rate = sum(int(n) for n in drained if n) / (DRAIN_WINDOW * 60)
+    if not rate:
+        return RETRY_AFTER_MAX
+    return min(RETRY_AFTER_MAX, max(1, math.ceil(excess / rate)))
+
+
+def _owned_test_ids(test_ids, test_settings, settings_id):
+    """
+    Return the ids in test_ids that belong to the settings with id settings_id where test_settings
+    are the values of autotest:tests (in the same order as test_ids).
+    """
+    return [
+        id_ for id_, setting in zip(test_ids, test_settings) if setting is not None and int(setting) == int(settings_id)
+    ]
+
+
+def _get_statuses(test_ids, settings_id):
+    """
+    Return a dictionary mapping each id in test_ids to the status of the corresponding job (or None if the
+    test does not exist or does not belong to the settings with id settings_id).
+
+    The ownership check and every status lookup are sent in a single pipeline and only the status field
+    of each job is read so no jobs are deserialized.
+    """
+    test_ids = list(test_ids)
+    if not test_ids:
+        return {}
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        _queue_status_lookups(pipe, test_ids)
+        return _parse_statuses(test_ids, settings_id, pipe.execute())
+
+
+def _queue_status_lookups(pipe, test_ids):
+    """Queue the commands on pipe that are needed to look up the statuses of the tests in test_ids"""
+    pipe.hmget("autotest:tests", test_ids)
+    for id_ in test_ids:
+        pipe.hget(rq.job.Job.key_for(str(id_)), "status")
 
 
-def _get_jobs(test_ids, settings_id):
-    for id_ in test_ids:
-        test_setting = REDIS_CONNECTION.hget("autotest:tests", id_)
-        if test_setting is None or int(test_setting) != int(settings_id):
-            yield None
-        else:
-            try:
-                yield rq.job.Job.fetch(str(id_), connection=REDIS_CONNECTION)
-            except rq.exceptions.NoSuchJobError:
-                yield None
+def _parse_statuses(test_ids, settings_id, responses):
+    """Return the statuses of the tests in test_ids given the responses to the commands of _queue_status_lookups"""
+    test_settings, *statuses = responses
+    owned_ids = set(_owned_test_ids(test_ids, test_settings, settings_id))
+    return {
+        id_: (status.decode() if status is not None else None) if id_ in owned_ids else None
+        for id_, status in zip(test_ids, statuses)
+    }
+
+
+def _decode_result(test_result):
+    """
+    Return the json encoded content of autotest:test_result. Large results are stored gzip compressed by the
+    autotester and are decompressed here.
+    """
+    if test_result is not None and test_result[:2] == b"\x1f\x8b":
+        return gzip.decompress(test_result)
+    return test_result
+
+
+def _format_result(job, job_status, test_result):
+    """
+    Return the result of a test run given its job, the job's status and the content of autotest:test_result
+    """
+    result = {"status": job_status}
+    if job_status == "finished":
+        try:
+            result.update(json.loads(_decode_result(test_result)))
+        except (json.JSONDecodeError, TypeError):
+            result.update({"error": f"invalid json: {test_result}"})
+    elif job_status == "failed":
+        result.update({"error": str(job.exc_info)})
+    return result
+
+
+_TERMINAL_REGISTRIES = {
+    "finished": rq.registry.FinishedJobRegistry,
+    "failed": rq.registry.FailedJobRegistry,
+    "stopped": rq.registry.FailedJobRegistry,
+    "canceled": rq.registry.CanceledJobRegistry,
+}
+
+
+def _delete_job(job, job_status, pipe):
+    """
+    Queue commands on pipe that delete job from redis.
+
+    Jobs that have completed are removed from the registry that matches job_status directly so that no further
+    round trips are needed, other jobs are deleted using rq's own (slower) cleanup.
+    """
+    registry_class = _TERMINAL_REGISTRIES.get(job_status)
+    if registry_class is None:
+        job.delete(pipeline=pipe)
+    else:
+        registry_class(job.origin, connection=REDIS_CONNECTION).remove(job, pipeline=pipe)
+        pipe.delete(job.key, job.dependents_key, job.dependencies_key, job.execution_registry.key)
+
+
+_CANCELABLE_STATUSES = {"queued", "deferred", "scheduled"}
+
+
+def _cancel_job(job, job_status, pipe):
+    """
+    Queue commands on pipe that cancel job, a job that has not started yet.
+
+    Queued jobs are removed from their queue directly (rq's own job.cancel reads the job's status again first, which
+    would take one round trip per job).
+    """
+    if job_status != "queued":
+        job.cancel(pipeline=pipe)
+        return
+    rq.Queue(job.origin, connection=REDIS_CONNECTION).remove(job, pipeline=pipe)
+    job.set_status(rq.job.JobStatus.CANCELED, pipeline=pipe)
+    rq.registry.CanceledJobRegistry(job.origin, connection=REDIS_CONNECTION).add(job, pipeline=pipe)
+
+
+def _iter_results(test_ids, settings_id):
+    """
+    Yield the results of all tests in test_ids as newline delimited json strings.
+
+    Results are fetched RESULTS_CHUNK_SIZE tests at a time (ownership check and result lookup in one pipeline,
+    jobs in a second, deletion in a third) and each result is deleted after it has been read.
+    """
+    for start in range(0, len(test_ids), RESULTS_CHUNK_SIZE):
+        end = start + RESULTS_CHUNK_SIZE
+        chunk = test_ids[start:end]
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            pipe.hmget("autotest:tests", chunk)
+            pipe.mget([f"autotest:test_result:{id_}" for id_ in chunk])
+            test_settings, test_results = pipe.execute()
+        owned_ids = _owned_test_ids(chunk, test_settings, settings_id)
+        jobs = dict(zip(owned_ids, rq.job.Job.fetch_many([str(id_) for id_ in owned_ids], connection=REDIS_CONNECTION)))
+        lines = []
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            for id_, test_result in zip(chunk, test_results):
+                job = jobs.get(id_)
+                if job is None:
+                    lines.append(json.dumps({"test_id": id_, "status": None}))
+                    continue
+                job_status = job.get_status(refresh=False)
+                lines.append(json.dumps({"test_id": id_, **_format_result(job, job_status, test_result)}))
+                _delete_job(job, job_status, pipe)
+                pipe.delete(f"autotest:test_result:{id_}")
+            pipe.execute()
+        yield "".join(f"{line}\n" for line in lines)
+
+
+_DONE_STATUSES = {"finished", "failed", "canceled", "stopped", None}
+
+
+def _format_event(test_id, status):
+    return f"event: status\ndata: {json.dumps({'test_id': test_id, 'status': status})}\n\n"
+
+
+class _StatusTracker:
+    """
+    Keep track of the statuses of the tests that an event stream reports on and of the events to send next.
+
+    If test_ids is not None, only those tests are tracked and they are checked right away. Otherwise, any test that
+    status change messages are received for is tracked.
+    """
+
+    def __init__(self, test_ids=None):
+        self.test_ids = test_ids
+        self.tracked = {}  # last status reported to the client for each test that is not done yet
+        self.pending = dict.fromkeys(test_ids or [], "")  # tests to check and the status last published for them
+        self.last_reconcile = self.last_sent = time.monotonic()
+
+    def to_check(self):
+        """Return the ids of the tests whose statuses should be looked up next"""
+        if time.monotonic() - self.last_reconcile > EVENTS_RECONCILE_INTERVAL:
+            self.pending.update((id_, "") for id_ in self.tracked if id_ not in self.pending)
+            self.last_reconcile = time.monotonic()
+        return list(self.pending)
+
+    def update(self, statuses):
+        """
+        Update the tracked tests given the statuses looked up for the tests returned by to_check. Return the events
+        to send to the client (or a keepalive comment if nothing has been sent for a while) or None.
+        """
+        events = []
+        for id_, status in statuses.items():
+            if status != self.tracked.get(id_, ""):
+                events.append(_format_event(id_, status))
+            if status in _DONE_STATUSES:
+                self.tracked.pop(id_, None)
+                self.pending.pop(id_)
+            else:
+                self.tracked[id_] = status
+                # if the test was published as finished, keep checking until the job has caught up
+                if self.pending[id_] != "finished":
+                    self.pending.pop(id_)
+        if events:
+            self.last_sent = time.monotonic()
+            return "".join(events)
+        if time.monotonic() - self.last_sent > EVENTS_KEEPALIVE_INTERVAL:
+            self.last_sent = time.monotonic()
+            return ": keepalive\n\n"
+        return None
+
+    def notify(self, data):
+        """Record a status change message published by a worker"""
+        event = json.loads(data)
+        if self.test_ids is None or event["test_id"] in self.tracked:
+            self.pending[event["test_id"]] = event["status"]
+
+    def done(self):
+        """Return True if the stream should end because all tests it reports on are done"""
+        return self.test_ids is not None and not self.tracked
+
+
+def _iter_events(settings_id, test_ids=None):
+    """
+    Yield server-sent events that report status changes of the tests belonging to the settings with id settings_id.
+
+    If test_ids is not None, only report changes for those tests: the current status of each is reported first and
+    the stream ends once all of them are done. Otherwise, report changes for all tests of these settings until the
+    client disconnects.
+
+    Workers publish a message on autotest:events:<settings_id> whenever a test starts or finishes. These messages
+    are only used as a hint that a status has changed, the status itself is always read from the job so that
+    clients never see a test as finished before its job is. Tracked tests are also checked every
+    EVENTS_RECONCILE_INTERVAL seconds to catch jobs that fail without publishing a message (e.g. timeouts).
+    """
+    pubsub = REDIS_CONNECTION.pubsub()
+    pubsub.subscribe(f"autotest:events:{settings_id}")
+    try:
+        tracker = _StatusTracker(test_ids)
+        while True:
+            output = tracker.update(_get_statuses(tracker.to_check(), settings_id))
+            if output is not None:
+                yield output
+            if tracker.done():
+                return
+            message = pubsub.get_message(timeout=EVENTS_POLL_INTERVAL)
+            while message is not None:
+                if message["type"] == "message":
+                    tracker.notify(message["data"])
+                message = pubsub.get_message()
+    finally:
+        pubsub.close()
+
+
+def _iter_redis_value(key, start, stop, delete=False):
+    """
+    Yield the bytes from start to stop of the string stored at key in chunks of FEEDBACK_CHUNK_SIZE.
+    Delete the key once all bytes have been yielded if delete is True.
+    """
+    for chunk_start in range(start, stop, FEEDBACK_CHUNK_SIZE):
+        chunk_end = min(chunk_start + FEEDBACK_CHUNK_SIZE, stop) - 1
+        yield REDIS_CONNECTION.getrange(key, chunk_start, chunk_end)
+    if delete:
+        REDIS_CONNECTION.delete(key)
+
+
+def _iter_decompressed(chunks):
+    """Yield the decompressed content of gzip compressed data given as an iterable of chunks"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class _StreamBuffer:
+    """A minimal write-only file object that collects written bytes until they are taken with pop"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _iter_feedback_zip(tests_id, feedback_files):
+    """
+    Yield a zip file containing the decompressed content of each feedback file in feedback_files (a dictionary
+    mapping feedback file ids to their info) as it is being written.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for id_, info in feedback_files.items():
+            key = f"autotest:feedback_file:{tests_id}:{id_}"
+            length = REDIS_CONNECTION.strlen(key)
+            if not length:
+                continue
+            with zf.open(f"{id_}/{info['filename']}", mode="w") as f:
+                for data in _iter_decompressed(_iter_redis_value(key, 0, length)):
+                    f.write(data)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+    REDIS_CONNECTION.delete(*(f"autotest:feedback_file:{tests_id}:{id_}" for id_ in feedback_files))
+    REDIS_CONNECTION.delete(f"autotest:feedback_files:{tests_id}")
 
 
 def authorize(func):
@@ -149,23 +657,15 @@ def authorize(func):
     @wraps(func)
     def _f(*args, **kwargs):
         user = None
-        log_msg = None
         try:
             user = _authorize_user()
             _authorize_settings(**kwargs, user=user)
             _authorize_tests(**kwargs)
-            log_msg = f"AUTHORIZED\n\t{datetime.now()}\n\turl: {request.url}\n\tuser: {user}\n"
+            ACCESS_LOGGER.info("AUTHORIZED", extra={"url": request.url, "user": user})
         except HTTPException as e:
-            log_msg = (
-                f"UNAUTHORIZED\n\t{datetime.now()}\n\t"
-                f"url: {request.url}\n\tuser: {user}\n\tresponse: {e.response.response}\n"
-            )
+            extra = {"url": request.url, "user": user, "response": e.response.get_data(as_text=True)}
+            ACCESS_LOGGER.info("UNAUTHORIZED", extra=extra)
             raise e
-        finally:
-            if log_msg:
-                with _open_log(ACCESS_LOG) as f:
-                    f.write(log_msg)
-                    f.flush()
         return func(*args, **kwargs, user=user)
 
     return _f
@@ -190,31 +690,47 @@ def reset_credentials(user):
     credentials = request.json.get("credentials")
     data = {"auth_type": auth_type, "credentials": credentials}
     REDIS_CONNECTION.hset("autotest:user_credentials", key=user, value=json.dumps(data))
+    CREDENTIALS_CACHE.pop(user)
     return jsonify(success=True)
 
 
 @app.route("/schema", methods=["GET"])
 @authorize
 def schema(**_kwargs):
-    return json.loads(REDIS_CONNECTION.get("autotest:schema") or "{}")
+    version = REDIS_CONNECTION.get("autotest:schema_version")
+    if version is None:
+        return _load_schema(version)
+    etag = version.decode()
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    response = jsonify(_load_schema(version))
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/settings/<settings_id>", methods=["GET"])
 @authorize
 def settings(settings_id, **_kw):
-    settings_ = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id) or "{}")
-    if settings_.get("_error"):
-        raise Exception(f"Settings Error: {settings_['_error']}")
-    return {k: v for k, v in settings_.items() if not k.startswith("_")}
+    meta = settings_store.get_metadata(REDIS_CONNECTION, settings_id, "error", "etag") or {}
+    if meta.get("error"):
+        raise Exception(f"Settings Error: {meta['error']}")
+    etag = meta.get("etag")
+    if etag is not None and request.if_none_match.contains(etag):
+        return _not_modified(etag)
+    # the body is sent as stored: settings are written without any (private) metadata keys
+    response = Response(
+        REDIS_CONNECTION.hget(settings_store.SETTINGS_KEY, settings_id) or "{}", mimetype="application/json"
+    )
+    if etag is not None:
+        response.set_etag(etag)
+    return response
 
 
 @app.route("/settings", methods=["POST"])
 @authorize
 def create_settings(user):
     settings_id = REDIS_CONNECTION.incr("autotest:settings_id")
-    REDIS_CONNECTION.hset(
-        "autotest:settings", key=settings_id, value=json.dumps({"_user": user, "_env_status": "setup"})
-    )
+    REDIS_CONNECTION.hset(settings_store.meta_key(settings_id), mapping={"user": user, "env_status": "setup"})
     _update_settings(settings_id, user)
     return {"settings_id": settings_id}
 
@@ -229,13 +745,13 @@ def update_settings(settings_id, user):
 @app.route("/settings/<settings_id>/test", methods=["PUT"])
 @authorize
 def run_tests(settings_id, user):
-    test_settings = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id))
-    env_status = test_settings.get("_env_status")
+    meta = settings_store.get_metadata(REDIS_CONNECTION, settings_id, "env_status", "error", "timeout", "groups") or {}
+    env_status = meta.get("env_status")
     if env_status == "setup":
         abort(make_response(jsonify(message="Setting up test environment. Please try again later."), 503))
     elif env_status == "error":
         msg = "Settings Error"
-        settings_error = test_settings.get("_error", "")
+        settings_error = meta.get("error") or ""
         if settings_error:
             msg += f": {settings_error}"
         raise Exception(msg)
@@ -243,38 +759,67 @@ def run_tests(settings_id, user):
     test_data = request.json["test_data"]
     categories = request.json["categories"]
     high_priority = request.json.get("request_high_priority")
+    callback_url = request.json.get("callback_url")
+    if callback_url is not None and not callback_url.startswith(("http://", "https://")):
+        abort(make_response(jsonify(message="callback_url must be an http or https url"), 422))
     queue_name = "batch" if len(test_data) > 1 else ("high" if high_priority else "low")
-    queue = rq.Queue(queue_name, connection=REDIS_CONNECTION)
-
-    timeout = 0
-
-    for settings_ in test_settings["testers"]:
-        for data in settings_["test_data"]:
-            timeout += data["timeout"]
-
-    ids = []
-    for data in test_data:
-        url = data["file_url"]
-        test_env_vars = data.get("env_vars", {})
-        id_ = REDIS_CONNECTION.incr("autotest:tests_id")
-        REDIS_CONNECTION.hset("autotest:tests", key=id_, value=settings_id)
-        ids.append(id_)
+    queue = rq.Queue(_batch_queue_name(user) if queue_name == "batch" else queue_name, connection=REDIS_CONNECTION)
+    retry_after = _retry_after(queue_name, queue, len(test_data))
+    if retry_after is not None:
+        response = make_response(jsonify(message="Too many tests are waiting to run. Please try again later."), 503)
+        response.headers["Retry-After"] = str(retry_after)
+        abort(response)
+
+    # only the test groups in the requested categories are run (settings written by older versions have no groups)
+    groups = json.loads(meta["groups"]) if meta.get("groups") else None
+    if groups is None:
+        timeout = int(meta.get("timeout") or 0)
+    else:
+        requested = settings_store.requested_groups(groups, categories)
+        # the tests of each group are stopped by the autotester after the configured timeout of the group, so the job
+        # must be allowed to run for at least that long even if the recorded run times are much shorter
+        timeout = sum(groups[i][1] for i in requested)
+    score = None
+    if queue_name == "low" and SJF_WEIGHT and groups is not None:
+        now = time.time()
+        recorded = _recorded_runtimes(settings_id, requested)
+        score = now + SJF_WEIGHT * _expected_runtime(groups, requested, recorded)
+
+    # allocate a block of ids, then map them to the settings and enqueue all jobs in a single pipeline
+    last_id = REDIS_CONNECTION.incrby("autotest:tests_id", len(test_data)) if test_data else 0
+    ids = list(range(last_id - len(test_data) + 1, last_id + 1))
+    job_data = []
+    for id_, data in zip(ids, test_data):
         data = {
             "settings_id": settings_id,
             "test_id": id_,
-            "files_url": url,
+            "files_url": data["file_url"],
             "categories": categories,
             "user": user,
-            "test_env_vars": test_env_vars,
+            "test_env_vars": data.get("env_vars", {}),
         }
-        queue.enqueue_call(
-            "autotest_server.run_test",
-            kwargs=data,
-            job_id=str(id_),
-            timeout=int(timeout * 1.5),
-            failure_ttl=3600,
-            result_ttl=3600,
-        )  # TODO: make this configurable
+        if callback_url:
+            data["callback_url"] = callback_url
+        job_data.append(
+            rq.Queue.prepare_data(
+                "autotest_server.run_test",
+                kwargs=data,
+                job_id=str(id_),
+                timeout=int(timeout * 1.5) or None,
+                failure_ttl=3600,
+                result_ttl=3600,
+            )  # TODO: make this configurable
+        )
+    if ids:
+        with REDIS_CONNECTION.pipeline() as pipe:
+            pipe.hset("autotest:tests", mapping={id_: settings_id for id_ in ids})
+            if queue_name == "batch":
+                pipe.sadd(BATCH_QUEUES_KEY, queue.name)
+            queue.enqueue_many(job_data, pipeline=pipe)
+            if score is not None:
+                SJF_SCRIPT(keys=[queue.key, SJF_INDEX_KEY], args=[ids[0], score, now], client=pipe)
+            pipe.execute()
+        JOBS_ENQUEUED.inc(len(ids), queue=queue_name)
 
     return {"test_ids": ids}
 
@@ -284,51 +829,165 @@ def run_tests(settings_id, user):
 def get_result(settings_id, tests_id, **_kw):
     job = rq.job.Job.fetch(tests_id, connection=REDIS_CONNECTION)
     job_status = job.get_status()
-    result = {"status": job_status}
-    if job_status == "finished":
-        test_result = REDIS_CONNECTION.get(f"autotest:test_result:{tests_id}")
-        try:
-            result.update(json.loads(test_result))
-        except json.JSONDecodeError:
-            result.update({"error": f"invalid json: {test_result}"})
-    elif job_status == "failed":
-        result.update({"error": str(job.exc_info)})
+    test_result = REDIS_CONNECTION.get(f"autotest:test_result:{tests_id}") if job_status == "finished" else None
+    result = _format_result(job, job_status, test_result)
     job.delete()
     REDIS_CONNECTION.delete(f"autotest:test_result:{tests_id}")
     return result
 
 
+@app.route("/settings/<settings_id>/tests/results", methods=["GET"])
+@authorize
+def get_results(settings_id, **_kw):
+    test_ids = request.json["test_ids"]
+    return Response(stream_with_context(_iter_results(test_ids, settings_id)), mimetype="application/x-ndjson")
+
+
 @app.route("/settings/<settings_id>/test/<tests_id>/feedback/<feedback_id>", methods=["GET"])
 @authorize
 def get_feedback_file(settings_id, tests_id, feedback_id, **_kw):
+    """
+    Stream a gzip compressed feedback file straight from redis.
+
+    By default the compressed file itself is sent (mimetype application/gzip). If the decompress query parameter is
+    set, the original file is sent instead: as is with a Content-Encoding: gzip header if the client accepts gzip
+    encoding, otherwise decompressed while it is streamed. Single byte ranges of the stored (compressed) file are
+    supported; requests for multiple ranges are answered with the whole file.
+    The feedback file is deleted once it has been sent in full.
+    """
     key = f"autotest:feedback_file:{tests_id}:{feedback_id}"
-    data = REDIS_CONNECTION.get(key)
-    if data is None:
+    length = REDIS_CONNECTION.strlen(key)
+    if not length:
         abort(make_response(jsonify(message="File doesn't exist"), 404))
-    REDIS_CONNECTION.delete(key)
-    return send_file(io.BytesIO(data), mimetype="application/gzip", as_attachment=True, download_name=str(feedback_id))
+    decompress = request.args.get("decompress", "").lower() in ("1", "true")
+    gzip_passthrough = decompress and "gzip" in request.accept_encodings
+    start, stop = 0, length
+    if request.range is not None and len(request.range.ranges) == 1 and (gzip_passthrough or not decompress):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            abort(make_response("", 416, {"Content-Range": f"bytes */{length}"}))
+        start, stop = byte_range
+    delete = (start, stop) == (0, length)
+
+    if decompress:
+        info = json.loads(REDIS_CONNECTION.hget(f"autotest:feedback_files:{tests_id}", feedback_id) or "{}")
+        mimetype = info.get("mime_type", "application/octet-stream")
+    else:
+        mimetype = "application/gzip"
+
+    if decompress and not gzip_passthrough:
+        body = _iter_decompressed(_iter_redis_value(key, start, stop, delete=delete))
+        response = Response(stream_with_context(body), mimetype=mimetype)
+    else:
+        body = _iter_redis_value(key, start, stop, delete=delete)
+        response = Response(stream_with_context(body), mimetype=mimetype, status=200 if delete else 206)
+        response.content_length = stop - start
+        response.headers["Accept-Ranges"] = "bytes"
+        if not delete:
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        if gzip_passthrough:
+            response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers.set("Content-Disposition", "attachment", filename=str(feedback_id))
+    return response
+
+
+@app.route("/settings/<settings_id>/test/<tests_id>/feedback", methods=["GET"])
+@authorize
+def get_feedback_files(settings_id, tests_id, **_kw):
+    """
+    Stream all feedback files of a test as a single zip file. Each file is stored as <feedback_id>/<filename>.
+    The feedback files are deleted once they have been sent.
+    """
+    index_key = f"autotest:feedback_files:{tests_id}"
+    feedback_files = {id_.decode(): json.loads(info) for id_, info in REDIS_CONNECTION.hgetall(index_key).items()}
+    if not feedback_files:
+        abort(make_response(jsonify(message="No feedback files exist"), 404))
+    response = Response(stream_with_context(_iter_feedback_zip(tests_id, feedback_files)), mimetype="application/zip")
+    response.headers.set("Content-Disposition", "attachment", filename=f"feedback_{tests_id}.zip")
+    return response
 
 
 @app.route("/settings/<settings_id>/tests/status", methods=["GET"])
 @authorize
 def get_statuses(settings_id, **_kw):
-    test_ids = request.json["test_ids"]
-    result = {}
-    for id_, job in zip(test_ids, _get_jobs(test_ids, settings_id)):
-        result[id_] = job if job is None else job.get_status()
-    return result
+    return _get_statuses(request.json["test_ids"], settings_id)
+
+
+@app.route("/settings/<settings_id>/tests/events", methods=["GET"])
+@authorize
+def get_events(settings_id, **_kw):
+    test_ids = request.args.get("test_ids")
+    if test_ids is not None:
+        test_ids = [int(id_) for id_ in test_ids.split(",") if id_]
+    return Response(
+        stream_with_context(_iter_events(settings_id, test_ids)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/settings/<settings_id>/tests/cancel", methods=["DELETE"])
 @authorize
 def cancel_tests(settings_id, **_kw):
-    test_ids = request.json["test_ids"]
-    result = {}
-    for id_, job in zip(test_ids, _get_jobs(test_ids, settings_id)):
-        result[id_] = job if job is None else job.cancel()
+    """
+    Cancel the tests in test_ids. Queued jobs are cancelled right away, running jobs are flagged so that the worker
+    running them kills the tester and moves on (see autotest_server._communicate). All cancellations are sent in a
+    single pipeline.
+    """
+    statuses = _get_statuses(request.json["test_ids"], settings_id)
+    queued = {str(id_): id_ for id_, status in statuses.items() if status in _CANCELABLE_STATUSES}
+    jobs = rq.job.Job.fetch_many(list(queued), connection=REDIS_CONNECTION)
+    with REDIS_CONNECTION.pipeline() as pipe:
+        for job in jobs:
+            if job is not None:
+                id_ = queued[job.id]
+                _cancel_job(job, statuses[id_], pipe)
+                pipe.publish(f"autotest:events:{settings_id}", json.dumps({"test_id": id_, "status": "canceled"}))
+        for id_, status in statuses.items():
+            if status == "started":
+                pipe.set(f"autotest:cancel:{id_}", 1, ex=CANCEL_TTL)
+        pipe.execute()
     return jsonify(success=True)
 
 
 @app.route("/status", methods=["GET"])
 def status():
     return jsonify(success=True)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    queues = [rq.Queue(name, connection=REDIS_CONNECTION) for name in METRICS_QUEUES]
+    with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.llen(queue.key)
+            pipe.zcard(queue.started_job_registry.key)
+        pipe.hgetall("autotest:metrics")
+        pipe.smembers(BATCH_QUEUES_KEY)
+        *lengths, stored, batch_queues = pipe.execute()
+    counts = {
+        queue.name: [n_queued, n_started] for queue, n_queued, n_started in zip(queues, lengths[::2], lengths[1::2])
+    }
+    if batch_queues:
+        # batches are queued separately for each user, report them all as the batch queue
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            for name in batch_queues:
+                queue = rq.Queue(name.decode(), connection=REDIS_CONNECTION)
+                pipe.llen(queue.key)
+                pipe.zcard(queue.started_job_registry.key)
+            batch_lengths = pipe.execute()
+        counts["batch"] = [sum(batch_lengths[i::2]) + counts["batch"][i] for i in (0, 1)]
+    queued = metrics.Gauge("autotest_queue_length", "Number of jobs waiting in each queue")
+    started = metrics.Gauge("autotest_queue_started", "Number of jobs currently running from each queue")
+    for name, (n_queued, n_started) in counts.items():
+        queued.set(n_queued, queue=name)
+        started.set(n_started, queue=name)
+    stored = {k.decode(): int(v) for k, v in stored.items()}
+    counters = []
+    for name, documentation in STORED_METRICS.items():
+        counter = metrics.Counter(f"autotest_{name}_total", documentation)
+        counter.inc(stored.get(name, 0))
+        counters.append(counter)
+    body = metrics.render([*METRICS, queued, started, *counters])
+    return Response(body, mimetype="text/plain; version=0.0.4")
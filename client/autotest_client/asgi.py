@@ -0,0 +1,252 @@
+"""
+An asynchronous (ASGI) version of the API.
+
+The endpoints that clients poll or hold open (test statuses and status change events) are served by a Quart app
+that uses redis.asyncio with a single connection pool so that one process can serve many concurrent clients.
+All event streams of a process also share a single pubsub connection. Every other request is passed on to the
+Flask app (which remains the default way to run the API) in a thread pool.
+
+Run it with any ASGI server, for example:
+
+    hypercorn autotest_client.asgi:app
+"""
+
+import asyncio
+import json
+import time
+import traceback
+from collections import defaultdict
+from functools import wraps
+
+import redis.asyncio
+from a2wsgi import WSGIMiddleware
+from quart import Quart, Response, request, jsonify, abort, g
+from redis.asyncio.retry import Retry
+from redis.backoff import FullJitterBackoff
+from redis.exceptions import TimeoutError, ConnectionError
+from werkzeug.exceptions import HTTPException
+
+import autotest_client as api
+from autotest_client import metrics, settings_store
+
+REDIS_CONNECTION = redis.asyncio.Redis.from_url(
+    api.REDIS_URL,
+    retry=Retry(FullJitterBackoff(cap=10, base=1), 25),
+    retry_on_error=[ConnectionError, TimeoutError],
+    health_check_interval=1,
+)
+REDIS_CONNECTION.connection_pool.connection_class = metrics.timed_async_connection_class(
+    REDIS_CONNECTION.connection_pool.connection_class, api.REDIS_DURATION
+)
+
+RATE_LIMIT_SCRIPT = REDIS_CONNECTION.register_script(api.RATE_LIMIT_SCRIPT.script)
+
+async_app = Quart(__name__)
+
+
+@async_app.before_request
+async def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@async_app.after_request
+async def _observe_duration(response):
+    if "request_start" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        duration = time.perf_counter() - g.request_start
+        api.REQUEST_DURATION.observe(duration, route=route, method=request.method, status=str(response.status_code))
+    return response
+
+
+@async_app.errorhandler(Exception)
+async def _handle_error(e):
+    code = 500
+    error = str(e)
+    if isinstance(e, HTTPException):
+        code = e.code
+    api_key = request.headers.get("Api-Key")
+    api.ERROR_LOGGER.error(str(e), extra={"user": api_key, "traceback": traceback.format_exc()})
+    if not async_app.debug and api_key:
+        error = str(e).replace(api_key, "[client-api-key]")
+    return jsonify(message=error), code
+
+
+def _abort(message, code):
+    abort(Response(json.dumps({"message": message}), status=code, mimetype="application/json"))
+
+
+async def _has_credentials(api_key):
+    """Return True if credentials have been registered for api_key (see autotest_client._has_credentials)"""
+    if api.CREDENTIALS_CACHE.get(api_key):
+        return True
+    registered = await REDIS_CONNECTION.hexists("autotest:user_credentials", api_key)
+    if registered:
+        api.CREDENTIALS_CACHE.set(api_key, True)
+    return registered
+
+
+async def _authorize_user():
+    api_key = request.headers.get("Api-Key")
+    if api_key is None or not await _has_credentials(api_key):
+        _abort("Unauthorized", 401)
+    keys = [f"autotest:ratelimit:{api_key}", f"autotest:ratelimit:{api_key}:limit"]
+    if not await RATE_LIMIT_SCRIPT(keys=keys, args=[api.RATE_LIMIT, api.RATE_LIMIT_BURST], client=REDIS_CONNECTION):
+        _abort("Too many requests", 429)
+    return api_key
+
+
+async def _authorize_settings(user, settings_id=None, **_kw):
+    if settings_id:
+        settings_user = await REDIS_CONNECTION.hget(settings_store.meta_key(settings_id), "user")
+        if settings_user is None:
+            # settings written by an older version are migrated by the synchronous implementation
+            meta = await asyncio.to_thread(settings_store.get_metadata, api.REDIS_CONNECTION, settings_id, "user")
+            if meta is None:
+                _abort("Settings not found", 404)
+            settings_user = meta["user"]
+        else:
+            settings_user = settings_user.decode()
+        if settings_user != user:
+            _abort("Unauthorized", 401)
+
+
+def authorize(func):
+    # non-secure authorization
+    @wraps(func)
+    async def _f(*args, **kwargs):
+        user = None
+        try:
+            user = await _authorize_user()
+            await _authorize_settings(**kwargs, user=user)
+            api.ACCESS_LOGGER.info("AUTHORIZED", extra={"url": request.url, "user": user})
+        except HTTPException as e:
+            extra = {"url": request.url, "user": user, "response": await e.response.get_data(as_text=True)}
+            api.ACCESS_LOGGER.info("UNAUTHORIZED", extra=extra)
+            raise e
+        return await func(*args, **kwargs, user=user)
+
+    return _f
+
+
+async def _get_statuses(test_ids, settings_id):
+    """Return the statuses of the tests in test_ids (see autotest_client._get_statuses)"""
+    test_ids = list(test_ids)
+    if not test_ids:
+        return {}
+    async with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+        api._queue_status_lookups(pipe, test_ids)
+        return api._parse_statuses(test_ids, settings_id, await pipe.execute())
+
+
+class _EventBroker:
+    """
+    Share a single pubsub connection between all event streams of this process. Each stream gets a queue that the
+    data of every message published on the channel it subscribed to is put on.
+    """
+
+    def __init__(self):
+        self._pubsub = None
+        self._reader = None
+        self._queues = defaultdict(set)
+
+    async def subscribe(self, channel):
+        """Subscribe to channel and return the queue that its messages will be put on"""
+        if self._pubsub is None:
+            self._pubsub = REDIS_CONNECTION.pubsub()
+        if not self._queues[channel]:
+            await self._pubsub.subscribe(channel)
+        queue = asyncio.Queue()
+        self._queues[channel].add(queue)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        """Stop putting messages published on channel on queue"""
+        self._queues[channel].discard(queue)
+        if not self._queues[channel]:
+            del self._queues[channel]
+            await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while self._queues:
+            message = await self._pubsub.get_message(timeout=api.EVENTS_POLL_INTERVAL)
+            if message is not None and message["type"] == "message":
+                for queue in self._queues.get(message["channel"].decode(), ()):
+                    queue.put_nowait(message["data"])
+
+
+EVENTS = _EventBroker()
+
+
+async def _iter_events(settings_id, test_ids=None):
+    """Yield server-sent events that report status changes of tests (see autotest_client._iter_events)"""
+    channel = f"autotest:events:{settings_id}"
+    messages = await EVENTS.subscribe(channel)
+    try:
+        tracker = api._StatusTracker(test_ids)
+        while True:
+            output = tracker.update(await _get_statuses(tracker.to_check(), settings_id))
+            if output is not None:
+                yield output
+            if tracker.done():
+                return
+            try:
+                tracker.notify(await asyncio.wait_for(messages.get(), api.EVENTS_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                continue
+            while not messages.empty():
+                tracker.notify(messages.get_nowait())
+    finally:
+        await EVENTS.unsubscribe(channel, messages)
+
+
+@async_app.route("/settings/<settings_id>/tests/status", methods=["GET"])
+@authorize
+async def get_statuses(settings_id, **_kw):
+    return await _get_statuses((await request.get_json())["test_ids"], settings_id)
+
+
+@async_app.route("/settings/<settings_id>/tests/events", methods=["GET"])
+@authorize
+async def get_events(settings_id, **_kw):
+    test_ids = request.args.get("test_ids")
+    if test_ids is not None:
+        test_ids = [int(id_) for id_ in test_ids.split(",") if id_]
+    return Response(
+        _iter_events(settings_id, test_ids),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@async_app.route("/status", methods=["GET"])
+async def status():
+    return jsonify(success=True)
+
+
+class _Dispatcher:
+    """
+    An ASGI app that serves requests for the routes of asgi_app with asgi_app and all other requests with the WSGI
+    app wsgi_app.
+    """
+
+    def __init__(self, asgi_app, wsgi_app):
+        self.asgi_app = asgi_app
+        self.wsgi_app = WSGIMiddleware(wsgi_app)
+
+    def _is_async_route(self, scope):
+        try:
+            self.asgi_app.url_map.bind("").match(scope["path"], method=scope["method"])
+        except HTTPException:
+            return False
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not self._is_async_route(scope):
+            await self.wsgi_app(scope, receive, send)
+        else:
+            await self.asgi_app(scope, receive, send)
+
+
+app = _Dispatcher(async_app, api.app)
@@ -1,17 +1,47 @@
 from jsonschema import Draft7Validator, validators, ValidationError
 from jsonschema.exceptions import best_match
-from copy import deepcopy
-from typing import Type, Generator, Dict, Union, List, Optional
+from functools import lru_cache
+from typing import Type, Generator, Dict, Union, List, Optional, Any, Callable, Iterable, Tuple
 
 ValidatorType = type(Draft7Validator)
 
+# keywords that fill in defaults on the instance. These are applied before all other keywords in the same schema
+# so that keywords like 'required' or 'minProperties' see the instance after defaults have been filled in.
+_DEFAULT_KEYWORDS = ("properties", "items", "dependencies", "oneOf")
 
+
+def _copy_json(obj: Any) -> Any:
+    """
+    Return a copy of obj where obj is json-like data (nested dicts and lists of immutable values).
+    This is much faster than copy.deepcopy for this kind of data.
+    """
+    if isinstance(obj, dict):
+        return {k: _copy_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_copy_json(v) for v in obj]
+    return obj
+
+
+def _defaults_first(applicable_validators: Callable) -> Callable:
+    """
+    Wrap applicable_validators so that the keywords in _DEFAULT_KEYWORDS are applied first.
+    """
+
+    def _applicable_validators(schema: Dict) -> Iterable[Tuple[str, Any]]:
+        return sorted(applicable_validators(schema), key=lambda item: item[0] not in _DEFAULT_KEYWORDS)
+
+    return _applicable_validators
+
+
+@lru_cache(maxsize=None)
 def _extend_with_default(
     validator_class: Type[ValidatorType] = Draft7Validator,
 ) -> ValidatorType:
     """
     Extends a validator class to add defaults before validation.
     From: https://github.com/Julian/jsonschema/blob/master/docs/faq.rst
+
+    The extended class is cached since creating a validator class is expensive.
     """
     validate_props = validator_class.VALIDATORS["properties"]
     validate_array = validator_class.VALIDATORS["items"]
@@ -77,10 +107,7 @@ def _extend_with_default(
         good_instance = None
 
         for i, subschema in enumerate(properties):
-            new_instance = deepcopy(instance)
-            # first time to fill in defaults since validating 'required', 'minProperties',
-            # etc. can't be done until the instance has been properly filled with defaults.
-            list(validator.descend(new_instance, subschema, schema_path=i))
+            new_instance = _copy_json(instance)
             errs = list(validator.descend(new_instance, subschema, schema_path=i))
             if errs:
                 all_errors.extend(errs)
@@ -104,7 +131,14 @@ def _extend_with_default(
         "oneOf": _set_oneof_defaults,
     }
 
-    return validators.extend(validator_class, custom_validators)
+    return validators.create(
+        meta_schema=validator_class.META_SCHEMA,
+        validators={**validator_class.VALIDATORS, **custom_validators},
+        type_checker=validator_class.TYPE_CHECKER,
+        format_checker=validator_class.FORMAT_CHECKER,
+        id_of=validator_class.ID_OF,
+        applicable_validators=_defaults_first(validator_class._APPLICABLE_VALIDATORS),
+    )
 
 
 def _validate_with_defaults(
@@ -115,12 +149,12 @@ def _validate_with_defaults(
 ) -> Union[ValidationError, List[ValidationError]]:
     """
     Return an iterator that yields errors from validating obj on schema
-    after first filling in defaults on obj.
+    while filling in defaults on obj.
+
+    Defaults are filled in before any other keyword in the same schema is validated (see _defaults_first) so
+    a single pass is enough to both fill in defaults and validate.
     """
     validator = _extend_with_default(validator_class)(schema)
-    # first time to fill in defaults since validating 'required', 'minProperties',
-    # etc. can't be done until the instance has been properly filled with defaults.
-    list(validator.iter_errors(obj))
     errors = list(validator.iter_errors(obj))
     if best_only:
         return best_match(errors)
@@ -131,10 +165,14 @@ def validate_against_schema(test_specs: Dict, schema: Dict, filenames: List[str]
     """
     Check if test_specs is valid according to the schema.
     Raise an error if it is not valid.
+
+    The schema is not modified so that it can be cached by the caller.
     """
-    schema["definitions"]["files_list"]["enum"] = filenames
+    definitions = dict(schema["definitions"])
+    definitions["files_list"] = {**definitions["files_list"], "enum": filenames}
     # don't validate based on categories
-    schema["definitions"]["test_data_categories"].pop("enum")
-    schema["definitions"]["test_data_categories"].pop("enumNames")
-    error = _validate_with_defaults(schema, test_specs, best_only=True)
+    definitions["test_data_categories"] = {
+        k: v for k, v in definitions["test_data_categories"].items() if k not in ("enum", "enumNames")
+    }
+    error = _validate_with_defaults({**schema, "definitions": definitions}, test_specs, best_only=True)
     return str(error) if error else None
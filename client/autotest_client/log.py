@@ -0,0 +1,110 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from datetime import datetime
+from typing import Optional, TextIO
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format each record as a single line json object containing the time the record was created, its message
+    and any extra fields that were passed to the logger.
+    """
+
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"timestamp": datetime.fromtimestamp(record.created).isoformat(), "message": record.getMessage()}
+        data.update((k, v) for k, v in vars(record).items() if k not in self._RESERVED)
+        return json.dumps(data, default=str)
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A rotating file handler that only flushes once at least flush_size characters have been written since the last
+    flush or the last flush was at least flush_interval seconds ago.
+    """
+
+    def __init__(
+        self, filename: str, max_bytes: int = 0, backup_count: int = 0, flush_size: int = 0, flush_interval: float = 0
+    ) -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record) + self.terminator
+            self.stream.write(msg)
+            self._buffered += len(msg)
+            if self._buffered >= self.flush_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        super().flush()
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """
+    A queue listener that flushes its handlers whenever no records have been received for flush_interval seconds
+    so that buffered records are not held back indefinitely when there is no traffic.
+    """
+
+    def __init__(self, queue_: queue.Queue, *handlers: logging.Handler, flush_interval: float = 1) -> None:
+        super().__init__(queue_, *handlers)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+
+def queue_logger(
+    name: str,
+    filename: Optional[str],
+    fallback: TextIO,
+    max_bytes: int = 0,
+    backup_count: int = 0,
+    flush_size: int = 0,
+    flush_interval: float = 0,
+) -> logging.Logger:
+    """
+    Return a logger that writes json lines to filename (or to fallback if filename is empty) from a background thread.
+
+    Logging a record only puts it on a queue. The background thread writes the records with a
+    BufferedRotatingFileHandler using the max_bytes, backup_count, flush_size and flush_interval arguments.
+    """
+    if filename:
+        handler = BufferedRotatingFileHandler(filename, max_bytes, backup_count, flush_size, flush_interval)
+    else:
+        handler = logging.StreamHandler(fallback)
+    handler.setFormatter(JsonFormatter())
+    records = queue.Queue()
+    listener = FlushingQueueListener(records, handler, flush_interval=flush_interval or 1)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger(name)
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
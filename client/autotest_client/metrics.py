@@ -0,0 +1,168 @@
+import bisect
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+import redis
+import redis.asyncio
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = ((k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics kept in this process. Values are stored per set of labels and can be updated from
+    any thread.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        """Yield the name, labels and value of each sample of this metric"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Return this metric in the prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str) -> None:
+        super().__init__(name, documentation)
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = sorted(buckets)
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> Iterable[Tuple[str, Labels, float]]:
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", (*labels, ("le", _format_value(bound))), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+def render(metrics: Iterable[Metric]) -> str:
+    """Return all metrics in the prometheus text exposition format"""
+    return "".join(metric.render() for metric in metrics)
+
+
+def timed_connection_class(connection_class: Type[redis.Connection], histogram: Histogram) -> Type[redis.Connection]:
+    """
+    Return a subclass of connection_class that observes the time between sending a command (or a pipeline of
+    commands) and reading the first reply in histogram.
+    """
+
+    class TimedConnection(connection_class):
+        _sent: Optional[float] = None
+
+        def send_packed_command(self, command, check_health=True):
+            start = time.perf_counter()
+            super().send_packed_command(command, check_health=check_health)
+            self._sent = start
+
+        def read_response(self, *args, **kwargs):
+            response = super().read_response(*args, **kwargs)
+            if self._sent is not None:
+                histogram.observe(time.perf_counter() - self._sent)
+                self._sent = None
+            return response
+
+    TimedConnection.__name__ = f"Timed{connection_class.__name__}"
+    return TimedConnection
+
+
+def timed_async_connection_class(
+    connection_class: Type[redis.asyncio.Connection], histogram: Histogram
+) -> Type[redis.asyncio.Connection]:
+    """The same as timed_connection_class for connections used by redis.asyncio"""
+
+    class TimedConnection(connection_class):
+        _sent: Optional[float] = None
+
+        async def send_packed_command(self, command, check_health=True):
+            start = time.perf_counter()
+            await super().send_packed_command(command, check_health=check_health)
+            self._sent = start
+
+        async def read_response(self, *args, **kwargs):
+            response = await super().read_response(*args, **kwargs)
+            if self._sent is not None:
+                histogram.observe(time.perf_counter() - self._sent)
+                self._sent = None
+            return response
+
+    TimedConnection.__name__ = f"Timed{connection_class.__name__}"
+    return TimedConnection
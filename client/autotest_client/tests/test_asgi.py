@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import a2wsgi
+import fakeredis
+import pytest
+import rq
+import werkzeug.test
+
+import autotest_client
+from autotest_client import asgi
+
+
+@pytest.fixture
+def fake_redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake_redis_conn(fake_redis_server):
+    return fakeredis.FakeStrictRedis(server=fake_redis_server)
+
+
+@pytest.fixture(autouse=True)
+def fake_redis_db(monkeypatch, fake_redis_server, fake_redis_conn):
+    monkeypatch.setattr(autotest_client, "REDIS_CONNECTION", fake_redis_conn)
+    monkeypatch.setattr(asgi, "REDIS_CONNECTION", fakeredis.FakeAsyncRedis(server=fake_redis_server))
+    monkeypatch.setattr(asgi, "EVENTS", asgi._EventBroker())
+    autotest_client.CREDENTIALS_CACHE.clear()
+
+
+@pytest.fixture
+def client():
+    return werkzeug.test.Client(a2wsgi.ASGIMiddleware(asgi.app), werkzeug.test.TestResponse)
+
+
+@pytest.fixture
+def api_key(fake_redis_conn):
+    key = "test-api-key"
+    fake_redis_conn.hset(
+        "autotest:user_credentials", key=key, value=json.dumps({"auth_type": "test", "credentials": ""})
+    )
+    return key
+
+
+@pytest.fixture
+def settings_id(fake_redis_conn, api_key):
+    fake_redis_conn.hset("autotest:settings", key=1, value=json.dumps({"testers": []}))
+    fake_redis_conn.hset("autotest:settings_meta:1", mapping={"user": api_key, "env_status": "ready", "version": 1})
+    return 1
+
+
+class TestAuthorization:
+    def test_unregistered(self, client, settings_id):
+        response = client.get(f"/settings/{settings_id}/tests/status", json={"test_ids": []}, headers={"Api-Key": "x"})
+        assert response.status_code == 401
+        assert response.json == {"message": "Unauthorized"}
+
+    def test_other_users_settings(self, client, fake_redis_conn, api_key):
+        fake_redis_conn.hset("autotest:settings_meta:2", mapping={"user": "other"})
+        response = client.get("/settings/2/tests/status", json={"test_ids": []}, headers={"Api-Key": api_key})
+        assert response.status_code == 401
+
+    def test_legacy_settings(self, client, fake_redis_conn, api_key):
+        fake_redis_conn.hset("autotest:settings", key=2, value=json.dumps({"_user": api_key, "testers": []}))
+        response = client.get("/settings/2/tests/status", json={"test_ids": []}, headers={"Api-Key": api_key})
+        assert response.status_code == 200
+
+    def test_settings_not_found(self, client, api_key):
+        response = client.get("/settings/3/tests/status", json={"test_ids": []}, headers={"Api-Key": api_key})
+        assert response.status_code == 404
+
+
+class TestDispatcher:
+    def test_async_route(self):
+        assert asgi.app._is_async_route({"path": "/settings/1/tests/status", "method": "GET"})
+
+    def test_wsgi_route(self):
+        assert not asgi.app._is_async_route({"path": "/settings/1/test", "method": "PUT"})
+
+
+class TestIterEvents:
+    def test_published_status(self, fake_redis_conn, settings_id):
+        fake_redis_conn.hset("autotest:tests", key=1, value=settings_id)
+        job = rq.Queue("low", connection=fake_redis_conn).enqueue_call("autotest_server.run_test", job_id="1")
+
+        async def stream():
+            events = asgi._iter_events(settings_id, [1])
+            received = [await events.__anext__()]
+            job.set_status("finished")
+            fake_redis_conn.publish(f"autotest:events:{settings_id}", json.dumps({"test_id": 1, "status": "finished"}))
+            received.extend([event async for event in events])
+            return received
+
+        assert asyncio.run(stream()) == [
+            autotest_client._format_event(1, "queued"),
+            autotest_client._format_event(1, "finished"),
+        ]
+        assert not asgi.EVENTS._queues
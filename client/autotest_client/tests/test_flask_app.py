@@ -1,19 +1,54 @@
 import autotest_client
+from autotest_client import asgi
+import a2wsgi
+import flask.testing
+import werkzeug.test
 import pytest
 import fakeredis
 import json
+import rq
+import gzip
+import io
+import zipfile
+import time
 
 
-@pytest.fixture
-def client():
+class _Buffered:
+    """Test client mixin that reads each (possibly streamed) response in full before returning it"""
+
+    def open(self, *args, **kwargs):
+        return super().open(*args, buffered=True, **kwargs)
+
+
+class _BufferedFlaskClient(_Buffered, flask.testing.FlaskClient):
+    pass
+
+
+class _BufferedClient(_Buffered, werkzeug.test.Client):
+    pass
+
+
+@pytest.fixture(params=["wsgi", "asgi"])
+def client(request, monkeypatch, fake_redis_server):
     autotest_client.app.config["TESTING"] = True
-    with autotest_client.app.test_client() as client:
-        yield client
+    if request.param == "wsgi":
+        monkeypatch.setattr(autotest_client.app, "test_client_class", _BufferedFlaskClient)
+        with autotest_client.app.test_client() as client:
+            yield client
+    else:
+        monkeypatch.setattr(asgi, "REDIS_CONNECTION", fakeredis.FakeAsyncRedis(server=fake_redis_server))
+        monkeypatch.setattr(asgi, "EVENTS", asgi._EventBroker())
+        yield _BufferedClient(a2wsgi.ASGIMiddleware(asgi.app), werkzeug.test.TestResponse)
+
+
+@pytest.fixture
+def fake_redis_server():
+    return fakeredis.FakeServer()
 
 
 @pytest.fixture
-def fake_redis_conn():
-    yield fakeredis.FakeStrictRedis()
+def fake_redis_conn(fake_redis_server):
+    yield fakeredis.FakeStrictRedis(server=fake_redis_server)
 
 
 @pytest.fixture(autouse=True)
@@ -21,6 +56,12 @@ def fake_redis_db(monkeypatch, fake_redis_conn):
     monkeypatch.setattr(autotest_client, "REDIS_CONNECTION", fake_redis_conn)
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    autotest_client.CREDENTIALS_CACHE.clear()
+    autotest_client.SCHEMA_CACHE.clear()
+
+
 class TestRegister:
     @pytest.fixture
     def credentials(self):
@@ -51,3 +92,609 @@ class TestStatus:
 
     def test_success(self, response):
         assert response.json["success"] is True
+
+
+@pytest.fixture
+def api_key(fake_redis_conn):
+    key = "test-api-key"
+    fake_redis_conn.hset(
+        "autotest:user_credentials", key=key, value=json.dumps({"auth_type": "test", "credentials": ""})
+    )
+    return key
+
+
+@pytest.fixture
+def settings_id(fake_redis_conn, api_key):
+    fake_redis_conn.hset("autotest:settings", key=1, value=json.dumps({"testers": []}))
+    fake_redis_conn.hset("autotest:settings_meta:1", mapping={"user": api_key, "env_status": "ready", "version": 1})
+    return 1
+
+
+def _enqueue_test(fake_redis_conn, test_id, settings_id):
+    fake_redis_conn.hset("autotest:tests", key=test_id, value=settings_id)
+    queue = rq.Queue("low", connection=fake_redis_conn)
+    return queue.enqueue_call("autotest_server.run_test", kwargs={}, job_id=str(test_id))
+
+
+class TestAuthorization:
+    def test_other_users_settings(self, client, fake_redis_conn, api_key):
+        fake_redis_conn.hset("autotest:settings_meta:2", mapping={"user": "other"})
+        response = client.get("/settings/2", headers={"Api-Key": api_key})
+        assert response.status_code == 401
+
+    def test_settings_not_found(self, client, api_key):
+        response = client.get("/settings/2", headers={"Api-Key": api_key})
+        assert response.status_code == 404
+
+    def test_legacy_settings(self, client, fake_redis_conn, api_key):
+        legacy = {"_user": api_key, "_env_status": "ready", "_last_access": 100, "testers": []}
+        fake_redis_conn.hset("autotest:settings", key=2, value=json.dumps(legacy))
+        response = client.get("/settings/2", headers={"Api-Key": api_key})
+        assert response.status_code == 200
+        assert fake_redis_conn.hget("autotest:settings_meta:2", "user") == api_key.encode()
+
+    def test_unregistered(self, client, settings_id):
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": "bad-key"})
+        assert response.status_code == 401
+
+    def test_missing_key(self, client, settings_id):
+        response = client.get(f"/settings/{settings_id}")
+        assert response.status_code == 401
+
+    def test_credentials_cached(self, client, fake_redis_conn, api_key, settings_id):
+        client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        fake_redis_conn.hdel("autotest:user_credentials", api_key)
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        assert response.status_code == 200
+
+    def test_cache_invalidated_on_reset(self, client, api_key):
+        client.put(
+            "/reset_credentials", json={"auth_type": "test", "credentials": "6789"}, headers={"Api-Key": api_key}
+        )
+        assert autotest_client.CREDENTIALS_CACHE.get(api_key) is None
+
+
+class TestSchema:
+    @pytest.fixture(autouse=True)
+    def schema(self, fake_redis_conn):
+        fake_redis_conn.set("autotest:schema", json.dumps({"type": "object"}))
+        fake_redis_conn.set("autotest:schema_version", "1")
+
+    def test_schema(self, client, api_key):
+        assert client.get("/schema", headers={"Api-Key": api_key}).json == {"type": "object"}
+
+    def test_schema_cached(self, client, fake_redis_conn, api_key):
+        client.get("/schema", headers={"Api-Key": api_key})
+        fake_redis_conn.set("autotest:schema", json.dumps({"type": "array"}))
+        assert client.get("/schema", headers={"Api-Key": api_key}).json == {"type": "object"}
+
+    def test_etag(self, client, api_key):
+        assert client.get("/schema", headers={"Api-Key": api_key}).headers["ETag"] == '"1"'
+
+    def test_not_modified(self, client, api_key):
+        response = client.get("/schema", headers={"Api-Key": api_key, "If-None-Match": '"1"'})
+        assert response.status_code == 304
+        assert response.get_data() == b""
+
+    def test_schema_version_changed(self, client, fake_redis_conn, api_key):
+        client.get("/schema", headers={"Api-Key": api_key})
+        fake_redis_conn.set("autotest:schema", json.dumps({"type": "array"}))
+        fake_redis_conn.set("autotest:schema_version", "2")
+        assert client.get("/schema", headers={"Api-Key": api_key}).json == {"type": "array"}
+
+
+class TestSettings:
+    @pytest.fixture
+    def schema(self, fake_redis_conn):
+        definitions = {"files_list": {"type": "string"}, "test_data_categories": {"type": "string"}}
+        fake_redis_conn.set("autotest:schema", json.dumps({"type": "object", "definitions": definitions}))
+
+    @pytest.fixture
+    def settings_(self):
+        return {"testers": [{"test_data": [{"timeout": 10}, {"timeout": 20}]}]}
+
+    def test_get(self, client, fake_redis_conn, api_key, settings_id, settings_):
+        fake_redis_conn.hset("autotest:settings", key=settings_id, value=json.dumps(settings_))
+        assert client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key}).json == settings_
+
+    def test_not_modified(self, client, fake_redis_conn, api_key, settings_id, schema, settings_):
+        client.put(f"/settings/{settings_id}", json={"settings": settings_}, headers={"Api-Key": api_key})
+        etag = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key}).headers["ETag"]
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key, "If-None-Match": etag})
+        assert response.status_code == 304
+
+    def test_modified(self, client, fake_redis_conn, api_key, settings_id, schema, settings_):
+        client.put(f"/settings/{settings_id}", json={"settings": settings_}, headers={"Api-Key": api_key})
+        etag = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key}).headers["ETag"]
+        client.put(f"/settings/{settings_id}", json={"settings": {"testers": []}}, headers={"Api-Key": api_key})
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json == {"testers": []}
+
+    def test_get_error(self, client, fake_redis_conn, api_key, settings_id):
+        fake_redis_conn.hset(f"autotest:settings_meta:{settings_id}", "error", "failed")
+        response = client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+        assert response.status_code == 500
+        assert response.json["message"] == "Settings Error: failed"
+
+    def test_update(self, client, fake_redis_conn, api_key, settings_id, schema, settings_):
+        fake_redis_conn.hset(f"autotest:settings_meta:{settings_id}", "error", "failed")
+        client.put(f"/settings/{settings_id}", json={"settings": settings_}, headers={"Api-Key": api_key})
+        assert json.loads(fake_redis_conn.hget("autotest:settings", settings_id)) == settings_
+        meta = fake_redis_conn.hgetall(f"autotest:settings_meta:{settings_id}")
+        assert (meta[b"env_status"], meta[b"timeout"], meta[b"version"]) == (b"setup", b"30", b"2")
+        assert b"error" not in meta
+
+    def test_create(self, client, fake_redis_conn, api_key, schema, settings_):
+        response = client.post("/settings", json={"settings": settings_}, headers={"Api-Key": api_key})
+        settings_id = response.json["settings_id"]
+        assert fake_redis_conn.hget(f"autotest:settings_meta:{settings_id}", "user") == api_key.encode()
+
+
+class TestRateLimit:
+    @pytest.fixture(autouse=True)
+    def rate_limit(self, monkeypatch):
+        monkeypatch.setattr(autotest_client, "RATE_LIMIT", 1)
+        monkeypatch.setattr(autotest_client, "RATE_LIMIT_BURST", 2)
+
+    def _request(self, client, api_key, settings_id):
+        return client.get(f"/settings/{settings_id}", headers={"Api-Key": api_key})
+
+    def test_burst_allowed(self, client, api_key, settings_id):
+        assert [self._request(client, api_key, settings_id).status_code for _ in range(2)] == [200, 200]
+
+    def test_limit_exceeded(self, client, api_key, settings_id):
+        for _ in range(2):
+            self._request(client, api_key, settings_id)
+        assert self._request(client, api_key, settings_id).status_code == 429
+
+    def test_user_limit(self, client, fake_redis_conn, api_key, settings_id):
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:limit", 5)
+        assert all(self._request(client, api_key, settings_id).status_code == 200 for _ in range(5))
+
+
+class TestRunTests:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        fake_redis_conn.hset(
+            "autotest:settings", key=1, value=json.dumps({"testers": [{"test_data": [{"timeout": 10}]}]})
+        )
+        fake_redis_conn.hset(
+            "autotest:settings_meta:1", mapping={"user": api_key, "env_status": "ready", "timeout": 10}
+        )
+        return 1
+
+    @pytest.fixture
+    def test_data(self):
+        return [{"file_url": "http://example.com/a"}, {"file_url": "http://example.com/b", "env_vars": {"A": "1"}}]
+
+    @pytest.fixture
+    def response(self, client, fake_redis_conn, api_key, settings_id, test_data):
+        fake_redis_conn.set("autotest:tests_id", 5)
+        return client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+
+    def test_status_code(self, response):
+        assert response.status_code == 200
+
+    def test_ids_allocated(self, response, fake_redis_conn):
+        assert response.json["test_ids"] == [6, 7]
+        assert int(fake_redis_conn.get("autotest:tests_id")) == 7
+
+    def test_tests_mapped_to_settings(self, response, fake_redis_conn, settings_id):
+        assert fake_redis_conn.hgetall("autotest:tests") == {b"6": b"1", b"7": b"1"}
+
+    def test_jobs_enqueued(self, response, fake_redis_conn, api_key):
+        queue_name = autotest_client._batch_queue_name(api_key)
+        assert rq.Queue(queue_name, connection=fake_redis_conn).job_ids == ["6", "7"]
+
+    def test_batch_queue_registered(self, response, fake_redis_conn, api_key):
+        assert fake_redis_conn.smembers("autotest:batch_queues") == {
+            autotest_client._batch_queue_name(api_key).encode()
+        }
+
+    def test_batch_queue_per_user(self, api_key):
+        assert autotest_client._batch_queue_name(api_key) != autotest_client._batch_queue_name("other")
+        assert api_key not in autotest_client._batch_queue_name(api_key)
+
+    def test_job_kwargs(self, response, fake_redis_conn, api_key, test_data):
+        job = rq.job.Job.fetch("7", connection=fake_redis_conn)
+        assert job.kwargs == {
+            "settings_id": "1",
+            "test_id": 7,
+            "files_url": test_data[1]["file_url"],
+            "categories": ["instructor"],
+            "user": api_key,
+            "test_env_vars": {"A": "1"},
+        }
+        assert job.timeout == 15
+
+    def test_callback_url(self, client, fake_redis_conn, api_key, settings_id, test_data):
+        client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": [], "callback_url": "https://example.com/results"},
+            headers={"Api-Key": api_key},
+        )
+        assert rq.job.Job.fetch("1", connection=fake_redis_conn).kwargs["callback_url"] == "https://example.com/results"
+
+    def test_invalid_callback_url(self, client, api_key, settings_id, test_data):
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": test_data, "categories": [], "callback_url": "file:///etc/passwd"},
+            headers={"Api-Key": api_key},
+        )
+        assert response.status_code == 422
+
+
+class TestRunTestsByCategory:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        groups = [[["instructor"], 10], [["student", "instructor"], 100]]
+        fake_redis_conn.hset(
+            "autotest:settings_meta:1",
+            mapping={"user": api_key, "env_status": "ready", "timeout": 110, "groups": json.dumps(groups)},
+        )
+        return 1
+
+    def _run(self, client, settings_id, api_key, categories):
+        response = client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": [{"file_url": "http://example.com/a"}], "categories": categories},
+            headers={"Api-Key": api_key},
+        )
+        return response.json["test_ids"][0]
+
+    def test_timeout_from_requested_categories(self, client, fake_redis_conn, settings_id, api_key):
+        test_id = self._run(client, settings_id, api_key, ["student"])
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 150
+
+    def test_timeout_not_shortened_by_recorded_runtimes(self, client, fake_redis_conn, settings_id, api_key):
+        fake_redis_conn.hset("autotest:runtimes:1", mapping={"1:total": 20, "1:count": 5})
+        test_id = self._run(client, settings_id, api_key, ["student"])
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 150
+
+    def test_fifo_by_default(self, client, fake_redis_conn, settings_id, api_key):
+        ids = [self._run(client, settings_id, api_key, categories) for categories in (["instructor"], ["student"])]
+        assert rq.Queue("low", connection=fake_redis_conn).job_ids == [str(id_) for id_ in ids]
+
+    def test_shortest_job_first(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setattr(autotest_client, "SJF_WEIGHT", 1)
+        slow, fast = [self._run(client, settings_id, api_key, c) for c in (["instructor"], ["student"])]
+        assert rq.Queue("low", connection=fake_redis_conn).job_ids == [str(fast), str(slow)]
+
+    def test_recorded_runtimes_used(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setattr(autotest_client, "SJF_WEIGHT", 1)
+        fake_redis_conn.hset("autotest:runtimes:1", mapping={"0:total": 300, "0:count": 2, "1:total": 1, "1:count": 1})
+        student, instructor = [self._run(client, settings_id, api_key, c) for c in (["student"], ["instructor"])]
+        assert rq.Queue("low", connection=fake_redis_conn).job_ids == [str(student), str(instructor)]
+
+    def test_aging(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        # a slow job enqueued long enough ago has a lower score than a new fast job
+        monkeypatch.setattr(autotest_client, "SJF_WEIGHT", 1)
+        fake_redis_conn.rpush("rq:queue:low", "old")
+        fake_redis_conn.zadd("autotest:sjf:low", {"old": time.time() + 5})
+        fast = self._run(client, settings_id, api_key, ["instructor"])
+        assert rq.Queue("low", connection=fake_redis_conn).job_ids == ["old", str(fast)]
+
+
+class TestAdmission:
+    @pytest.fixture
+    def settings_id(self, fake_redis_conn, api_key):
+        fake_redis_conn.hset(
+            "autotest:settings_meta:1", mapping={"user": api_key, "env_status": "ready", "timeout": 10}
+        )
+        return 1
+
+    def _run(self, client, settings_id, api_key, n_tests):
+        return client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": [{"file_url": "http://example.com/a"}] * n_tests, "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+
+    def _drained(self, fake_redis_conn, queue_name, n_jobs):
+        fake_redis_conn.set(f"autotest:drained:{queue_name}:{int(time.time() // 60)}", n_jobs)
+
+    def test_accepted_below_limit(self, monkeypatch, client, settings_id, api_key):
+        monkeypatch.setitem(autotest_client.QUEUE_LIMITS, "low", 2)
+        assert self._run(client, settings_id, api_key, 1).status_code == 200
+        assert self._run(client, settings_id, api_key, 1).status_code == 200
+
+    def test_queue_limit(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setitem(autotest_client.QUEUE_LIMITS, "low", 1)
+        self._drained(fake_redis_conn, "low", 60)
+        self._run(client, settings_id, api_key, 1)
+        response = self._run(client, settings_id, api_key, 1)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+        assert rq.Queue("low", connection=fake_redis_conn).count == 1
+
+    def test_batch_queue_limit_counts_all_users(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setitem(autotest_client.QUEUE_LIMITS, "batch", 3)
+        rq.Queue("batch:other", connection=fake_redis_conn).enqueue_call("autotest_server.run_test", job_id="1")
+        fake_redis_conn.sadd("autotest:batch_queues", "batch:other")
+        assert self._run(client, settings_id, api_key, 3).status_code == 503
+        assert self._run(client, settings_id, api_key, 2).status_code == 200
+
+    def test_user_limit(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setattr(autotest_client, "USER_JOB_LIMIT", 3)
+        self._drained(fake_redis_conn, "batch", 30)
+        assert self._run(client, settings_id, api_key, 2).status_code == 200
+        response = self._run(client, settings_id, api_key, 2)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "10"
+
+    def test_no_drain_rate(self, monkeypatch, client, fake_redis_conn, settings_id, api_key):
+        monkeypatch.setattr(autotest_client, "USER_JOB_LIMIT", 1)
+        response = self._run(client, settings_id, api_key, 2)
+        assert response.headers["Retry-After"] == str(autotest_client.RETRY_AFTER_MAX)
+
+
+class TestGetStatuses:
+    @pytest.fixture
+    def response(self, client, fake_redis_conn, api_key, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        _enqueue_test(fake_redis_conn, 2, settings_id).set_status("started")
+        _enqueue_test(fake_redis_conn, 3, settings_id + 1)
+        return client.get(
+            f"/settings/{settings_id}/tests/status", json={"test_ids": [1, 2, 3, 4]}, headers={"Api-Key": api_key}
+        )
+
+    def test_status_code(self, response):
+        assert response.status_code == 200
+
+    def test_statuses(self, response):
+        assert response.json == {"1": "queued", "2": "started", "3": None, "4": None}
+
+
+class TestCancelTests:
+    @pytest.fixture
+    def response(self, client, fake_redis_conn, api_key, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        _enqueue_test(fake_redis_conn, 2, settings_id).set_status("started")
+        _enqueue_test(fake_redis_conn, 3, settings_id + 1)
+        return client.delete(
+            f"/settings/{settings_id}/tests/cancel", json={"test_ids": [1, 2, 3, 4]}, headers={"Api-Key": api_key}
+        )
+
+    def test_success(self, response):
+        assert response.json == {"success": True}
+
+    def test_queued_job_cancelled(self, response, fake_redis_conn):
+        assert rq.job.Job.fetch("1", connection=fake_redis_conn).get_status() == "canceled"
+        assert "1" not in rq.Queue("low", connection=fake_redis_conn).job_ids
+        assert "1" in rq.registry.CanceledJobRegistry("low", connection=fake_redis_conn)
+
+    def test_running_job_flagged(self, response, fake_redis_conn):
+        assert fake_redis_conn.exists("autotest:cancel:2")
+        assert not fake_redis_conn.exists("autotest:cancel:1", "autotest:cancel:3")
+
+    def test_other_settings_not_cancelled(self, response, fake_redis_conn):
+        assert rq.job.Job.fetch("3", connection=fake_redis_conn).get_status() == "queued"
+
+
+class TestGetResult:
+    @pytest.mark.parametrize("compress", [False, True])
+    def test_result(self, client, fake_redis_conn, api_key, settings_id, compress):
+        _enqueue_test(fake_redis_conn, 1, settings_id).set_status("finished")
+        result = json.dumps({"test_groups": [{"stderr": "error"}], "error": None}).encode()
+        fake_redis_conn.set("autotest:test_result:1", gzip.compress(result) if compress else result)
+        response = client.get(f"/settings/{settings_id}/test/1", headers={"Api-Key": api_key})
+        assert response.json == {"status": "finished", "test_groups": [{"stderr": "error"}], "error": None}
+        assert not fake_redis_conn.exists("autotest:test_result:1")
+
+
+class TestGetResults:
+    @pytest.fixture
+    def response(self, client, fake_redis_conn, api_key, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id).set_status("finished")
+        fake_redis_conn.set("autotest:test_result:1", json.dumps({"test_groups": [], "error": None}))
+        _enqueue_test(fake_redis_conn, 2, settings_id)
+        _enqueue_test(fake_redis_conn, 3, settings_id + 1)
+        return client.get(
+            f"/settings/{settings_id}/tests/results", json={"test_ids": [1, 2, 3]}, headers={"Api-Key": api_key}
+        )
+
+    def test_status_code(self, response):
+        assert response.status_code == 200
+
+    def test_content_type(self, response):
+        assert response.mimetype == "application/x-ndjson"
+
+    def test_results(self, response):
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == [
+            {"test_id": 1, "status": "finished", "test_groups": [], "error": None},
+            {"test_id": 2, "status": "queued"},
+            {"test_id": 3, "status": None},
+        ]
+
+    def test_results_deleted(self, response, fake_redis_conn):
+        response.get_data()
+        assert not fake_redis_conn.exists("autotest:test_result:1", rq.job.Job.key_for("1"), rq.job.Job.key_for("2"))
+
+    def test_other_settings_not_deleted(self, response, fake_redis_conn):
+        response.get_data()
+        assert fake_redis_conn.exists(rq.job.Job.key_for("3"))
+
+
+class TestGetEvents:
+    @pytest.fixture(autouse=True)
+    def poll_interval(self, monkeypatch):
+        monkeypatch.setattr(autotest_client, "EVENTS_POLL_INTERVAL", 0.01)
+
+    @staticmethod
+    def _parse(events):
+        return [json.loads(line.removeprefix("data: ")) for line in events.splitlines() if line.startswith("data: ")]
+
+    def test_done_tests_end_stream(self, client, fake_redis_conn, api_key, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id).set_status("finished")
+        response = client.get(f"/settings/{settings_id}/tests/events?test_ids=1,2", headers={"Api-Key": api_key})
+        assert response.mimetype == "text/event-stream"
+        assert self._parse(response.get_data(as_text=True)) == [
+            {"test_id": 1, "status": "finished"},
+            {"test_id": 2, "status": None},
+        ]
+
+    def test_status_change_published(self, fake_redis_conn, settings_id):
+        job = _enqueue_test(fake_redis_conn, 1, settings_id)
+        events = autotest_client._iter_events(settings_id, [1])
+        assert self._parse(next(events)) == [{"test_id": 1, "status": "queued"}]
+        job.set_status("finished")
+        fake_redis_conn.publish(f"autotest:events:{settings_id}", json.dumps({"test_id": 1, "status": "finished"}))
+        assert self._parse(next(events)) == [{"test_id": 1, "status": "finished"}]
+        with pytest.raises(StopIteration):
+            next(events)
+
+    def test_keepalive(self, monkeypatch, settings_id):
+        monkeypatch.setattr(autotest_client, "EVENTS_KEEPALIVE_INTERVAL", 0)
+        events = autotest_client._iter_events(settings_id)
+        assert next(events) == ": keepalive\n\n"
+        events.close()
+
+    def test_all_tests_of_settings(self, monkeypatch, fake_redis_conn, settings_id):
+        monkeypatch.setattr(autotest_client, "EVENTS_KEEPALIVE_INTERVAL", 0)
+        events = autotest_client._iter_events(settings_id)
+        next(events)
+        _enqueue_test(fake_redis_conn, 3, settings_id).set_status("started")
+        fake_redis_conn.publish(f"autotest:events:{settings_id}", json.dumps({"test_id": 3, "status": "started"}))
+        assert self._parse(next(events)) == [{"test_id": 3, "status": "started"}]
+        events.close()
+
+
+class TestGetFeedbackFile:
+    content = b"feedback content " * 100
+
+    @pytest.fixture(autouse=True)
+    def feedback(self, fake_redis_conn, monkeypatch, settings_id):
+        monkeypatch.setattr(autotest_client, "FEEDBACK_CHUNK_SIZE", 64)
+        fake_redis_conn.hset("autotest:tests", key=1, value=settings_id)
+        fake_redis_conn.set("autotest:feedback_file:1:2", gzip.compress(self.content))
+        fake_redis_conn.hset(
+            "autotest:feedback_files:1", 2, json.dumps({"filename": "feedback.txt", "mime_type": "text/plain"})
+        )
+
+    def _get(self, client, settings_id, api_key, query="", **headers):
+        return client.get(f"/settings/{settings_id}/test/1/feedback/2{query}", headers={"Api-Key": api_key, **headers})
+
+    def test_compressed(self, client, settings_id, api_key):
+        response = self._get(client, settings_id, api_key)
+        assert response.mimetype == "application/gzip"
+        assert gzip.decompress(response.get_data()) == self.content
+
+    def test_deleted_after_download(self, client, fake_redis_conn, settings_id, api_key):
+        self._get(client, settings_id, api_key).get_data()
+        assert not fake_redis_conn.exists("autotest:feedback_file:1:2")
+
+    def test_range(self, client, fake_redis_conn, settings_id, api_key):
+        response = self._get(client, settings_id, api_key, Range="bytes=10-99")
+        assert response.status_code == 206
+        assert response.get_data() == fake_redis_conn.getrange("autotest:feedback_file:1:2", 10, 99)
+        assert fake_redis_conn.exists("autotest:feedback_file:1:2")
+
+    def test_unsatisfiable_range(self, client, settings_id, api_key):
+        response = self._get(client, settings_id, api_key, Range="bytes=100000-")
+        assert response.status_code == 416
+
+    def test_multiple_ranges(self, client, fake_redis_conn, settings_id, api_key):
+        response = self._get(client, settings_id, api_key, Range="bytes=0-9,20-29")
+        assert response.status_code == 200
+        assert "Content-Range" not in response.headers
+        assert gzip.decompress(response.get_data()) == self.content
+
+    def test_gzip_passthrough(self, client, settings_id, api_key):
+        response = self._get(client, settings_id, api_key, "?decompress=true", **{"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.mimetype == "text/plain"
+        assert gzip.decompress(response.get_data()) == self.content
+
+    def test_decompressed(self, client, settings_id, api_key):
+        response = self._get(client, settings_id, api_key, "?decompress=true")
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert response.get_data() == self.content
+
+    def test_missing(self, client, settings_id, api_key):
+        response = client.get(f"/settings/{settings_id}/test/1/feedback/3", headers={"Api-Key": api_key})
+        assert response.status_code == 404
+
+
+class TestGetFeedbackFiles:
+    @pytest.fixture
+    def response(self, client, fake_redis_conn, settings_id, api_key):
+        fake_redis_conn.hset("autotest:tests", key=1, value=settings_id)
+        for id_, content in ((2, b"first"), (3, b"second")):
+            fake_redis_conn.set(f"autotest:feedback_file:1:{id_}", gzip.compress(content))
+            fake_redis_conn.hset(
+                "autotest:feedback_files:1", id_, json.dumps({"filename": "out.txt", "mime_type": "text/plain"})
+            )
+        return client.get(f"/settings/{settings_id}/test/1/feedback", headers={"Api-Key": api_key})
+
+    def test_zip_content(self, response):
+        with zipfile.ZipFile(io.BytesIO(response.get_data())) as zf:
+            assert {name: zf.read(name) for name in zf.namelist()} == {"2/out.txt": b"first", "3/out.txt": b"second"}
+
+    def test_deleted_after_download(self, response, fake_redis_conn):
+        response.get_data()
+        assert not fake_redis_conn.exists(
+            "autotest:feedback_file:1:2", "autotest:feedback_file:1:3", "autotest:feedback_files:1"
+        )
+
+    def test_missing(self, client, settings_id, api_key):
+        response = client.get(f"/settings/{settings_id}/test/4/feedback", headers={"Api-Key": api_key})
+        assert response.status_code == 404
+
+
+class TestMetrics:
+    @pytest.fixture
+    def metrics(self, client):
+        def _metrics():
+            response = client.get("/metrics")
+            assert response.status_code == 200
+            return response.get_data(as_text=True).splitlines()
+
+        return _metrics
+
+    def test_queue_lengths(self, metrics, fake_redis_conn, settings_id):
+        _enqueue_test(fake_redis_conn, 1, settings_id)
+        lines = metrics()
+        assert 'autotest_queue_length{queue="low"} 1' in lines
+        assert 'autotest_queue_length{queue="batch"} 0' in lines
+
+    def test_batch_queues_combined(self, metrics, fake_redis_conn):
+        for name, n_jobs in (("batch", 1), ("batch:a", 2), ("batch:b", 3)):
+            queue = rq.Queue(name, connection=fake_redis_conn)
+            for i in range(n_jobs):
+                queue.enqueue_call("autotest_server.run_test", job_id=f"{name.replace(':', '-')}-{i}")
+        fake_redis_conn.sadd("autotest:batch_queues", "batch:a", "batch:b")
+        assert 'autotest_queue_length{queue="batch"} 6' in metrics()
+
+    def test_stored_counters(self, metrics, fake_redis_conn):
+        fake_redis_conn.hset("autotest:metrics", mapping={"results_stored": 2, "result_bytes": 100})
+        lines = metrics()
+        assert "autotest_results_stored_total 2" in lines
+        assert "autotest_result_bytes_total 100" in lines
+        assert "autotest_feedback_bytes_total 0" in lines
+
+    def test_request_duration(self, metrics):
+        metrics()
+        assert any(
+            line.startswith('autotest_request_duration_seconds_count{method="GET",route="/metrics",status="200"}')
+            for line in metrics()
+        )
+
+    def test_jobs_enqueued(self, metrics, client, fake_redis_conn, settings_id, api_key):
+        def _enqueued():
+            prefix = 'autotest_jobs_enqueued_total{queue="low"} '
+            return next((float(line.rpartition(" ")[2]) for line in metrics() if line.startswith(prefix)), 0)
+
+        fake_redis_conn.hset(f"autotest:settings_meta:{settings_id}", "timeout", 10)
+        before = _enqueued()
+        client.put(
+            f"/settings/{settings_id}/test",
+            json={"test_data": [{"file_url": "http://example.com/a"}], "categories": ["instructor"]},
+            headers={"Api-Key": api_key},
+        )
+        assert _enqueued() == before + 1
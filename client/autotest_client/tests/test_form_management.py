@@ -0,0 +1,57 @@
+from autotest_client import form_management
+
+SCHEMA = {
+    "definitions": {
+        "files_list": {"type": "string", "enum": []},
+        "test_data_categories": {"type": "string", "enum": ["a"], "enumNames": ["A"]},
+        "tester_schemas": {
+            "oneOf": [
+                {
+                    "properties": {
+                        "tester_type": {"enum": ["x"]},
+                        "test_data": {"type": "array"},
+                        "timeout": {"type": "integer", "default": 30},
+                    }
+                },
+                {"properties": {"tester_type": {"enum": ["y"]}, "files": {"$ref": "#/definitions/files_list"}}},
+            ]
+        },
+    },
+    "type": "object",
+    "required": ["testers"],
+    "properties": {
+        "testers": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["tester_type", "test_data"],
+                "properties": {"tester_type": {"type": "string"}},
+                "dependencies": {"tester_type": {"$ref": "#/definitions/tester_schemas"}},
+            },
+        }
+    },
+}
+
+
+class TestValidateAgainstSchema:
+    def test_defaults_filled(self):
+        specs = {"testers": [{"tester_type": "x"}]}
+        assert form_management.validate_against_schema(specs, SCHEMA, []) is None
+        assert specs == {"testers": [{"tester_type": "x", "test_data": [], "timeout": 30}]}
+
+    def test_only_matching_subschema_defaults(self):
+        specs = {"testers": [{"tester_type": "y", "test_data": [], "files": "f"}]}
+        assert form_management.validate_against_schema(specs, SCHEMA, ["f"]) is None
+        assert "timeout" not in specs["testers"][0]
+
+    def test_invalid_file(self):
+        specs = {"testers": [{"tester_type": "y", "test_data": [], "files": "g"}]}
+        assert form_management.validate_against_schema(specs, SCHEMA, ["f"]) is not None
+
+    def test_missing_required(self):
+        assert form_management.validate_against_schema({}, SCHEMA, []) is not None
+
+    def test_schema_not_modified(self):
+        form_management.validate_against_schema({"testers": []}, SCHEMA, ["f"])
+        assert SCHEMA["definitions"]["files_list"]["enum"] == []
+        assert SCHEMA["definitions"]["test_data_categories"]["enum"] == ["a"]
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+
+import pytest
+
+from autotest_client import log
+
+
+def _record(msg="AUTHORIZED", **extra):
+    record = logging.makeLogRecord({"msg": msg, "levelno": logging.INFO, "levelname": "INFO"})
+    record.__dict__.update(extra)
+    return record
+
+
+class TestJsonFormatter:
+    def test_fields(self):
+        data = json.loads(log.JsonFormatter().format(_record(url="http://localhost/schema", user="key")))
+        assert data.pop("timestamp")
+        assert data == {"message": "AUTHORIZED", "url": "http://localhost/schema", "user": "key"}
+
+
+class TestBufferedRotatingFileHandler:
+    @pytest.fixture
+    def filename(self, tmp_path):
+        return str(tmp_path / "access.log")
+
+    def _handler(self, filename, **kwargs):
+        handler = log.BufferedRotatingFileHandler(filename, **kwargs)
+        handler.setFormatter(log.JsonFormatter())
+        return handler
+
+    def _lines(self, filename):
+        with open(filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_buffered(self, filename):
+        handler = self._handler(filename, flush_size=10000, flush_interval=60)
+        handler.emit(_record())
+        assert self._lines(filename) == []
+        handler.close()
+        assert len(self._lines(filename)) == 1
+
+    def test_flush_size(self, filename):
+        handler = self._handler(filename, flush_size=1, flush_interval=60)
+        handler.emit(_record())
+        assert len(self._lines(filename)) == 1
+        handler.close()
+
+    def test_flush_interval(self, filename):
+        handler = self._handler(filename, flush_size=10000, flush_interval=0)
+        handler.emit(_record())
+        assert len(self._lines(filename)) == 1
+        handler.close()
+
+    def test_rotation(self, filename):
+        handler = self._handler(filename, max_bytes=100, backup_count=2)
+        for _ in range(5):
+            handler.emit(_record(url="http://localhost/schema"))
+        handler.close()
+        assert os.path.exists(f"{filename}.1")
+        assert os.path.exists(f"{filename}.2")
+        assert not os.path.exists(f"{filename}.3")
+
+
+class TestQueueLogger:
+    def test_written_in_background(self, tmp_path):
+        filename = str(tmp_path / "error.log")
+        logger = log.queue_logger("autotest_client.test", filename, None, flush_size=1, flush_interval=60)
+        logger.error("failed", extra={"user": "key", "traceback": "Traceback"})
+        logger.handlers[0].queue.join()
+        with open(filename) as f:
+            data = json.loads(f.read())
+        assert (data["message"], data["user"], data["traceback"]) == ("failed", "key", "Traceback")
@@ -0,0 +1,75 @@
+import fakeredis
+
+from autotest_client import metrics
+
+
+def _samples(metric):
+    return {(name, labels): value for name, labels, value in metric.samples()}
+
+
+class TestCounter:
+    def test_labels(self):
+        counter = metrics.Counter("jobs_total", "Jobs")
+        counter.inc(queue="low")
+        counter.inc(2, queue="low")
+        counter.inc(queue="high")
+        assert _samples(counter) == {
+            ("jobs_total", (("queue", "low"),)): 3,
+            ("jobs_total", (("queue", "high"),)): 1,
+        }
+
+    def test_render(self):
+        counter = metrics.Counter("jobs_total", "Jobs")
+        counter.inc(queue='a"b')
+        assert counter.render() == '# HELP jobs_total Jobs\n# TYPE jobs_total counter\njobs_total{queue="a\\"b"} 1\n'
+
+
+class TestGauge:
+    def test_set(self):
+        gauge = metrics.Gauge("length", "Length")
+        gauge.set(3)
+        gauge.set(1)
+        assert _samples(gauge) == {("length", ()): 1}
+
+
+class TestHistogram:
+    def test_buckets(self):
+        histogram = metrics.Histogram("duration", "Duration", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, route="/")
+        labels = (("route", "/"),)
+        assert _samples(histogram) == {
+            ("duration_bucket", (*labels, ("le", "0.1"))): 2,
+            ("duration_bucket", (*labels, ("le", "1"))): 3,
+            ("duration_bucket", (*labels, ("le", "+Inf"))): 4,
+            ("duration_sum", labels): 2.65,
+            ("duration_count", labels): 4,
+        }
+
+
+class TestTimedConnection:
+    def _count(self, histogram):
+        return _samples(histogram).get(("roundtrip_count", ()), 0)
+
+    def test_command(self):
+        histogram = metrics.Histogram("roundtrip", "Round trip")
+        conn = fakeredis.FakeStrictRedis()
+        pool = conn.connection_pool
+        pool.connection_class = metrics.timed_connection_class(pool.connection_class, histogram)
+        conn.ping()
+        before = self._count(histogram)
+        conn.set("a", 1)
+        assert self._count(histogram) == before + 1
+
+    def test_pipeline_observed_once(self):
+        histogram = metrics.Histogram("roundtrip", "Round trip")
+        conn = fakeredis.FakeStrictRedis()
+        pool = conn.connection_pool
+        pool.connection_class = metrics.timed_connection_class(pool.connection_class, histogram)
+        conn.ping()
+        before = self._count(histogram)
+        with conn.pipeline() as pipe:
+            pipe.set("a", 1)
+            pipe.get("a")
+            pipe.execute()
+        assert self._count(histogram) == before + 1
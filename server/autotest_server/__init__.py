@@ -8,7 +8,7 @@ import subprocess
 import signal
 import socket
 import getpass
-import requests
+import tempfile
 import gzip
 import redis
 import importlib
@@ -16,20 +16,29 @@ import psycopg2
 import mimetypes
 import rq
 import traceback
-from typing import Optional, Dict, Union, List, Tuple, Callable, Type
+from typing import Optional, Dict, Union, List, Tuple, Callable, Type, IO
 from types import TracebackType
 
 from .config import config
+from .callbacks import queue_callback
+from . import result_cache, settings_store
+from .agent import AgentClient, AgentError, AgentProcess, agent_client
+from .download import downloader
 from .utils import (
     loads_partial_json,
     get_resource_settings,
     extract_zip_stream,
-    recursive_iglob,
+    archive_limits,
     copy_tree,
+    link_tree,
 )
 
 DEFAULT_ENV_DIR = "defaultvenv"
 TEST_SCRIPT_DIR = os.path.join(config["workspace"], "scripts")
+RESULT_COMPRESSION_THRESHOLD = config.get("result_compression_threshold", 1024)
+METRICS_KEY = "autotest:metrics"
+CANCEL_POLL_INTERVAL = 1
+CANCELLED_MESSAGE = "Tests were cancelled\n"
 
 ResultData = Dict[str, Union[str, int, type(None), Dict]]
 
@@ -38,6 +47,38 @@ def redis_connection() -> redis.Redis:
     return rq.get_current_job().connection
 
 
+def _publish_status(settings_id: Union[int, str], test_id: Union[int, str], status: str) -> None:
+    """
+    Notify clients subscribed to events for settings_id that the status of the test with id test_id has changed.
+    """
+    message = json.dumps({"test_id": test_id, "status": status})
+    redis_connection().publish(f"autotest:events:{settings_id}", message)
+
+
+def _encode_result(result: Dict) -> bytes:
+    """Return result encoded as compact json"""
+    return json.dumps(result, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _store_result(test_id: Union[int, str], result: Dict) -> None:
+    """
+    Store the result of the test run with id test_id so that clients can retrieve it.
+
+    Encoded results larger than RESULT_COMPRESSION_THRESHOLD bytes are gzip compressed (readers recognize compressed
+    results by the gzip magic number). The number of bytes stored, and how many bytes that was before compression,
+    are added to the counters in the metrics hash.
+    """
+    encoded = _encode_result(result)
+    data = gzip.compress(encoded, mtime=0) if len(encoded) > RESULT_COMPRESSION_THRESHOLD else encoded
+    conn = redis_connection()
+    conn.set(f"autotest:test_result:{test_id}", data, ex=3600)  # TODO: make this configurable
+    with conn.pipeline(transaction=False) as pipe:
+        pipe.hincrby(METRICS_KEY, "results_stored", 1)
+        pipe.hincrby(METRICS_KEY, "result_bytes", len(data))
+        pipe.hincrby(METRICS_KEY, "result_uncompressed_bytes", len(encoded))
+        pipe.execute()
+
+
 def run_test_command(test_username: Optional[str] = None) -> str:
     """
     Return a command used to run test scripts as a the test_username
@@ -91,14 +132,73 @@ def _create_test_group_result(
     return result
 
 
+def _agent(test_username: str) -> Optional[AgentClient]:
+    """
+    Return the client of the runner agent of test_username or None if the worker should run commands as test_username
+    with sudo instead. Agents are not used when the tests are run as the worker user itself.
+    """
+    if not config.get("runner_agent") or test_username == getpass.getuser():
+        return None
+    return agent_client(test_username, os.path.join(config["workspace"], "agents", test_username))
+
+
 def _kill_user_processes(test_username: str) -> None:
     """
     Kill all processes that test_username is able to kill
     """
+    agent = _agent(test_username)
+    if agent is not None:
+        agent.kill()
+        return
     kill_cmd = f"sudo -u {test_username} -- bash -c 'kill -KILL -1'"
     subprocess.run(kill_cmd, shell=True)
 
 
+def _kill_tester(proc: subprocess.Popen, test_username: str) -> None:
+    """
+    Kill the process group of the tester process proc or, if it is running as a different user, all processes of
+    test_username.
+    """
+    if test_username == getpass.getuser():
+        pgrp = os.getpgid(proc.pid)
+        os.killpg(pgrp, signal.SIGKILL)
+    else:
+        _kill_user_processes(test_username)
+
+
+def _cancel_key(test_id: Union[int, str]) -> str:
+    return f"autotest:cancel:{test_id}"
+
+
+def _cancel_requested(test_id: Union[int, str]) -> bool:
+    """Return True if a client has asked to cancel the test run with id test_id while it is running"""
+    return bool(redis_connection().exists(_cancel_key(test_id)))
+
+
+def _communicate(
+    proc: Union[subprocess.Popen, AgentProcess], input_: str, timeout: Optional[float], test_id: Union[int, str]
+) -> Tuple[str, str, bool]:
+    """
+    Send input_ to proc and wait for it to finish like proc.communicate but check whether the test run with id test_id
+    has been cancelled every CANCEL_POLL_INTERVAL seconds. Return the output of proc and whether the test run has
+    been cancelled.
+
+    Raises subprocess.TimeoutExpired if proc is still running after timeout seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = CANCEL_POLL_INTERVAL if deadline is None else min(CANCEL_POLL_INTERVAL, deadline - time.monotonic())
+        try:
+            out, err = proc.communicate(input=input_, timeout=max(wait, 0))
+            return out, err, False
+        except subprocess.TimeoutExpired:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            input_ = None  # input can only be sent on the first call
+            if _cancel_requested(test_id):
+                return "", "", True
+
+
 def _create_test_script_command(tester_type: str) -> str:
     """
     Return string representing a command line command to
@@ -148,6 +248,27 @@ def _get_env_vars(test_username: str) -> Dict[str, str]:
     return env_vars
 
 
+def _store_feedback_file(test_id: Union[int, str], filename: str, mime_type: str, data: bytes) -> Dict:
+    """
+    Store the gzip compressed content (data) of a feedback file of the test run with id test_id so that clients can
+    retrieve it. Return the feedback information that is included in the test results.
+    """
+    conn = redis_connection()
+    id_ = conn.incr("autotest:feedback_files_id")
+    key = f"autotest:feedback_file:{test_id}:{id_}"
+    index_key = f"autotest:feedback_files:{test_id}"
+    with conn.pipeline() as pipe:
+        pipe.set(key, data)
+        pipe.expire(key, 3600)  # TODO: make this configurable
+        pipe.hincrby(METRICS_KEY, "feedback_files_stored", 1)
+        pipe.hincrby(METRICS_KEY, "feedback_bytes", len(data))
+        # index of all feedback files for this test (used to download them all at once)
+        pipe.hset(index_key, id_, json.dumps({"filename": filename, "mime_type": mime_type}))
+        pipe.expire(index_key, 3600)
+        pipe.execute()
+    return {"filename": filename, "mime_type": mime_type, "compression": "gzip", "id": id_}
+
+
 def _get_feedback(test_data, tests_path, test_id) -> tuple[dict, str]:
     feedback_files = test_data.get("feedback_file_names", [])
     feedback, feedback_errors = [], []
@@ -155,19 +276,8 @@ def _get_feedback(test_data, tests_path, test_id) -> tuple[dict, str]:
         feedback_path = os.path.join(tests_path, feedback_file)
         if os.path.isfile(feedback_path):
             with open(feedback_path, "rb") as f:
-                conn = redis_connection()
-                id_ = conn.incr("autotest:feedback_files_id")
-                key = f"autotest:feedback_file:{test_id}:{id_}"
-                conn.set(key, gzip.compress(f.read()))
-                conn.expire(key, 3600)  # TODO: make this configurable
-                feedback.append(
-                    {
-                        "filename": feedback_file,
-                        "mime_type": mimetypes.guess_type(feedback_path)[0] or "text/plain",
-                        "compression": "gzip",
-                        "id": id_,
-                    }
-                )
+                mime_type = mimetypes.guess_type(feedback_path)[0] or "text/plain"
+                feedback.append(_store_feedback_file(test_id, feedback_file, mime_type, gzip.compress(f.read())))
         else:
             feedback_errors.append(feedback_file)
     return feedback, feedback_errors
@@ -196,6 +306,8 @@ def _run_test_specs(
     test_username: str,
     test_id: Union[int, str],
     test_env_vars: Dict[str, str],
+    settings_id: Optional[int] = None,
+    version: Optional[str] = None,
 ) -> List[ResultData]:
     """
     Run each test script in test_scripts in the tests_path directory using the
@@ -203,11 +315,12 @@ def _run_test_specs(
     """
     results = []
 
-    for settings in test_settings["testers"]:
+    for i, settings in enumerate(test_settings["testers"]):
         tester_type = settings["tester_type"]
 
         cmd_str = _create_test_script_command(tester_type)
         args = cmd.format(cmd_str)
+        agent = _agent(test_username)
 
         for test_data in settings["test_data"]:
             test_category = test_data.get("category", [])
@@ -215,34 +328,41 @@ def _run_test_specs(
                 start = time.time()
                 out, err = "", ""
                 timeout_expired = None
+                cancelled = False
                 timeout = test_data.get("timeout")
                 try:
                     env = settings.get("_env", {})
                     env_vars = {**os.environ, **_get_env_vars(test_username), **env}
                     env_vars = _update_env_vars(env_vars, test_env_vars)
-                    proc = subprocess.Popen(
-                        args,
-                        start_new_session=True,
-                        cwd=tests_path,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        stdin=subprocess.PIPE,
-                        universal_newlines=True,
-                        env={**os.environ, **env_vars, **env},
-                        executable="/bin/bash",
-                    )
+                    if agent is not None:
+                        tester_env = {**os.environ, **env_vars, **env}
+                        zygote_key = None if version is None else (f"{settings_id}-{i}", version)
+                        proc = _start_tester(agent, tester_type, cmd_str, tests_path, tester_env, zygote_key)
+                    else:
+                        proc = subprocess.Popen(
+                            args,
+                            start_new_session=True,
+                            cwd=tests_path,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            stdin=subprocess.PIPE,
+                            universal_newlines=True,
+                            env={**os.environ, **env_vars, **env},
+                            executable="/bin/bash",
+                        )
                     try:
                         settings_json = json.dumps({**settings, "test_data": test_data})
-                        out, err = proc.communicate(input=settings_json, timeout=timeout)
+                        out, err, cancelled = _communicate(proc, settings_json, timeout, test_id)
+                        if cancelled:
+                            _kill_tester(proc, test_username)
+                            out, _ = proc.communicate()
+                            err = CANCELLED_MESSAGE
                     except subprocess.TimeoutExpired:
-                        if test_username == getpass.getuser():
-                            pgrp = os.getpgid(proc.pid)
-                            os.killpg(pgrp, signal.SIGKILL)
-                        else:
-                            _kill_user_processes(test_username)
+                        _kill_tester(proc, test_username)
                         out, err = proc.communicate()
-                        if err == "Killed\n":  # Default message from shell
+                        # "Killed" is the default message from the shell, an agent's tester has no message at all
+                        if err in ("Killed\n", ""):
                             test_group_name = test_data.get("extra_info", {}).get("name", "").strip()
                             if test_group_name:
                                 err = f"Tests for {test_group_name} did not complete within time limit ({timeout}s)\n"
@@ -259,14 +379,56 @@ def _run_test_specs(
                         msg = "Cannot find feedback file(s): " + ", ".join(feedback_errors)
                         err = err + "\n\n" + msg if err else msg
                     results.append(_create_test_group_result(out, err, duration, extra_info, feedback, timeout_expired))
+                if cancelled:
+                    return results
     return results
 
 
+def _start_tester(
+    agent: AgentClient,
+    tester_type: str,
+    cmd_str: str,
+    tests_path: str,
+    env: Dict[str, str],
+    zygote_key: Optional[Tuple[str, str]],
+) -> AgentProcess:
+    """
+    Start a tester of tester_type with agent in the tests_path directory with the environment env. If zygotes are
+    enabled, the tester is forked from the zygote for zygote_key (a key and version of the tester's environment),
+    otherwise (or if the zygote cannot be used) the tester is started by running cmd_str.
+    """
+    zygote_settings = {"enabled": False, "idle_timeout": 600, **config.get("zygotes", {})}
+    if zygote_settings["enabled"] and zygote_key is not None and "PYTHON" in env:
+        try:
+            zygote_socket = agent.zygote(
+                *zygote_key,
+                python=env["PYTHON"],
+                tester_type=tester_type,
+                resource_settings=get_resource_settings(config),
+                env=env,
+                idle_timeout=zygote_settings["idle_timeout"],
+            )
+            return agent.fork(zygote_socket, tests_path, env)
+        except (AgentError, OSError):
+            traceback.print_exc()
+    return agent.spawn(cmd_str, tests_path, env)
+
+
 def _clear_working_directory(tests_path: str, test_username: str) -> None:
     """
     Run commands that clear the tests_path working directory, as well
     as clearing any files or directories owned by test_username in the /tmp directory
     """
+    agent = _agent(test_username)
+    if agent is not None:
+        agent.clean(tests_path)
+        for name in os.listdir(tests_path):
+            path = os.path.join(tests_path, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        return
     if test_username != getpass.getuser():
         sticky_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf -t {tests_path}'"
         chmod_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf ugo+rwX {tests_path}'"
@@ -298,9 +460,17 @@ def _stop_tester_processes(test_username: str) -> None:
         _kill_user_processes(test_username)
 
 
-def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, test_username: str) -> None:
+def _download_files(user: str, files_url: str) -> Tuple[IO[bytes], str]:
+    """
+    Download the zip archive of student files at files_url using the credentials of user. Return a temporary file
+    containing the archive and the sha256 hash of the archive.
+    """
+    return downloader(redis_connection()).download(user, files_url)
+
+
+def _setup_files(settings_id: int, archive: IO[bytes], tests_path: str, test_username: str) -> None:
     """
-    Copy test script files and student files to the working directory tests_path,
+    Copy test script files and student files (from the zip archive archive) to the working directory tests_path,
     then make it the current working directory.
     The following permissions are also set:
         - tests_path directory:     rwxrwx--T
@@ -309,19 +479,28 @@ def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, t
         - student subdirectories:   rwxrwx---
         - student files:            rw-rw----
     """
-    creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-    r = requests.get(files_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-    extract_zip_stream(r.content, tests_path)
-    for fd, file_or_dir in recursive_iglob(tests_path):
-        if fd == "d":
-            os.chmod(file_or_dir, 0o770)
-        else:
-            os.chmod(file_or_dir, 0o770)
-        shutil.chown(file_or_dir, group=test_username)
-    settings = json.loads(redis_connection().hget("autotest:settings", settings_id))
-    assert "_files" in settings, "Required key `_files` not found in settings"
-    test_script_dir = settings["_files"]
-    script_files = copy_tree(test_script_dir, tests_path)
+    max_size, max_entries = archive_limits(config)
+    extract_zip_stream(
+        archive,
+        tests_path,
+        dir_mode=0o770,
+        file_mode=0o770,
+        group=test_username,
+        max_size=max_size,
+        max_entries=max_entries,
+    )
+    meta = settings_store.get_metadata(redis_connection(), settings_id, "files", "version") or {}
+    test_script_dir = meta.get("files")
+    assert test_script_dir is not None, "Required field `files` not found in settings"
+    # tests run as the worker user could write to the shared snapshot files through their links
+    if config.get("snapshot_test_files") and meta.get("version") and test_username != getpass.getuser():
+        link_tree(_test_files_snapshot(settings_id, meta["version"], test_script_dir, test_username), tests_path)
+    else:
+        _set_test_file_permissions(copy_tree(test_script_dir, tests_path), test_username)
+
+
+def _set_test_file_permissions(script_files: List[Tuple[str, str]], test_username: str) -> None:
+    """Set the permissions of the test files and directories in script_files (as returned by copy_tree)"""
     for fd, file_or_dir in script_files:
         if fd == "d":
             os.chmod(file_or_dir, 0o1770)
@@ -330,6 +509,33 @@ def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, t
         shutil.chown(file_or_dir, group=test_username)
 
 
+def _test_files_snapshot(settings_id: int, version: str, test_script_dir: str, test_username: str) -> str:
+    """
+    Return the path to a snapshot of the test files in test_script_dir for version of the settings with id settings_id,
+    with the permissions used when running tests as test_username. The snapshot is only created the first time it is
+    needed, at which point the snapshots of other versions of the settings for test_username are removed.
+
+    The snapshot is not accessible to test_username itself: its files are hard linked into the working directory
+    of each test run instead of being copied there (see link_tree).
+    """
+    snapshots_dir = os.path.join(TEST_SCRIPT_DIR, str(settings_id), "snapshots", test_username)
+    snapshot = os.path.join(snapshots_dir, version)
+    if os.path.isdir(snapshot):
+        return snapshot
+    os.makedirs(snapshots_dir, mode=0o700, exist_ok=True)
+    # build the snapshot under a temporary name so that a partially built snapshot is never used
+    building = tempfile.mkdtemp(dir=snapshots_dir, prefix=f"{version}.")
+    _set_test_file_permissions(copy_tree(test_script_dir, building), test_username)
+    try:
+        os.rename(building, snapshot)
+    except OSError:  # another worker created the snapshot first
+        shutil.rmtree(building)
+    for name in os.listdir(snapshots_dir):
+        if name != version and "." not in name:
+            shutil.rmtree(os.path.join(snapshots_dir, name), onerror=ignore_missing_dir_error)
+    return snapshot
+
+
 def tester_user() -> Tuple[str, str]:
     """
     Get the workspace for the tester user specified by the WORKERUSER
@@ -354,27 +560,109 @@ def tester_user() -> Tuple[str, str]:
     return user_name, user_workspace
 
 
-def run_test(settings_id, test_id, files_url, categories, user, test_env_vars):
+def _record_runtimes(settings_id: int, settings: Dict, categories: List[str], results: List[ResultData]) -> None:
+    """
+    Add the time taken to run each test group in results to the run time history of the settings with id settings_id.
+    Test groups that were cancelled are not recorded.
+    """
+    groups = settings_store.requested_groups(settings_store.test_groups(settings), categories)
+    key = settings_store.runtimes_key(settings_id)
+    with redis_connection().pipeline() as pipe:
+        for index, result in zip(groups, results):
+            if (result["stderr"] or "").startswith(CANCELLED_MESSAGE):
+                continue
+            pipe.hincrbyfloat(key, f"{index}:total", result["time"] / 1000)
+            pipe.hincrby(key, f"{index}:count", 1)
+        pipe.execute()
+
+
+def _cached_results(cache_key: str, test_id: Union[int, str]) -> Optional[List[ResultData]]:
+    """
+    Return the cached test group results stored under cache_key, after storing their feedback files again for the
+    test run with id test_id, or None if there are no such results.
+    """
+    cached = result_cache.get(redis_connection(), cache_key)
+    if cached is None:
+        return None
+    results, feedback_data = cached
+    for result in results:
+        result["feedback"] = [
+            _store_feedback_file(test_id, info["filename"], info["mime_type"], feedback_data[str(info["id"])])
+            for info in result["feedback"]
+        ]
+    return results
+
+
+def _cache_results(cache_key: str, test_id: Union[int, str], results: List[ResultData]) -> None:
+    """
+    Cache results (and their feedback files) under cache_key unless they depend on more than their inputs: results
+    of tests that were cancelled or timed out are not cached.
+    """
+    for result in results:
+        if result["timeout"] is not None or (result["stderr"] or "").startswith(CANCELLED_MESSAGE):
+            return
+    ids = [str(info["id"]) for result in results for info in result["feedback"]]
+    feedback_data = redis_connection().mget([f"autotest:feedback_file:{test_id}:{id_}" for id_ in ids]) if ids else []
+    if None in feedback_data:  # the feedback files were already downloaded and deleted
+        return
+    result_cache.put(redis_connection(), cache_key, results, dict(zip(ids, feedback_data)))
+
+
+def run_test(settings_id, test_id, files_url, categories, user, test_env_vars, callback_url=None):
     results = []
     error = None
     try:
-        settings = json.loads(redis_connection().hget("autotest:settings", key=settings_id))
-        settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(settings))
+        meta = (
+            settings_store.get_metadata(redis_connection(), settings_id, "env_status", "error", "etag", "version") or {}
+        )
+        with redis_connection().pipeline() as pipe:
+            pipe.hset(settings_store.meta_key(settings_id), "last_access", int(time.time()))
+            pipe.hget(settings_store.SETTINGS_KEY, settings_id)
+            _, settings = pipe.execute()
+        _publish_status(settings_id, test_id, "started")
 
         # If test settings contain errors, we do not want to run the tests.
-        assert not settings.get("_error"), f"Error in test settings: {settings['_error']}"
-        assert settings.get("_env_status") != "error", "Error in test settings"
-
+        assert not meta.get("error"), f"Error in test settings: {meta.get('error')}"
+        assert meta.get("env_status") != "error", "Error in test settings"
+        assert not _cancel_requested(test_id), "Tests were cancelled"
+        settings = json.loads(settings)
         test_username, tests_path = tester_user()
+        archive, archive_hash = _download_files(user, files_url)
+
+        # results of identical test runs are reused (without setting up the tests at all) if the settings allow it
+        cache_key = None
+        if settings.get("cache_results"):
+            cache_key = result_cache.cache_key(
+                settings_id, archive_hash, meta["etag"], meta["version"], categories, test_env_vars
+            )
+            cached = _cached_results(cache_key, test_id)
+            if cached is not None:
+                archive.close()
+                results = cached
+                return
+
         try:
             _clear_working_directory(tests_path, test_username)
-            _setup_files(settings_id, user, files_url, tests_path, test_username)
+            with archive:
+                _setup_files(settings_id, archive, tests_path, test_username)
             cmd = run_test_command(test_username=test_username)
-            results = _run_test_specs(cmd, settings, categories, tests_path, test_username, test_id, test_env_vars)
+            results = _run_test_specs(
+                cmd,
+                settings,
+                categories,
+                tests_path,
+                test_username,
+                test_id,
+                test_env_vars,
+                settings_id=settings_id,
+                version=meta.get("version"),
+            )
+            _record_runtimes(settings_id, settings, categories, results)
         finally:
             _stop_tester_processes(test_username)
             _clear_working_directory(tests_path, test_username)
+        if cache_key is not None:
+            _cache_results(cache_key, test_id, results)
     except AssertionError as e:
         traceback.print_exc()
         error = f"Failed to run tests: {e}"
@@ -382,9 +670,11 @@ def run_test(settings_id, test_id, files_url, categories, user, test_env_vars):
         traceback.print_exc()
         error = traceback.format_exc()
     finally:
-        key = f"autotest:test_result:{test_id}"
-        redis_connection().set(key, json.dumps({"test_groups": results, "error": error}))
-        redis_connection().expire(key, 3600)  # TODO: make this configurable
+        result = {"test_groups": results, "error": error}
+        _store_result(test_id, result)
+        if callback_url:
+            queue_callback(redis_connection(), callback_url, user, settings_id, test_id, result)
+        _publish_status(settings_id, test_id, "finished")
 
 
 def ignore_missing_dir_error(
@@ -400,6 +690,8 @@ def ignore_missing_dir_error(
 
 
 def update_test_settings(user, settings_id, test_settings, file_url):
+    test_settings, meta = settings_store.split_metadata(test_settings)
+    meta.pop("error", None)
     try:
         settings_dir = os.path.join(TEST_SCRIPT_DIR, str(settings_id))
 
@@ -407,12 +699,13 @@ def update_test_settings(user, settings_id, test_settings, file_url):
         os.chmod(TEST_SCRIPT_DIR, 0o755)
 
         files_dir = os.path.join(settings_dir, "files")
-        test_settings["_files"] = files_dir
+        meta["files"] = files_dir
         shutil.rmtree(files_dir, onerror=ignore_missing_dir_error)
         os.makedirs(files_dir, exist_ok=True)
-        creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-        r = requests.get(file_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-        extract_zip_stream(r.content, files_dir)
+        archive, _ = downloader(redis_connection()).download(user, file_url)
+        with archive:
+            max_size, max_entries = archive_limits(config)
+            extract_zip_stream(archive, files_dir, max_size=max_size, max_entries=max_entries)
 
         schema = json.loads(redis_connection().get("autotest:schema"))
         installed_testers = schema["definitions"]["installed_testers"]["enum"]
@@ -434,13 +727,15 @@ def update_test_settings(user, settings_id, test_settings, file_url):
                     error_message += f"\nDetails (captured stderr):\n{e.stderr}"
                 raise Exception(error_message) from e
             test_settings["testers"][i] = tester_settings
-        test_settings.pop("_error", None)
-        test_settings["_env_status"] = "ready"
+        meta["env_status"] = "ready"
     except Exception as e:
-        test_settings["_error"] = str(e)
-        test_settings["_env_status"] = "error"
+        meta["error"] = str(e)
+        meta["env_status"] = "error"
         raise
     finally:
-        test_settings["_user"] = user
-        test_settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
+        meta["user"] = user
+        meta["last_access"] = int(time.time())
+        delete = () if "error" in meta else ("error",)
+        with redis_connection().pipeline() as pipe:
+            settings_store.write_settings(pipe, settings_id, test_settings, meta, delete=delete)
+            pipe.execute()
@@ -0,0 +1,743 @@
+"""
+A long lived agent that runs as a test user and does the work that workers otherwise do by running commands as the
+test user with sudo: clearing the working directory, starting testers and killing the test user's processes.
+
+Workers with the runner_agent setting start an agent for each test user (see AgentClient) the first time it is needed
+and send it requests over a unix socket in the workspace. The agent runs with the same uid as the tests, so it must not
+be possible for tests to take its place: the worker binds the socket in a directory that only the worker user can
+access and passes it to the agent as its stdin. The agent then listens on it, which makes the agent the peer of every
+connection to the socket, and the worker checks the peer credentials of each connection against the pid of the agent
+that it started (see AgentClient.start). Each request is a json object sent in a single message on a new connection and
+the agent replies to it with a json object that contains an "error" if the request failed:
+
+    {"command": "clean", "path": ..., "tmp_dir": ...}
+        make the files owned by the test user in path removable and remove the test user's files in tmp_dir
+    {"command": "kill"}
+        kill all processes of the test user (except the agent itself)
+    {"command": "spawn", "args": ..., "cwd": ..., "env": ...}
+        run args with bash using the stdin, stdout and stderr file descriptors sent with the request. The agent replies
+        with the pid of the new process and then with its return code once it exits.
+    {"command": "zygote", "key": ..., "python": ..., "tester_type": ..., "resource_settings": ..., "env": ...,
+     "idle_timeout": ...}
+        start a zygote for key (see below) that listens on the socket file descriptor sent with the request, stopping
+        the previous zygote for key, and reply with its pid once it is ready
+    {"command": "stop"}
+        stop the agent and its zygotes
+
+A zygote is a process started by the agent with the python executable of a tester environment that imports the tester
+(and so all of its dependencies) once and then forks a new process to run the tester for every test group, instead of
+starting a new python process that imports the tester for every test group. A zygote only accepts spawn requests
+(without args) on its own socket, which is bound by the worker like the agent's socket, and exits after idle_timeout
+seconds without requests. The agent's kill command spares the zygotes that it started, so a zygote outlives the tests
+that are forked from it. Like the agent, a zygote cannot be attached to with ptrace by the tests, and the worker only
+sends requests to the zygote whose pid the agent reported. The tests can still send signals to it or change its
+scheduling priority and resource limits (which later tests inherit), so zygotes should only be used when the tests are
+trusted.
+
+This module only uses the standard library so that the agent and zygotes can be started without importing
+autotest_server (with any version of python 3.9+). Both are started with the socket they listen on as their stdin:
+
+    python agent.py
+    python agent.py --zygote <tester type> <resource settings (json)> <idle timeout>
+"""
+
+import array
+import ctypes
+import getpass
+import importlib
+import json
+import os
+import pwd
+import select
+import selectors
+import shutil
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional, Sequence, Tuple
+
+MAX_MESSAGE_SIZE = 1024**2
+SOCKET_NAME = "agent.sock"
+PID_FILE_NAME = "agent.pid"
+PR_SET_DUMPABLE = 4
+
+
+class AgentError(Exception):
+    pass
+
+
+def _send(conn: socket.socket, message: Dict, fds: Sequence[int] = ()) -> None:
+    data = json.dumps(message).encode()
+    if fds:
+        conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        conn.send(data)
+
+
+def _receive(conn: socket.socket, max_fds: int = 0) -> Tuple[Optional[Dict], List[int]]:
+    """Return the next message received on conn (or None if conn was closed) and the file descriptors sent with it"""
+    data, fds, _flags, _address = socket.recv_fds(conn, MAX_MESSAGE_SIZE, max_fds)
+    return (json.loads(data) if data else None), fds
+
+
+def _bind(socket_path: str) -> socket.socket:
+    """
+    Return a socket bound to socket_path that only the current user can connect to. The socket is not listening yet:
+    the process that it is passed to listens on it so that this process is the peer of the connections to it.
+    """
+    if os.path.lexists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+    except OSError:
+        server.close()
+        raise
+    return server
+
+
+def _stdin_socket() -> socket.socket:
+    """Return the socket that this process was started with as its stdin and replace stdin with /dev/null"""
+    server = socket.socket(fileno=os.dup(0))
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    return server
+
+
+def _peer_credentials(conn: socket.socket) -> Tuple[int, int]:
+    """Return the pid and uid of the process that listens on the socket that conn is connected to"""
+    pid, uid, _gid = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return pid, uid
+
+
+def _set_dumpable(dumpable: bool) -> None:
+    """
+    Set whether processes of the same user can attach to this process with ptrace (or take its file descriptors) even
+    where the kernel allows it. The flag is reset when a new program is executed.
+    """
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_DUMPABLE, int(dumpable), 0, 0, 0)
+
+
+def _connect(socket_path: str) -> socket.socket:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+
+def _user_env(env: Dict[str, str]) -> Dict[str, str]:
+    """Return env with the variables that describe the current user set like sudo sets them"""
+    user = pwd.getpwuid(os.getuid())
+    return {**env, "USER": user.pw_name, "LOGNAME": user.pw_name, "HOME": user.pw_dir}
+
+
+# agent
+
+
+def _make_removable(path: str, uid: int) -> None:
+    """Do what `chmod -t,ugo+rwX path` does if path belongs to uid"""
+    path_stat = os.lstat(path)
+    if path_stat.st_uid != uid or stat.S_ISLNK(path_stat.st_mode):
+        return
+    mode = (stat.S_IMODE(path_stat.st_mode) & ~stat.S_ISVTX) | 0o666
+    if stat.S_ISDIR(path_stat.st_mode) or mode & 0o111:
+        mode |= 0o111
+    os.chmod(path, mode)
+
+
+def _remove(path: str) -> None:
+    """Remove path like `rm -rf path` does, ignoring errors"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def clean(path: str, tmp_dir: str) -> None:
+    """
+    Make the files of the current user in path removable and remove the files of the current user in tmp_dir (but
+    not in its subdirectories)
+    """
+    uid = os.getuid()
+    # directories are made accessible before os.walk lists their contents
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                _make_removable(os.path.join(root, name), uid)
+            except OSError:
+                pass
+    for name in os.listdir(tmp_dir):
+        tmp_path = os.path.join(tmp_dir, name)
+        try:
+            if os.lstat(tmp_path).st_uid == uid:
+                _remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _real_uid(pid: int) -> int:
+    """
+    Return the real uid of the process with pid. The owner of /proc/<pid> cannot be used instead since it is root for
+    processes that are not dumpable.
+    """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Uid:"):
+                return int(line.split()[1])
+    raise ProcessLookupError(pid)
+
+
+def kill() -> None:
+    """Kill all processes of the current user except this one and its zygotes"""
+    with _ZYGOTES_LOCK:
+        spared = {os.getpid(), *(proc.pid for proc in _ZYGOTES.values() if proc.poll() is None)}
+    if len(spared) == 1:
+        try:
+            os.kill(-1, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        return
+    uid = os.getuid()
+    # processes can be started while others are killed so repeat until there are none left
+    for _ in range(100):
+        killed = False
+        for pid in (int(name) for name in os.listdir("/proc") if name.isdigit()):
+            try:
+                if pid not in spared and _real_uid(pid) == uid:
+                    os.kill(pid, signal.SIGKILL)
+                    killed = True
+            except (FileNotFoundError, ProcessLookupError):
+                pass
+        if not killed:
+            break
+    # a zygote that was stopped by a test would block the tests that are forked from it later
+    for pid in spared - {os.getpid()}:
+        try:
+            os.kill(pid, signal.SIGCONT)
+        except ProcessLookupError:
+            pass
+
+
+_ZYGOTES: Dict[str, subprocess.Popen] = {}
+_ZYGOTES_LOCK = threading.Lock()
+ZYGOTE_START_TIMEOUT = 120
+
+
+def start_zygote(request: Dict, server_fd: int) -> int:
+    """
+    Start a zygote for the key in request that listens on the socket server_fd, stopping the previous zygote for the
+    key, and wait until it is ready. Return the pid of the zygote.
+    """
+    key = request["key"]
+    with _ZYGOTES_LOCK:
+        current = _ZYGOTES.pop(key, None)
+        if current is not None:
+            current.kill()
+            current.wait()
+        resource_settings = json.dumps(request["resource_settings"])
+        cmd = [request["python"], os.path.abspath(__file__), "--zygote", request["tester_type"], resource_settings]
+        proc = subprocess.Popen(
+            [*cmd, str(request["idle_timeout"])],
+            env=_user_env(request["env"]),
+            stdin=server_fd,
+            stdout=subprocess.PIPE,
+            start_new_session=True,
+        )
+        # the zygote writes a line to stdout once it listens on its socket (or exits if it fails to start)
+        with proc.stdout:
+            ready, _, _ = select.select([proc.stdout], [], [], ZYGOTE_START_TIMEOUT)
+            if ready and proc.stdout.readline() == b"ready\n":
+                _ZYGOTES[key] = proc
+                return proc.pid
+        proc.kill()
+        proc.wait()
+    raise AgentError(f"the zygote for {key} did not start")
+
+
+def stop_zygotes() -> None:
+    with _ZYGOTES_LOCK:
+        for proc in _ZYGOTES.values():
+            proc.kill()
+        _ZYGOTES.clear()
+
+
+def spawn(conn: socket.socket, request: Dict, fds: List[int]) -> None:
+    """Run the command in request and reply with its pid, then with its return code once it exits"""
+    env = _user_env(request["env"])
+    stdin, stdout, stderr = fds
+    proc = subprocess.Popen(
+        request["args"],
+        shell=True,
+        executable="/bin/bash",
+        cwd=request["cwd"],
+        env=env,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        start_new_session=True,
+    )
+    for fd in fds:
+        os.close(fd)
+    _send(conn, {"pid": proc.pid})
+    _send(conn, {"returncode": proc.wait()})
+
+
+def handle(conn: socket.socket) -> None:
+    with conn:
+        fds = []
+        try:
+            request, fds = _receive(conn, max_fds=3)
+            if request is None:  # the worker checks whether the agent is running by connecting to it
+                return
+            command = request.get("command")
+            if command == "clean":
+                clean(request["path"], request["tmp_dir"])
+            elif command == "kill":
+                kill()
+            elif command == "spawn":
+                spawn(conn, request, fds)
+                fds = []
+                return
+            elif command == "zygote":
+                if len(fds) != 1:
+                    raise ValueError("a zygote request must include the socket that the zygote listens on")
+                _send(conn, {"pid": start_zygote(request, fds[0])})
+                return
+            elif command == "stop":
+                stop_zygotes()
+                _send(conn, {})
+                os._exit(0)
+            else:
+                raise ValueError(f"unknown command: {command}")
+            _send(conn, {})
+        except Exception as e:
+            _send(conn, {"error": f"{type(e).__name__}: {e}"})
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+def serve() -> None:
+    """Handle requests sent to the unix socket that the agent was started with as its stdin, each in a new thread"""
+    # tests run as the same user must not be able to attach to the agent and take its socket
+    _set_dumpable(False)
+    server = _stdin_socket()
+    server.listen()
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+# zygote
+
+
+def _exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _run_tester(tester_class: type, specs_class: type, resource_settings: List, request: Dict) -> int:
+    """Run the tester like `python -c` would in the current (forked) process and return its exit code"""
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(_user_env(request["env"]))
+        sys.argv = ["-c"]
+        sys.path.insert(0, "")
+        importlib.invalidate_caches()
+        tester_class(resource_settings=resource_settings, specs=specs_class.from_json(sys.stdin.read())).run()
+        return 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def zygote(tester_type: str, resource_settings: List, idle_timeout: float) -> None:
+    """
+    Import the tester of tester_type, then handle spawn requests sent to the unix socket that the zygote was started
+    with as its stdin by forking a process that runs the tester for each request. Exit after idle_timeout seconds
+    without requests or running testers.
+    """
+    # tests forked from the zygote must not be able to attach to it (the forked processes are made dumpable again)
+    _set_dumpable(False)
+    server = _stdin_socket()
+    # like `python -c`, the testers and tests are imported with the working directory first and autotest_server last
+    sys.path.append(sys.path.pop(0))
+    tester_module = importlib.import_module(f"testers.{tester_type}.{tester_type}_tester")
+    tester_class = getattr(tester_module, f"{tester_type.capitalize()}Tester")
+    specs_class = importlib.import_module("testers.specs").TestSpecs
+    resource_settings = [(limit, tuple(rlimit)) for limit, rlimit in resource_settings]
+
+    server.listen()
+    # tell the agent that the zygote is ready, then stop writing to the pipe that the agent reads that from
+    os.write(1, b"ready\n")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    running: Dict[int, Tuple[int, socket.socket]] = {}  # pidfd: (pid, connection of the request)
+    while True:
+        events = selector.select(idle_timeout)
+        if not events and not running:
+            return
+        for key, _ in events:
+            if key.fileobj is not server:
+                pidfd = key.fileobj
+                pid, conn = running.pop(pidfd)
+                selector.unregister(pidfd)
+                os.close(pidfd)
+                _, status = os.waitpid(pid, 0)
+                with conn:
+                    _send(conn, {"returncode": _exit_code(status)})
+                continue
+            conn, _ = server.accept()
+            fds = []
+            try:
+                request, fds = _receive(conn, max_fds=3)
+                if request is None:  # the worker checks whether the zygote is running by connecting to it
+                    conn.close()
+                    continue
+                if request.get("command") != "spawn" or len(fds) != 3:
+                    raise ValueError("a zygote only accepts spawn requests with stdin, stdout and stderr")
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        selector.close()
+                        server.close()
+                        for pidfd_ in running:
+                            os.close(pidfd_)
+                        os.setsid()
+                        _set_dumpable(True)
+                        for target, fd in enumerate(fds):
+                            os.dup2(fd, target)
+                            os.close(fd)
+                        conn.close()
+                        code = _run_tester(tester_class, specs_class, resource_settings, request)
+                    finally:
+                        os._exit(code)
+                pidfd = os.pidfd_open(pid)
+                running[pidfd] = (pid, conn)
+                selector.register(pidfd, selectors.EVENT_READ)
+                _send(conn, {"pid": pid})
+            except Exception as e:
+                with conn:
+                    try:
+                        _send(conn, {"error": f"{type(e).__name__}: {e}"})
+                    except OSError:
+                        pass
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+
+# client
+
+
+class AgentProcess:
+    def __init__(self, args: str, conn: socket.socket, stdin: int, stdout: int, stderr: int) -> None:
+        """
+        Initialize a process started by an agent, that the agent reports the return code of on conn and that reads
+        from the stdin file descriptor and writes to the stdout and stderr file descriptors.
+
+        The output of the process is read in the background and communicate can be used like
+        subprocess.Popen.communicate (in text mode) to send input and wait for the process to finish.
+        """
+        self.args = args
+        self.returncode = None
+        self._conn = conn
+        reply, _ = _receive(conn)
+        if reply is None or "error" in reply:
+            conn.close()
+            for fd in (stdin, stdout, stderr):
+                os.close(fd)
+            raise AgentError(f"failed to start {args}: {(reply or {}).get('error', 'the agent stopped')}")
+        self.pid = reply["pid"]
+        self._stdin = os.fdopen(stdin, "w")
+        self._output = {"stdout": [], "stderr": []}
+        self._threads = [
+            threading.Thread(target=self._read, args=(os.fdopen(stdout), self._output["stdout"]), daemon=True),
+            threading.Thread(target=self._read, args=(os.fdopen(stderr), self._output["stderr"]), daemon=True),
+            threading.Thread(target=self._wait, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._writer = None
+
+    @staticmethod
+    def _read(file, output: List[str]) -> None:
+        with file:
+            output.append(file.read())
+
+    def _wait(self) -> None:
+        with self._conn:
+            reply, _ = _receive(self._conn)
+        # the return code is unknown if the agent stops before the process does
+        self.returncode = (reply or {}).get("returncode", -signal.SIGKILL)
+
+    def _write(self, input_: Optional[str]) -> None:
+        try:
+            with self._stdin:
+                if input_:
+                    self._stdin.write(input_)
+        except BrokenPipeError:
+            pass
+
+    def communicate(self, input: Optional[str] = None, timeout: Optional[float] = None) -> Tuple[str, str]:
+        """
+        Send input to the process (on the first call only), then wait for it to exit and return its output.
+
+        Raises subprocess.TimeoutExpired if the process is still running after timeout seconds.
+        """
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write, args=(input,), daemon=True)
+            self._writer.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in (self._writer, *self._threads):
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if thread.is_alive():
+                raise subprocess.TimeoutExpired(self.args, timeout)
+        return "".join(self._output["stdout"]), "".join(self._output["stderr"])
+
+
+class AgentClient:
+    def __init__(self, test_username: str, socket_dir: str, start_timeout: float = 10) -> None:
+        """
+        Initialize a client of the agent of test_username that listens on a socket in socket_dir, a directory that only
+        the current user can access. The agent is started (and restarted if it stops) when a request is sent to it.
+        """
+        self.test_username = test_username
+        self.uid = pwd.getpwnam(test_username).pw_uid
+        self.socket_dir = socket_dir
+        self.socket_path = os.path.join(socket_dir, SOCKET_NAME)
+        self.pid_path = os.path.join(socket_dir, PID_FILE_NAME)
+        self.start_timeout = start_timeout
+
+    def _make_socket_dir(self) -> None:
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.socket_dir, 0o700)
+
+    def _pid(self) -> Optional[int]:
+        """Return the pid of the agent that was started last (by any process of the worker) if there is one"""
+        try:
+            with open(self.pid_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def start(self) -> None:
+        """
+        Start the agent with a new socket and wait until it accepts connections, then record its pid so that only
+        connections to this agent are used.
+        """
+        self._make_socket_dir()
+        cmd = [sys.executable, os.path.abspath(__file__)]
+        if self.test_username != getpass.getuser():
+            cmd = ["sudo", "-u", self.test_username, "--", *cmd]
+        with _bind(self.socket_path) as server:
+            proc = subprocess.Popen(cmd, stdin=server.fileno(), start_new_session=True)
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline and proc.poll() is None:
+            try:
+                conn = _connect(self.socket_path)
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+                continue
+            with conn:
+                pid, uid = _peer_credentials(conn)
+            if uid != self.uid:
+                raise AgentError(f"the agent of {self.test_username} is running as uid {uid}")
+            with open(f"{self.pid_path}.tmp", "w") as f:
+                f.write(str(pid))
+            os.replace(f"{self.pid_path}.tmp", self.pid_path)
+            return
+        raise AgentError(f"the agent of {self.test_username} did not start within {self.start_timeout} seconds")
+
+    def _connect(self) -> Optional[socket.socket]:
+        """
+        Return a connection to the agent or None if it is not running. Connections to any process other than the
+        agent that was started last are closed without sending anything.
+        """
+        try:
+            conn = _connect(self.socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        if _peer_credentials(conn) != (self._pid(), self.uid):
+            conn.close()
+            return None
+        return conn
+
+    def _request(self, message: Dict, fds: Sequence[int] = ()) -> socket.socket:
+        """Send message to the agent (starting it if it is not running) and return the connection it was sent on"""
+        conn = self._connect()
+        if conn is None:
+            self.start()
+            conn = self._connect()
+            if conn is None:
+                raise AgentError(f"the agent of {self.test_username} stopped")
+        _send(conn, message, fds)
+        return conn
+
+    def _call(self, message: Dict) -> None:
+        with self._request(message) as conn:
+            reply, _ = _receive(conn)
+        if reply is None or "error" in reply:
+            raise AgentError(f"{message['command']} failed: {(reply or {}).get('error', 'the agent stopped')}")
+
+    def clean(self, path: str, tmp_dir: str = "/tmp") -> None:
+        """Make the test user's files in path removable and remove the test user's files in tmp_dir"""
+        self._call({"command": "clean", "path": path, "tmp_dir": tmp_dir})
+
+    def kill(self) -> None:
+        """Kill all processes of the test user"""
+        self._call({"command": "kill"})
+
+    def stop(self) -> None:
+        """Stop the agent if it is running"""
+        conn = self._connect()
+        if conn is not None:
+            with conn:
+                _send(conn, {"command": "stop"})
+                _receive(conn)
+        # new connections fail (and start a new agent) instead of being accepted by a stopping agent
+        for path in (self.socket_path, self.pid_path):
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def _spawn(self, message: Dict, zygote_socket: Optional[str] = None) -> AgentProcess:
+        """Send a spawn request to the agent or, if zygote_socket is given, to the zygote listening at zygote_socket"""
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        fds = [stdin_r, stdout_w, stderr_w]
+        try:
+            if zygote_socket is None:
+                conn = self._request(message, fds)
+            else:
+                conn = self._connect_zygote(zygote_socket)
+                if conn is None:
+                    raise AgentError(f"the zygote listening at {zygote_socket} is not running")
+                _send(conn, message, fds)
+        except Exception:
+            for fd in (stdin_w, stdout_r, stderr_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w):
+                os.close(fd)
+        return AgentProcess(message.get("args", "zygote"), conn, stdin_w, stdout_r, stderr_r)
+
+    def spawn(self, args: str, cwd: str, env: Dict[str, str]) -> AgentProcess:
+        """Run args with bash as the test user, in the cwd directory with the environment env"""
+        return self._spawn({"command": "spawn", "args": args, "cwd": cwd, "env": env})
+
+    def zygote(
+        self,
+        key: str,
+        version: str,
+        python: str,
+        tester_type: str,
+        resource_settings: List,
+        env: Dict[str, str],
+        idle_timeout: float,
+    ) -> str:
+        """
+        Start a zygote for version of key (unless it is already running) that runs the tester of tester_type with
+        the python executable python and the environment env. Return the path to the socket of the zygote.
+        """
+        socket_path = os.path.join(self.socket_dir, f"zygote-{key}.sock")
+        if self._zygote_info(socket_path).get("version") == version:
+            conn = self._connect_zygote(socket_path)
+            if conn is not None:
+                conn.close()
+                return socket_path
+        message = {
+            "command": "zygote",
+            "key": key,
+            "python": python,
+            "tester_type": tester_type,
+            "resource_settings": resource_settings,
+            "env": env,
+            "idle_timeout": idle_timeout,
+        }
+        self._make_socket_dir()
+        with _bind(socket_path) as server, self._request(message, [server.fileno()]) as conn:
+            reply, _ = _receive(conn)
+        if reply is None or "error" in reply:
+            raise AgentError(f"zygote failed: {(reply or {}).get('error', 'the agent stopped')}")
+        with open(f"{socket_path}.json", "w") as f:
+            json.dump({"version": version, "pid": reply["pid"]}, f)
+        return socket_path
+
+    @staticmethod
+    def _zygote_info(zygote_socket: str) -> Dict:
+        """Return the version and pid of the zygote that was started last with the socket zygote_socket"""
+        try:
+            with open(f"{zygote_socket}.json") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _connect_zygote(self, zygote_socket: str) -> Optional[socket.socket]:
+        """
+        Return a connection to the zygote listening at zygote_socket or None if it is not running. Like connections to
+        the agent, connections to any other process are closed without sending anything.
+        """
+        try:
+            conn = _connect(zygote_socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        if _peer_credentials(conn) != (self._zygote_info(zygote_socket).get("pid"), self.uid):
+            conn.close()
+            return None
+        return conn
+
+    def fork(self, zygote_socket: str, cwd: str, env: Dict[str, str]) -> AgentProcess:
+        """
+        Run the tester of the zygote listening at zygote_socket in a process forked from the zygote, in the cwd
+        directory with the environment env. Like the tester command, the process reads the test specs from stdin.
+        """
+        return self._spawn({"command": "spawn", "cwd": cwd, "env": env}, zygote_socket)
+
+
+_CLIENTS: Dict[str, AgentClient] = {}
+
+
+def agent_client(test_username: str, socket_dir: str) -> AgentClient:
+    """Return the client of the agent of test_username that listens on a socket in socket_dir"""
+    if test_username not in _CLIENTS:
+        _CLIENTS[test_username] = AgentClient(test_username, socket_dir)
+    return _CLIENTS[test_username]
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--zygote"]:
+        zygote(sys.argv[2], json.loads(sys.argv[3]), float(sys.argv[4]))
+    else:
+        serve()
@@ -0,0 +1,243 @@
+"""
+Deliver test results to the callback urls that clients register when they enqueue tests.
+
+When a test with a callback url finishes, the worker running the test only appends a delivery record to the
+CALLBACK_QUEUE list so that delivery never blocks the worker. This module is run as a separate process
+(see start_stop.py) that sends these records in batches. Records that cannot be delivered are retried with an
+exponential backoff and moved to the DEAD_LETTER_QUEUE list after max_attempts failed attempts.
+
+Records are moved to the PROCESSING_QUEUE list while they are being sent and are only removed from it once they have
+been delivered, scheduled for a retry or moved to the DEAD_LETTER_QUEUE list. Records left in the PROCESSING_QUEUE list
+by a sender that stopped unexpectedly are moved back to the CALLBACK_QUEUE list when the next sender starts, so only one
+sender should run at a time.
+
+    python -m autotest_server.callbacks
+"""
+
+import json
+import time
+import traceback
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import redis
+import requests
+from redis.backoff import FullJitterBackoff
+from redis.exceptions import TimeoutError, ConnectionError
+from redis.retry import Retry
+from requests.adapters import HTTPAdapter
+
+from .config import config
+
+CALLBACK_QUEUE = "autotest:callbacks"
+RETRY_QUEUE = "autotest:callbacks:retry"
+DEAD_LETTER_QUEUE = "autotest:callbacks:dead"
+PROCESSING_QUEUE = "autotest:callbacks:processing"
+
+CallbackRecord = Dict
+
+
+def callback_settings() -> Dict:
+    """Return the callback settings from the config file, with defaults filled in"""
+    return {
+        "batch_size": 100,
+        "max_attempts": 5,
+        "backoff": 2,
+        "timeout": 30,
+        "pool_size": 10,
+        "credentials_ttl": 300,
+        **config.get("callbacks", {}),
+    }
+
+
+def queue_callback(conn: redis.Redis, url: str, user: str, settings_id: int, test_id: int, result: Dict) -> None:
+    """
+    Add a record to the callback queue that will be used to deliver result to url.
+    """
+    data = {"settings_id": settings_id, "test_id": test_id, "status": "finished", **result}
+    conn.rpush(CALLBACK_QUEUE, json.dumps({"url": url, "user": user, "attempts": 0, "data": data}))
+
+
+class CallbackSender:
+    def __init__(
+        self,
+        conn: redis.Redis,
+        batch_size: int = 100,
+        max_attempts: int = 5,
+        backoff: float = 2,
+        timeout: float = 30,
+        pool_size: int = 10,
+        credentials_ttl: float = 300,
+    ) -> None:
+        """
+        Initialize a sender that delivers callback records found in the redis database that conn connects to.
+
+        Up to batch_size records are sent at a time; records with the same url are sent in a single request.
+        Connections are kept alive and reused with a pool of up to pool_size connections per host. The credentials
+        of each user are read from the redis database at most once every credentials_ttl seconds, or again when they
+        are rejected.
+        """
+        self.conn = conn
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.credentials_ttl = credentials_ttl
+        self._credentials: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+    def _auth_header(self, user: str) -> Dict[str, str]:
+        """Return the authorization header used to send results on behalf of user"""
+        expires, header = self._credentials.get(user, (0, {}))
+        if expires <= time.monotonic():
+            creds = json.loads(self.conn.hget("autotest:user_credentials", key=user) or "{}")
+            header = {"Authorization": f"{creds.get('auth_type')} {creds.get('credentials')}"}
+            self._credentials[user] = (time.monotonic() + self.credentials_ttl, header)
+        return header
+
+    def _post(self, url: str, user: str, data: Dict) -> requests.Response:
+        response = self.session.post(url, json=data, headers=self._auth_header(user), timeout=self.timeout)
+        if response.status_code == 401:
+            # the credentials may have been changed since they were cached
+            self._credentials.pop(user, None)
+            response = self.session.post(url, json=data, headers=self._auth_header(user), timeout=self.timeout)
+        return response
+
+    def requeue_due_retries(self) -> None:
+        """Move records whose backoff has expired from the retry queue back to the callback queue"""
+        due = self.conn.zrangebyscore(RETRY_QUEUE, "-inf", time.time(), start=0, num=self.batch_size)
+        for record in due:
+            # only the process that removes the record from the retry queue requeues it
+            if self.conn.zrem(RETRY_QUEUE, record):
+                self.conn.rpush(CALLBACK_QUEUE, record)
+
+    def recover(self) -> int:
+        """
+        Move records that a previous sender left in the processing queue back to the front of the callback queue.
+        Return the number of records that were moved.
+        """
+        count = 0
+        while self.conn.lmove(PROCESSING_QUEUE, CALLBACK_QUEUE, "RIGHT", "LEFT") is not None:
+            count += 1
+        return count
+
+    @staticmethod
+    def _parse(raw: bytes) -> Optional[CallbackRecord]:
+        """Return the record encoded by raw or None if raw is not a valid record"""
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            return None
+        if not isinstance(record, dict) or not {"url", "user", "attempts", "data"}.issubset(record):
+            return None
+        return record
+
+    def pop_batch(self, timeout: int) -> List[Tuple[bytes, CallbackRecord]]:
+        """
+        Move up to batch_size records from the callback queue to the processing queue, waiting up to timeout seconds
+        for the first one. Return each record along with its raw value in the processing queue.
+
+        Records that are not valid are moved to the dead letter queue instead.
+        """
+        first = self.conn.blmove(CALLBACK_QUEUE, PROCESSING_QUEUE, timeout, "LEFT", "RIGHT")
+        if first is None:
+            return []
+        raw_records = [first]
+        if self.batch_size > 1:
+            with self.conn.pipeline() as pipe:
+                for _ in range(self.batch_size - 1):
+                    pipe.lmove(CALLBACK_QUEUE, PROCESSING_QUEUE, "LEFT", "RIGHT")
+                raw_records.extend(raw for raw in pipe.execute() if raw is not None)
+        records = []
+        with self.conn.pipeline() as pipe:
+            for raw in raw_records:
+                record = self._parse(raw)
+                if record is None:
+                    pipe.lrem(PROCESSING_QUEUE, 1, raw)
+                    pipe.rpush(DEAD_LETTER_QUEUE, raw)
+                else:
+                    records.append((raw, record))
+            pipe.execute()
+        return records
+
+    def send(self, url: str, user: str, records: List[CallbackRecord]) -> Optional[str]:
+        """
+        Send the data in records to url in a single request. Return None on success or an error message otherwise.
+        """
+        try:
+            response = self._post(url, user, {"test_results": [record["data"] for record in records]})
+            response.raise_for_status()
+        except requests.RequestException as e:
+            return str(e)
+        return None
+
+    def ack(self, records: List[Tuple[bytes, CallbackRecord]]) -> None:
+        """Remove records that have been delivered from the processing queue"""
+        with self.conn.pipeline() as pipe:
+            for raw, _ in records:
+                pipe.lrem(PROCESSING_QUEUE, 1, raw)
+            pipe.execute()
+
+    def fail(self, records: List[Tuple[bytes, CallbackRecord]], error: str) -> None:
+        """
+        Remove records from the processing queue and schedule a retry for each record or move it to the dead letter
+        queue if it has no attempts left.
+        """
+        with self.conn.pipeline() as pipe:
+            for raw, record in records:
+                pipe.lrem(PROCESSING_QUEUE, 1, raw)
+                record["attempts"] += 1
+                record["error"] = error
+                if record["attempts"] >= self.max_attempts:
+                    pipe.rpush(DEAD_LETTER_QUEUE, json.dumps(record))
+                else:
+                    retry_at = time.time() + self.backoff ** record["attempts"]
+                    pipe.zadd(RETRY_QUEUE, {json.dumps(record): retry_at})
+            pipe.execute()
+
+    def deliver(self, timeout: int = 1) -> int:
+        """
+        Deliver the next batch of records, waiting up to timeout seconds for records to arrive.
+        Return the number of records that were processed.
+        """
+        self.requeue_due_retries()
+        records = self.pop_batch(timeout)
+        batches: Dict[Tuple[str, str], List[Tuple[bytes, CallbackRecord]]] = defaultdict(list)
+        for raw, record in records:
+            batches[(record["url"], record["user"])].append((raw, record))
+        for (url, user), batch in batches.items():
+            error = self.send(url, user, [record for _, record in batch])
+            if error is None:
+                self.ack(batch)
+            else:
+                self.fail(batch, error)
+        return len(records)
+
+    def run(self) -> None:
+        """Recover records left by a previous sender and then deliver records forever"""
+        while True:
+            try:
+                self.recover()
+                break
+            except redis.RedisError:
+                traceback.print_exc()
+                time.sleep(1)
+        while True:
+            try:
+                self.deliver()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    redis_conn = redis.Redis.from_url(
+        config["redis_url"],
+        retry=Retry(FullJitterBackoff(cap=10, base=1), 25),
+        retry_on_error=[ConnectionError, TimeoutError],
+        health_check_interval=1,
+    )
+    CallbackSender(redis_conn, **callback_settings()).run()
@@ -0,0 +1,145 @@
+"""
+Download files from clients (student submissions and test script files) over a pooled HTTP session.
+
+Each worker process keeps a single Downloader (see downloader) whose session keeps connections to the client alive
+between jobs and retries requests that fail to connect or that fail with a temporary server error. Downloads are
+streamed to a spooled temporary file (kept in memory up to spool_size bytes) and abandoned if they are larger than
+max_size bytes. The credentials of each client are read from the redis database at most once every credentials_ttl
+seconds.
+
+Connections and credentials are only reused between jobs if the worker runs its jobs in the worker process itself,
+which is what workers do when their fork setting is false. A worker that forks a new process for each job (the
+default) starts each job with a new session and an empty credentials cache.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Dict, IO, Optional, Tuple
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import config
+
+CREDENTIALS_KEY = "autotest:user_credentials"
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+def download_settings() -> Dict:
+    """Return the download settings from the config file, with defaults filled in"""
+    return {
+        "timeout": 30,
+        "retries": 3,
+        "max_size": 1024**3,
+        "spool_size": 16 * 1024**2,
+        "credentials_ttl": 300,
+        "pool_size": 4,
+        **config.get("downloads", {}),
+    }
+
+
+class Downloader:
+    def __init__(
+        self,
+        conn: redis.Redis,
+        timeout: float = 30,
+        retries: int = 3,
+        max_size: int = 1024**3,
+        spool_size: int = 16 * 1024**2,
+        credentials_ttl: float = 300,
+        pool_size: int = 4,
+    ) -> None:
+        """
+        Initialize a downloader that authenticates with the client credentials found in the redis database that conn
+        connects to.
+
+        Requests that fail to connect or that get a 502, 503 or 504 response are retried up to retries times with an
+        exponential backoff. Connections are kept alive and reused with a pool of up to pool_size connections per host.
+        """
+        self.conn = conn
+        self.timeout = timeout
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.credentials_ttl = credentials_ttl
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods={"GET"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._credentials: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+    def _auth_header(self, user: str) -> Dict[str, str]:
+        """Return the authorization header for requests to the client of user"""
+        expires, header = self._credentials.get(user, (0, {}))
+        if expires <= time.monotonic():
+            creds = self.conn.hget(CREDENTIALS_KEY, key=user)
+            if creds is None:
+                raise DownloadError(f"no credentials found for user {user}")
+            creds = json.loads(creds)
+            header = {"Authorization": f"{creds.get('auth_type')} {creds.get('credentials')}"}
+            self._credentials[user] = (time.monotonic() + self.credentials_ttl, header)
+        return header
+
+    def _get(self, user: str, url: str) -> requests.Response:
+        response = self.session.get(url, headers=self._auth_header(user), timeout=self.timeout, stream=True)
+        if response.status_code == 401:
+            # the credentials may have been changed since they were cached
+            response.close()
+            self._credentials.pop(user, None)
+            response = self.session.get(url, headers=self._auth_header(user), timeout=self.timeout, stream=True)
+        return response
+
+    def download(self, user: str, url: str) -> Tuple[IO[bytes], str]:
+        """
+        Download the file at url using the credentials of user. Return a temporary file containing the content of the
+        file (positioned at the start of the file) and the sha256 hash of the content.
+
+        Raise a DownloadError if there are no credentials for user, if the request fails or if the file is larger than
+        max_size bytes.
+        """
+        too_large = f"{url} is larger than the maximum download size ({self.max_size} bytes)"
+        file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        hash_ = hashlib.sha256()
+        try:
+            with self._get(user, url) as response:
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length") or 0) > self.max_size:
+                    raise DownloadError(too_large)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if file.tell() + len(chunk) > self.max_size:
+                        raise DownloadError(too_large)
+                    hash_.update(chunk)
+                    file.write(chunk)
+        except requests.RequestException as e:
+            file.close()
+            raise DownloadError(f"failed to download {url}: {e}") from e
+        except DownloadError:
+            file.close()
+            raise
+        file.seek(0)
+        return file, hash_.hexdigest()
+
+
+_DOWNLOADER: Optional[Downloader] = None
+_DOWNLOADER_PID: Optional[int] = None
+
+
+def downloader(conn: redis.Redis) -> Downloader:
+    """
+    Return the downloader of this process. A new one is created in a forked process so that connections are never
+    shared between processes.
+    """
+    global _DOWNLOADER, _DOWNLOADER_PID
+    if _DOWNLOADER is None or _DOWNLOADER_PID != os.getpid():
+        _DOWNLOADER = Downloader(conn, **download_settings())
+        _DOWNLOADER_PID = os.getpid()
+    return _DOWNLOADER
@@ -0,0 +1,185 @@
+"""
+Share the workers fairly between the users (api keys) that enqueue batches of tests.
+
+The API puts the jobs of each batch in a separate batch queue for each user (see batch_queue_name) and records the
+name of that queue in the BATCH_QUEUES_KEY set. FairShareWorker replaces the 'batch' queue in its list of queues by
+these queues, ordered with stride scheduling: every time a job is taken from a user's queue, that user's pass is
+advanced by 1 / weight and the queue with the lowest pass is served next. A user that starts enqueueing tests again
+after being idle starts at the current pass of the busiest users so that it cannot claim the workers for itself to
+make up for the time it was idle. Users that are already running max_concurrent jobs are skipped.
+
+The worker also counts the jobs it takes from each queue per minute (see drain_key) so that the API can tell clients
+when to retry once a queue is full.
+
+Start the workers with:
+
+    rq worker --worker-class autotest_server.fair_share.FairShareWorker ...
+
+or use FairShareSimpleWorker to run each job in the worker process itself instead of in a forked work horse.
+"""
+
+import hashlib
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import rq
+from rq.registry import clean_registries
+
+from .config import config
+
+BATCH_QUEUE = "batch"
+BATCH_QUEUES_KEY = "autotest:batch_queues"
+PASS_KEY = "autotest:batch_pass"
+VIRTUAL_TIME_KEY = "autotest:batch_virtual_time"
+DRAIN_KEY_TTL = 600
+
+
+def batch_queue_name(user: str) -> str:
+    """
+    Return the name of the batch queue of user. The name contains a hash of the api key so that the key itself does
+    not appear in queue names.
+    """
+    return f"{BATCH_QUEUE}:{hashlib.sha256(user.encode()).hexdigest()[:16]}"
+
+
+def drain_key(queue_name: str, minute: int) -> str:
+    """
+    Return the key of the number of jobs dequeued from the queue named queue_name during minute (minutes since the
+    epoch). The API uses these to estimate when a full queue will have room for more jobs.
+    """
+    return f"autotest:drained:{queue_name}:{minute}"
+
+
+def fair_share_settings() -> Dict:
+    """Return the fair share settings from the config file, with defaults filled in"""
+    return {"weight": 1, "max_concurrent": 0, "poll_interval": 5, "users": {}, **config.get("fair_share", {})}
+
+
+class FairShareWorker(rq.Worker):
+    def __init__(self, *args, **kwargs) -> None:
+        """
+        Initialize an rq worker that serves the batch queue of each user fairly in place of the 'batch' queue.
+
+        The weight and max_concurrent settings of each user are read from the fair_share config settings.
+        """
+        super().__init__(*args, **kwargs)
+        settings = fair_share_settings()
+        self.poll_interval = settings["poll_interval"]
+        self.default_share = (settings["weight"], settings["max_concurrent"])
+        self.shares = {
+            batch_queue_name(user): (data.get("weight", settings["weight"]), data.get("max_concurrent", settings["max_concurrent"]))
+            for user, data in settings["users"].items()
+        }
+        self._batch_queues: Dict[str, rq.Queue] = {}
+
+    @property
+    def serves_batch(self) -> bool:
+        return BATCH_QUEUE in self.queue_names()
+
+    def _queue(self, name: str) -> rq.Queue:
+        if name not in self._batch_queues:
+            self._batch_queues[name] = self.queue_class(
+                name,
+                connection=self.connection,
+                job_class=self.job_class,
+                serializer=self.serializer,
+                death_penalty_class=self.death_penalty_class,
+            )
+        return self._batch_queues[name]
+
+    def batch_queues(self) -> List[rq.Queue]:
+        """Return the batch queues of all users"""
+        return [self._queue(name.decode()) for name in sorted(self.connection.smembers(BATCH_QUEUES_KEY))]
+
+    def fair_share_order(self) -> List[rq.Queue]:
+        """
+        Return the batch queues that can be served now: queues that contain jobs first, each group ordered by the
+        pass of its user.
+        """
+        queues = self.batch_queues()
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.get(VIRTUAL_TIME_KEY)
+            pipe.hmget(PASS_KEY, [queue.name for queue in queues] or [""])
+            for queue in queues:
+                pipe.llen(queue.key)
+                pipe.zcard(queue.started_job_registry.key)
+            virtual_time, passes, *counts = pipe.execute()
+        virtual_time = float(virtual_time or 0)
+        order: List[Tuple[bool, float, str, rq.Queue]] = []
+        for queue, pass_, length, running in zip(queues, passes, counts[::2], counts[1::2]):
+            _weight, max_concurrent = self.shares.get(queue.name, self.default_share)
+            if max_concurrent and running >= max_concurrent:
+                continue
+            order.append((not length, max(float(pass_ or 0), virtual_time), queue.name, queue))
+        return [queue for *_, queue in sorted(order)]
+
+    def ordered_queues(self) -> List[rq.Queue]:
+        """Return this worker's queues with the 'batch' queue followed by the batch queues of all users in its place"""
+        queues = []
+        for queue in self.queues:
+            queues.append(queue)
+            if queue.name == BATCH_QUEUE:
+                queues.extend(self.fair_share_order())
+        return queues
+
+    def dequeue_job_and_maintain_ttl(
+        self, timeout: Optional[int], max_idle_time: Optional[int] = None
+    ) -> Optional[Tuple[rq.job.Job, rq.Queue]]:
+        """
+        Dequeue a job from this worker's queues in fair share order.
+
+        The order is recalculated at least every poll_interval seconds while waiting for a job so that new batch
+        queues and users that are no longer at their max_concurrent limit are picked up.
+        """
+        if not self.serves_batch or timeout is None:
+            self._ordered_queues = self.ordered_queues()
+            return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+        deadline = None if max_idle_time is None else time.monotonic() + max_idle_time
+        while True:
+            self._ordered_queues = self.ordered_queues()
+            idle_time = self.poll_interval
+            if deadline is not None:
+                idle_time = max(1, min(idle_time, math.ceil(deadline - time.monotonic())))
+            result = super().dequeue_job_and_maintain_ttl(timeout, idle_time)
+            if result is not None or (deadline is not None and time.monotonic() >= deadline):
+                return result
+
+    def reorder_queues(self, reference_queue: rq.Queue) -> None:
+        """
+        Count a job dequeued from reference_queue towards its queue's drain rate and, if reference_queue is a user's
+        batch queue, advance the pass of that user.
+        """
+        is_batch = reference_queue.name.startswith(f"{BATCH_QUEUE}:")
+        key = drain_key(BATCH_QUEUE if is_batch else reference_queue.name, int(time.time() // 60))
+        if is_batch:
+            weight, _max_concurrent = self.shares.get(reference_queue.name, self.default_share)
+            with self.connection.pipeline(transaction=False) as pipe:
+                pipe.get(VIRTUAL_TIME_KEY)
+                pipe.hget(PASS_KEY, reference_queue.name)
+                virtual_time, pass_ = pipe.execute()
+            current = max(float(pass_ or 0), float(virtual_time or 0))
+        with self.connection.pipeline() as pipe:
+            pipe.incr(key)
+            pipe.expire(key, DRAIN_KEY_TTL)
+            if is_batch:
+                pipe.hset(PASS_KEY, reference_queue.name, current + 1 / weight)
+                pipe.set(VIRTUAL_TIME_KEY, current)
+            pipe.execute()
+
+    def clean_registries(self) -> None:
+        """Run maintenance jobs on the registries of this worker's queues and of the batch queues of all users"""
+        super().clean_registries()
+        if not self.serves_batch:
+            return
+        for queue in self.batch_queues():
+            if queue.acquire_maintenance_lock():
+                clean_registries(queue, self._exc_handlers)
+                queue.release_maintenance_lock()
+
+
+class FairShareSimpleWorker(FairShareWorker, rq.SimpleWorker):
+    """
+    A FairShareWorker that runs jobs in the worker process itself so that state such as open HTTP connections is kept
+    from one job to the next.
+    """
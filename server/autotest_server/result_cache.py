@@ -0,0 +1,95 @@
+"""
+Reuse the results of test runs that have already been run with identical inputs.
+
+Settings opt in to caching with the cache_results setting. The results of a test run are cached under a hash of
+everything that determines them: the settings they were run with (their id, since the test files are not part of the
+settings body), the submission archive, the settings body (its etag) and environment (its version), the requested
+categories and the environment variables sent by the client. Feedback files are cached with the
+results so that they can be stored again for the new test run.
+
+Entries expire ttl seconds after they were last stored or used and the least recently used entries are evicted when
+there are more than max_entries of them. Cache hits and misses are counted in the metrics hash.
+"""
+
+import gzip
+import hashlib
+import json
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import redis
+
+from .config import config
+
+INDEX_KEY = "autotest:result_cache_index"
+METRICS_KEY = "autotest:metrics"
+
+
+def result_cache_settings() -> Dict:
+    """Return the result cache settings from the config file, with defaults filled in"""
+    return {"ttl": 86400, "max_entries": 10000, **config.get("result_cache", {})}
+
+
+def entry_key(key: str) -> str:
+    return f"autotest:result_cache:{key}"
+
+
+def cache_key(
+    settings_id: Union[int, str],
+    archive_hash: str,
+    etag: str,
+    version: str,
+    categories: List[str],
+    test_env_vars: Dict[str, str],
+) -> str:
+    """Return the key of the results of a test run with these inputs"""
+    data = json.dumps(
+        [str(settings_id), archive_hash, etag, version, sorted(categories), test_env_vars], sort_keys=True
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get(conn: redis.Redis, key: str) -> Optional[Tuple[List[Dict], Dict[str, bytes]]]:
+    """
+    Return the cached test group results stored under key and the content of their feedback files (indexed by
+    the id of each feedback file in the results) or None if there is no such entry.
+    """
+    entry = conn.hgetall(entry_key(key))
+    with conn.pipeline(transaction=False) as pipe:
+        if entry:
+            # the score of an entry in the index and its ttl are both counted from when it was last used
+            pipe.expire(entry_key(key), result_cache_settings()["ttl"])
+            pipe.zadd(INDEX_KEY, {key: time.time()})
+        pipe.hincrby(METRICS_KEY, "result_cache_hits" if entry else "result_cache_misses", 1)
+        pipe.execute()
+    if not entry:
+        return None
+    results = json.loads(gzip.decompress(entry.pop(b"results")))
+    feedback = {field.decode().split(":", 1)[1]: data for field, data in entry.items()}
+    return results, feedback
+
+
+def put(conn: redis.Redis, key: str, results: List[Dict], feedback: Dict[str, bytes]) -> None:
+    """
+    Cache results and the content of their feedback files (indexed by the id of each feedback file in the results)
+    under key, then evict the least recently used entries if the cache is full.
+    """
+    settings = result_cache_settings()
+    now = time.time()
+    with conn.pipeline() as pipe:
+        pipe.hset(
+            entry_key(key),
+            mapping={
+                "results": gzip.compress(json.dumps(results).encode(), mtime=0),
+                **{f"feedback:{id_}": data for id_, data in feedback.items()},
+            },
+        )
+        pipe.expire(entry_key(key), settings["ttl"])
+        pipe.zadd(INDEX_KEY, {key: now})
+        # entries that have expired no longer need to be evicted
+        pipe.zremrangebyscore(INDEX_KEY, "-inf", now - settings["ttl"])
+        pipe.zcard(INDEX_KEY)
+        *_, size = pipe.execute()
+    if size > settings["max_entries"]:
+        evicted = conn.zpopmin(INDEX_KEY, size - settings["max_entries"])
+        conn.delete(*(entry_key(k.decode()) for k, _ in evicted))
@@ -0,0 +1,135 @@
+"""
+Read and write test settings in redis.
+
+The settings body (the tester configuration uploaded by the client, plus the details of the environments created
+for it) is stored as json in the autotest:settings hash. Metadata that is read or updated on every request or
+test run is stored separately in a small hash for each settings (autotest:settings_meta:<settings_id>) so that it
+can be read and updated with single field operations:
+
+    user, env_status, last_access, error, files: see META_FIELDS
+    timeout: the sum of the timeouts of all test groups (computed when the body is written)
+    groups: a json list of the categories and timeout of each test group (computed when the body is written)
+    version: incremented every time the body is written
+    etag: a hash of the body (computed when the body is written)
+
+The time taken to run each test group is recorded in autotest:runtimes:<settings_id> (see runtimes_key) and is
+cleared whenever the body is written.
+
+Settings written by older versions stored this metadata in the body itself (as _user, _env_status, etc.). These
+settings are migrated the first time their metadata is read.
+
+The API uses the same layout (see autotest_client/settings_store.py).
+"""
+
+import hashlib
+import json
+from typing import Dict, List, Optional, Tuple, Union
+
+import redis
+
+SETTINGS_KEY = "autotest:settings"
+META_FIELDS = ("user", "env_status", "last_access", "error", "files", "timeout", "groups")
+
+SettingsId = Union[int, str]
+
+
+def meta_key(settings_id: SettingsId) -> str:
+    """Return the key of the metadata hash of the settings with id settings_id"""
+    return f"autotest:settings_meta:{settings_id}"
+
+
+def runtimes_key(settings_id: SettingsId) -> str:
+    """
+    Return the key of the hash containing the total run time (<index>:total) and the number of runs (<index>:count)
+    of each test group of the settings with id settings_id, where index is the position of the test group in the list
+    returned by test_groups.
+    """
+    return f"autotest:runtimes:{settings_id}"
+
+
+def _decode(value: Optional[Union[bytes, str]]) -> Optional[str]:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def settings_timeout(body: Dict) -> int:
+    """Return the sum of the timeouts of all test data in the settings body"""
+    return sum(data.get("timeout", 0) for tester in body.get("testers", []) for data in tester.get("test_data", []))
+
+
+def test_groups(body: Dict) -> List[Tuple[List[str], int]]:
+    """Return the categories and timeout of each test group (test data) of all testers in the settings body"""
+    return [
+        (data.get("category", []), data.get("timeout", 0))
+        for tester in body.get("testers", [])
+        for data in tester.get("test_data", [])
+    ]
+
+
+def requested_groups(groups: List[Tuple[List[str], int]], categories: List[str]) -> List[int]:
+    """Return the indices of the test groups in groups that are run when tests in categories are requested"""
+    return [i for i, (group_categories, _timeout) in enumerate(groups) if set(group_categories) & set(categories)]
+
+
+def split_metadata(body: Dict) -> Tuple[Dict, Dict]:
+    """
+    Return a copy of body without the metadata keys that older versions stored in it, and a dictionary containing
+    the metadata fields of those keys.
+    """
+    meta_keys = {f"_{field}": field for field in META_FIELDS}
+    meta = {meta_keys[k]: v for k, v in body.items() if k in meta_keys and v is not None}
+    return {k: v for k, v in body.items() if k not in meta_keys}, meta
+
+
+def migrate_settings(conn: redis.Redis, settings_id: SettingsId) -> bool:
+    """
+    Move the metadata of settings written by an older version from their body into their metadata hash.
+    Return False if these settings do not exist.
+    """
+
+    def _migrate(pipe: redis.client.Pipeline) -> bool:
+        if pipe.hexists(meta_key(settings_id), "user"):
+            return True
+        body = pipe.hget(SETTINGS_KEY, settings_id)
+        if body is None:
+            return False
+        body, meta = split_metadata(json.loads(body))
+        pipe.multi()
+        write_settings(pipe, settings_id, body, meta)
+        return True
+
+    return conn.transaction(_migrate, SETTINGS_KEY, meta_key(settings_id), value_from_callable=True)
+
+
+def get_metadata(conn: redis.Redis, settings_id: SettingsId, *fields: str) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Return a dictionary mapping each field in fields to its value in the metadata of the settings with id
+    settings_id (or None if that field is not set). Return None if these settings do not exist.
+    """
+    user, *values = conn.hmget(meta_key(settings_id), ["user", *fields])
+    if user is None:
+        if not migrate_settings(conn, settings_id):
+            return None
+        user, *values = conn.hmget(meta_key(settings_id), ["user", *fields])
+    return {field: _decode(value) for field, value in zip(fields, values)}
+
+
+def write_settings(
+    pipe: redis.client.Pipeline, settings_id: SettingsId, body: Dict, meta: Dict, delete: Tuple[str, ...] = ()
+) -> None:
+    """
+    Queue the commands on pipe that replace the body of the settings with id settings_id, set the metadata fields in
+    meta, delete the metadata fields in delete, and increment the version of these settings.
+    """
+    data = json.dumps(body)
+    meta = {
+        **meta,
+        "timeout": settings_timeout(body),
+        "groups": json.dumps(test_groups(body)),
+        "etag": hashlib.sha256(data.encode()).hexdigest(),
+    }
+    pipe.hset(SETTINGS_KEY, settings_id, data)
+    pipe.hset(meta_key(settings_id), mapping=meta)
+    if delete:
+        pipe.hdel(meta_key(settings_id), *delete)
+    pipe.hincrby(meta_key(settings_id), "version", 1)
+    pipe.delete(runtimes_key(settings_id))
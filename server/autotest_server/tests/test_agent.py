@@ -0,0 +1,155 @@
+import getpass
+import json
+import os
+import socket
+import stat
+import subprocess
+import sys
+
+import pytest
+
+from autotest_server import agent
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = agent.AgentClient(getpass.getuser(), str(tmp_path / "agent"))
+    yield client
+    client.stop()
+
+
+class TestAgentClient:
+    def test_started_on_demand(self, client):
+        assert not os.path.exists(client.socket_path)
+        proc = client.spawn("true", "/", {})
+        proc.communicate()
+        assert stat.S_ISSOCK(os.stat(client.socket_path).st_mode)
+
+    def test_socket_private(self, client):
+        client.spawn("true", "/", {}).communicate()
+        assert stat.S_IMODE(os.stat(client.socket_dir).st_mode) == 0o700
+        assert stat.S_IMODE(os.stat(client.socket_path).st_mode) == 0o600
+
+    def test_other_listener_replaced(self, client):
+        # a process that takes the place of a stopped agent is never sent requests
+        client.spawn("true", "/", {}).communicate()
+        client.stop()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as other:
+            other.bind(client.socket_path)
+            other.listen()
+            other.settimeout(1)
+            out, _ = client.spawn("echo ok", "/", {}).communicate()
+            conn, _ = other.accept()
+            with conn:
+                assert conn.recv(agent.MAX_MESSAGE_SIZE) == b""
+        assert out == "ok\n"
+        assert client._pid() != os.getpid()
+
+    def test_restarted(self, client):
+        client.spawn("true", "/", {}).communicate()
+        client.stop()
+        out, _ = client.spawn("echo ok", "/", {}).communicate()
+        assert out == "ok\n"
+
+    def test_spawn(self, client, tmp_path):
+        proc = client.spawn('cat; echo "$VAR" >&2; pwd', str(tmp_path), {"VAR": "value"})
+        out, err = proc.communicate(input="input\n")
+        assert out == f"input\n{tmp_path}\n"
+        assert err == "value\n"
+        assert proc.returncode == 0
+
+    def test_return_code(self, client):
+        proc = client.spawn("exit 3", "/", {})
+        proc.communicate()
+        assert proc.returncode == 3
+
+    def test_timeout(self, client):
+        proc = client.spawn("sleep 0.5; echo done", "/", {})
+        with pytest.raises(subprocess.TimeoutExpired):
+            proc.communicate(timeout=0.05)
+        assert proc.communicate() == ("done\n", "")
+
+    def test_spawn_error(self, client):
+        with pytest.raises(agent.AgentError):
+            client.spawn("true", "/does/not/exist", {})
+
+    def test_clean(self, client, tmp_path):
+        tests_path = tmp_path / "tests"
+        (tests_path / "dir").mkdir(parents=True)
+        (tmp_path / "tmp").mkdir()
+        (tests_path / "dir" / "file").write_text("")
+        os.chmod(tests_path / "dir" / "file", 0o100)
+        os.chmod(tests_path / "dir", 0o1000)
+        client.clean(str(tests_path), str(tmp_path / "tmp"))
+        assert stat.S_IMODE(os.stat(tests_path / "dir").st_mode) == 0o777
+        assert stat.S_IMODE(os.stat(tests_path / "dir" / "file").st_mode) == 0o777
+
+    def test_clean_tmp(self, client, tmp_path):
+        tmp_dir = tmp_path / "tmp"
+        (tmp_dir / "dir").mkdir(parents=True)
+        (tmp_dir / "file").write_text("")
+        client.clean(str(tmp_path / "tests"), str(tmp_dir))
+        assert os.listdir(tmp_dir) == []
+
+    def test_unknown_command(self, client):
+        with pytest.raises(agent.AgentError, match="unknown command"):
+            client._call({"command": "other"})
+
+
+class TestZygote:
+    @pytest.fixture
+    def tests_path(self, tmp_path):
+        tests_path = tmp_path / "tests"
+        tests_path.mkdir()
+        script = tests_path / "run.sh"
+        script.write_text('#!/bin/bash\necho "$VAR $(pwd)"\n')
+        script.chmod(0o755)
+        return tests_path
+
+    def _zygote(self, client, version="1"):
+        return client.zygote("1-0", version, sys.executable, "custom", [], {}, idle_timeout=60)
+
+    def _fork(self, client, zygote_socket, tests_path, value="value"):
+        proc = client.fork(zygote_socket, str(tests_path), {"VAR": value, "PATH": os.environ["PATH"]})
+        out, err = proc.communicate(input=json.dumps({"test_data": {"script_files": ["run.sh"]}}))
+        return proc, out, err
+
+    def test_fork(self, client, tests_path):
+        proc, out, err = self._fork(client, self._zygote(client), tests_path)
+        assert out == f"value {tests_path}\n"
+        assert proc.returncode == 0
+
+    def test_reused(self, client, tests_path):
+        zygote_socket = self._zygote(client)
+        assert self._zygote(client) == zygote_socket
+        pids = {self._fork(client, zygote_socket, tests_path, str(i))[0].pid for i in range(3)}
+        assert len(pids) == 3
+
+    def test_new_version(self, client, tests_path):
+        zygote_socket = self._zygote(client)
+        conn = agent._connect(zygote_socket)
+        self._zygote(client, version="2")
+        # the zygote of the old version was stopped
+        assert conn.recv(1) == b""
+        assert self._fork(client, zygote_socket, tests_path)[1] == f"value {tests_path}\n"
+
+    def test_start_error(self, client):
+        with pytest.raises(agent.AgentError, match="did not start"):
+            client.zygote("1-0", "1", sys.executable, "not_a_tester", [], {}, idle_timeout=60)
+
+    def test_other_listener_not_used(self, client, tests_path):
+        zygote_socket = self._zygote(client)
+        os.remove(zygote_socket)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as other:
+            other.bind(zygote_socket)
+            other.listen()
+            with pytest.raises(agent.AgentError, match="not running"):
+                self._fork(client, zygote_socket, tests_path)
+            # a new zygote is started in place of the other listener
+            assert self._zygote(client) == zygote_socket
+        assert self._fork(client, zygote_socket, tests_path)[1] == f"value {tests_path}\n"
+
+
+class TestRealUid:
+    def test_current_process(self):
+        assert agent._real_uid(os.getpid()) == os.getuid()
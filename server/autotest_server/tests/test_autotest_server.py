@@ -8,6 +8,11 @@ import os
 import unittest
 from unittest.mock import patch, MagicMock
 import json
+import gzip
+import getpass
+import grp
+import stat
+import time
 
 
 @pytest.fixture
@@ -118,8 +123,8 @@ class TestRunTest(unittest.TestCase):
         mock_redis.return_value = mock_redis_instance
 
         error_message = "Invalid configuration"
-        mock_settings = {"_error": error_message}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_redis_instance.hmget.return_value = [b"test_user", None, error_message.encode()]
+        mock_redis_instance.pipeline.return_value.__enter__.return_value.execute.return_value = [1, json.dumps({})]
 
         autotest_server.run_test(
             settings_id="test_settings_id",
@@ -144,8 +149,8 @@ class TestRunTest(unittest.TestCase):
         mock_redis_instance = MagicMock()
         mock_redis.return_value = mock_redis_instance
 
-        mock_settings = {"_env_status": "error"}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_redis_instance.hmget.return_value = [b"test_user", b"error", None]
+        mock_redis_instance.pipeline.return_value.__enter__.return_value.execute.return_value = [1, json.dumps({})]
 
         autotest_server.run_test(
             settings_id="test_settings_id",
@@ -172,7 +177,12 @@ class TestRunTest(unittest.TestCase):
         mock_redis.return_value = mock_redis_instance
 
         mock_settings = {"key": "value"}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_redis_instance.hmget.return_value = [b"test_user", b"ready", None]
+        mock_redis_instance.exists.return_value = 0
+        mock_redis_instance.pipeline.return_value.__enter__.return_value.execute.return_value = [
+            1,
+            json.dumps(mock_settings),
+        ]
 
         # `tester_user` is a function that gets called after we assert that settings don't have an error.
         # We add an exception to this call to check the correct error value in the result.
@@ -196,3 +206,210 @@ class TestRunTest(unittest.TestCase):
         self.assertIsNotNone(result_dict["error"])
         self.assertIn("Traceback", result_dict["error"])
         self.assertIn("Unexpected error", result_dict["error"])
+
+
+class TestPublishStatus:
+    @pytest.fixture
+    def pubsub(self, fake_redis_conn):
+        pubsub = fake_redis_conn.pubsub()
+        pubsub.subscribe("autotest:events:1")
+        assert pubsub.get_message(timeout=1)["type"] == "subscribe"
+        yield pubsub
+        pubsub.close()
+
+    def test_message_published(self, pubsub):
+        autotest_server._publish_status(1, 2, "finished")
+        message = pubsub.get_message(timeout=1)
+        assert json.loads(message["data"]) == {"test_id": 2, "status": "finished"}
+
+    @patch("autotest_server.tester_user")
+    def test_run_test_publishes_status(self, mock_tester_user, fake_redis_conn, pubsub):
+        fake_redis_conn.hset("autotest:settings", key=1, value=json.dumps({}))
+        fake_redis_conn.hset("autotest:settings_meta:1", mapping={"user": "test_user", "env_status": "ready"})
+        mock_tester_user.side_effect = Exception("Unexpected error")
+        autotest_server.run_test(
+            settings_id=1, test_id=2, files_url="", categories=[], user="test_user", test_env_vars={}
+        )
+        messages = [json.loads(pubsub.get_message(timeout=1)["data"]) for _ in range(2)]
+        assert messages == [{"test_id": 2, "status": "started"}, {"test_id": 2, "status": "finished"}]
+
+
+class TestGetFeedback:
+    @pytest.fixture
+    def feedback(self, tmp_path):
+        (tmp_path / "feedback.html").write_text("<p>feedback</p>")
+        return autotest_server._get_feedback({"feedback_file_names": ["feedback.html", "missing.txt"]}, tmp_path, 5)
+
+    def test_feedback_stored(self, feedback, fake_redis_conn):
+        (info,), _ = feedback
+        assert gzip.decompress(fake_redis_conn.get(f"autotest:feedback_file:5:{info['id']}")) == b"<p>feedback</p>"
+
+    def test_feedback_info(self, feedback):
+        (info,), _ = feedback
+        assert info == {"filename": "feedback.html", "mime_type": "text/html", "compression": "gzip", "id": 1}
+
+    def test_feedback_indexed(self, feedback, fake_redis_conn):
+        assert json.loads(fake_redis_conn.hget("autotest:feedback_files:5", 1)) == {
+            "filename": "feedback.html",
+            "mime_type": "text/html",
+        }
+
+    def test_missing_feedback(self, feedback):
+        _, errors = feedback
+        assert errors == ["missing.txt"]
+
+    def test_feedback_counted(self, feedback, fake_redis_conn):
+        (info,), _ = feedback
+        size = len(fake_redis_conn.get(f"autotest:feedback_file:5:{info['id']}"))
+        assert fake_redis_conn.hmget("autotest:metrics", "feedback_files_stored", "feedback_bytes") == [
+            b"1",
+            str(size).encode(),
+        ]
+
+
+class TestRecordRuntimes:
+    @pytest.fixture
+    def settings(self):
+        return {
+            "testers": [
+                {"test_data": [{"category": ["instructor"]}, {"category": ["student"]}, {"category": ["instructor"]}]}
+            ]
+        }
+
+    def _result(self, time_, stderr=None):
+        return autotest_server._create_test_group_result("", stderr, time_, {}, [])
+
+    def test_recorded(self, fake_redis_conn, settings):
+        for _ in range(2):
+            autotest_server._record_runtimes(1, settings, ["instructor"], [self._result(1500), self._result(500)])
+        assert fake_redis_conn.hgetall("autotest:runtimes:1") == {
+            b"0:total": b"3",
+            b"0:count": b"2",
+            b"2:total": b"1",
+            b"2:count": b"2",
+        }
+
+    def test_cancelled_not_recorded(self, fake_redis_conn, settings):
+        results = [self._result(1500), self._result(10, autotest_server.CANCELLED_MESSAGE)]
+        autotest_server._record_runtimes(1, settings, ["instructor"], results)
+        assert set(fake_redis_conn.hkeys("autotest:runtimes:1")) == {b"0:total", b"0:count"}
+
+
+class TestCachedResults:
+    @pytest.fixture
+    def results(self):
+        feedback = autotest_server._store_feedback_file(1, "out.txt", "text/plain", gzip.compress(b"feedback"))
+        return [autotest_server._create_test_group_result("", None, 100, {}, [feedback])]
+
+    def test_feedback_stored_for_new_test(self, fake_redis_conn, results):
+        autotest_server._cache_results("key", 1, results)
+        (cached,) = autotest_server._cached_results("key", 2)
+        (info,) = cached["feedback"]
+        assert gzip.decompress(fake_redis_conn.get(f"autotest:feedback_file:2:{info['id']}")) == b"feedback"
+        assert fake_redis_conn.hexists("autotest:feedback_files:2", info["id"])
+
+    def test_miss(self, fake_redis_conn):
+        assert autotest_server._cached_results("key", 2) is None
+
+    def test_timed_out_not_cached(self, fake_redis_conn, results):
+        results[0]["timeout"] = 10
+        autotest_server._cache_results("key", 1, results)
+        assert autotest_server._cached_results("key", 2) is None
+
+
+class TestTestFilesSnapshot:
+    @pytest.fixture
+    def test_files(self, tmp_path):
+        files = tmp_path / "files"
+        (files / "dir").mkdir(parents=True)
+        (files / "test.py").write_text("test")
+        (files / "dir" / "data.txt").write_text("data")
+        return str(files)
+
+    @pytest.fixture
+    def group(self):
+        return grp.getgrgid(os.getgid()).gr_name
+
+    @pytest.fixture(autouse=True)
+    def script_dir(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(autotest_server, "TEST_SCRIPT_DIR", str(tmp_path / "scripts"))
+
+    def test_permissions(self, test_files, group):
+        snapshot = autotest_server._test_files_snapshot(1, "1", test_files, group)
+        assert stat.S_IMODE(os.stat(os.path.join(snapshot, "dir")).st_mode) == 0o1770
+        assert stat.S_IMODE(os.stat(os.path.join(snapshot, "test.py")).st_mode) == 0o750
+
+    def test_created_once(self, test_files, group):
+        snapshot = autotest_server._test_files_snapshot(1, "1", test_files, group)
+        inode = os.stat(os.path.join(snapshot, "test.py")).st_ino
+        assert autotest_server._test_files_snapshot(1, "1", test_files, group) == snapshot
+        assert os.stat(os.path.join(snapshot, "test.py")).st_ino == inode
+
+    def test_old_versions_removed(self, test_files, group):
+        old = autotest_server._test_files_snapshot(1, "1", test_files, group)
+        autotest_server._test_files_snapshot(1, "2", test_files, group)
+        assert not os.path.exists(old)
+
+    def test_linked_into_working_directory(self, test_files, group, tmp_path):
+        snapshot = autotest_server._test_files_snapshot(1, "1", test_files, group)
+        tests_path = tmp_path / "tests"
+        tests_path.mkdir()
+        (tests_path / "test.py").write_text("student")
+        autotest_server.link_tree(snapshot, str(tests_path))
+        assert (tests_path / "test.py").read_text() == "test"
+        assert os.path.samefile(tests_path / "dir" / "data.txt", os.path.join(snapshot, "dir", "data.txt"))
+        assert stat.S_IMODE(os.stat(tests_path / "dir").st_mode) == 0o1770
+
+
+class TestStoreResult:
+    def test_small_result(self, fake_redis_conn):
+        autotest_server._store_result(1, {"test_groups": [], "error": None})
+        assert fake_redis_conn.get("autotest:test_result:1") == b'{"test_groups":[],"error":null}'
+
+    def test_large_result_compressed(self, fake_redis_conn):
+        result = {"test_groups": [{"stderr": "x" * 10000}], "error": None}
+        autotest_server._store_result(1, result)
+        assert json.loads(gzip.decompress(fake_redis_conn.get("autotest:test_result:1"))) == result
+
+    def test_expires(self, fake_redis_conn):
+        autotest_server._store_result(1, {"test_groups": [], "error": None})
+        assert 0 < fake_redis_conn.ttl("autotest:test_result:1") <= 3600
+
+    def test_metrics(self, fake_redis_conn):
+        autotest_server._store_result(1, {"test_groups": [{"stderr": "x" * 10000}], "error": None})
+        metrics = fake_redis_conn.hgetall("autotest:metrics")
+        assert metrics[b"results_stored"] == b"1"
+        assert int(metrics[b"result_bytes"]) == len(fake_redis_conn.get("autotest:test_result:1"))
+        assert int(metrics[b"result_uncompressed_bytes"]) > 10000
+
+
+class TestCancel:
+    @pytest.fixture(autouse=True)
+    def tester(self, monkeypatch):
+        monkeypatch.setattr(autotest_server, "CANCEL_POLL_INTERVAL", 0.05)
+        monkeypatch.setattr(autotest_server, "_create_test_script_command", lambda tester_type: "sleep 30")
+        monkeypatch.setattr(autotest_server, "_get_env_vars", lambda test_username: {})
+
+    @pytest.fixture
+    def test_settings(self):
+        test_data = {"category": ["instructor"], "timeout": 30}
+        return {"testers": [{"tester_type": "custom", "test_data": [test_data, test_data]}]}
+
+    def test_running_tests_killed(self, fake_redis_conn, test_settings, tmp_path):
+        fake_redis_conn.set("autotest:cancel:1", 1)
+        start = time.time()
+        results = autotest_server._run_test_specs(
+            "{}", test_settings, ["instructor"], str(tmp_path), getpass.getuser(), 1, {}
+        )
+        assert time.time() - start < 10
+        assert len(results) == 1
+        assert results[0]["stderr"] == "Tests were cancelled\n"
+
+    def test_not_cancelled(self, monkeypatch, fake_redis_conn, tmp_path):
+        monkeypatch.setattr(autotest_server, "_create_test_script_command", lambda tester_type: "echo ok")
+        test_settings = {"testers": [{"tester_type": "custom", "test_data": [{"category": ["instructor"]}]}]}
+        results = autotest_server._run_test_specs(
+            "{}", test_settings, ["instructor"], str(tmp_path), getpass.getuser(), 1, {}
+        )
+        assert results[0]["stderr"] is None
+        assert results[0]["malformed"] == "ok\n"
@@ -0,0 +1,176 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import fakeredis
+import pytest
+
+from autotest_server import callbacks
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.path, self.headers["Authorization"], json.loads(body)))
+        status_code = self.server.status_codes.pop(0) if self.server.status_codes else self.server.status_code
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = HTTPServer(("localhost", 0), _Handler)
+    server.requests = []
+    server.status_code = 200
+    server.status_codes = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(http_server):
+    return f"http://localhost:{http_server.server_port}/results"
+
+
+@pytest.fixture
+def fake_redis_conn():
+    conn = fakeredis.FakeStrictRedis()
+    conn.hset("autotest:user_credentials", key="user", value=json.dumps({"auth_type": "Bearer", "credentials": "abc"}))
+    yield conn
+
+
+@pytest.fixture
+def sender(fake_redis_conn):
+    return callbacks.CallbackSender(fake_redis_conn, batch_size=10, max_attempts=2, backoff=2, timeout=5)
+
+
+def _queue(conn, url, test_id):
+    callbacks.queue_callback(conn, url, "user", 1, test_id, {"test_groups": [], "error": None})
+
+
+class TestCallbackSender:
+    def test_batch_delivered(self, sender, fake_redis_conn, http_server, url):
+        for test_id in range(3):
+            _queue(fake_redis_conn, url, test_id)
+        assert sender.deliver() == 3
+        assert len(http_server.requests) == 1
+        path, auth, body = http_server.requests[0]
+        assert path == "/results"
+        assert auth == "Bearer abc"
+        assert [r["test_id"] for r in body["test_results"]] == [0, 1, 2]
+        assert body["test_results"][0] == {
+            "settings_id": 1,
+            "test_id": 0,
+            "status": "finished",
+            "test_groups": [],
+            "error": None,
+        }
+
+    def test_credentials_cached(self, sender, fake_redis_conn, http_server, url):
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        fake_redis_conn.delete("autotest:user_credentials")
+        _queue(fake_redis_conn, url, 2)
+        sender.deliver()
+        assert http_server.requests[1][1] == "Bearer abc"
+
+    def test_credentials_expire(self, sender, fake_redis_conn, http_server, url):
+        sender.credentials_ttl = 0
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        creds = json.dumps({"auth_type": "Bearer", "credentials": "def"})
+        fake_redis_conn.hset("autotest:user_credentials", key="user", value=creds)
+        _queue(fake_redis_conn, url, 2)
+        sender.deliver()
+        assert http_server.requests[1][1] == "Bearer def"
+
+    def test_credentials_refreshed_when_rejected(self, sender, fake_redis_conn, http_server, url):
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        creds = json.dumps({"auth_type": "Bearer", "credentials": "def"})
+        fake_redis_conn.hset("autotest:user_credentials", key="user", value=creds)
+        http_server.status_codes = [401]
+        _queue(fake_redis_conn, url, 2)
+        sender.deliver()
+        assert [auth for _, auth, _ in http_server.requests] == ["Bearer abc", "Bearer abc", "Bearer def"]
+        assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 0
+
+    def test_batches_by_url(self, sender, fake_redis_conn, http_server, url):
+        _queue(fake_redis_conn, url, 1)
+        _queue(fake_redis_conn, url + "/other", 2)
+        sender.deliver()
+        assert sorted(path for path, _, _ in http_server.requests) == ["/results", "/results/other"]
+
+    def test_nothing_to_deliver(self, sender):
+        assert sender.deliver(timeout=0.01) == 0
+
+    def test_failed_delivery_retried(self, sender, fake_redis_conn, http_server, url):
+        http_server.status_code = 500
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 1
+        assert fake_redis_conn.llen(callbacks.CALLBACK_QUEUE) == 0
+
+    def test_retry_requeued_when_due(self, sender, fake_redis_conn, http_server, url):
+        http_server.status_code = 500
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        record = fake_redis_conn.zrange(callbacks.RETRY_QUEUE, 0, -1)[0]
+        fake_redis_conn.zadd(callbacks.RETRY_QUEUE, {record: 0})
+        http_server.status_code = 200
+        sender.deliver()
+        assert len(http_server.requests) == 2
+        assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 0
+
+    def test_dead_letter(self, sender, fake_redis_conn, http_server, url):
+        http_server.status_code = 500
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        record = fake_redis_conn.zrange(callbacks.RETRY_QUEUE, 0, -1)[0]
+        fake_redis_conn.zadd(callbacks.RETRY_QUEUE, {record: 0})
+        sender.deliver()
+        dead = [json.loads(r) for r in fake_redis_conn.lrange(callbacks.DEAD_LETTER_QUEUE, 0, -1)]
+        assert [(r["data"]["test_id"], r["attempts"]) for r in dead] == [(1, 2)]
+
+    def test_unreachable_url(self, sender, fake_redis_conn):
+        _queue(fake_redis_conn, "http://localhost:1/results", 1)
+        sender.deliver()
+        assert fake_redis_conn.zcard(callbacks.RETRY_QUEUE) == 1
+
+    def test_delivered_records_acknowledged(self, sender, fake_redis_conn, http_server, url):
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        assert fake_redis_conn.llen(callbacks.PROCESSING_QUEUE) == 0
+
+    def test_failed_records_acknowledged(self, sender, fake_redis_conn, http_server, url):
+        http_server.status_code = 500
+        _queue(fake_redis_conn, url, 1)
+        sender.deliver()
+        assert fake_redis_conn.llen(callbacks.PROCESSING_QUEUE) == 0
+
+    def test_unacknowledged_records_recovered(self, sender, fake_redis_conn, http_server, url):
+        for test_id in range(3):
+            _queue(fake_redis_conn, url, test_id)
+        sender.pop_batch(timeout=1)
+        _queue(fake_redis_conn, url, 3)
+        assert fake_redis_conn.llen(callbacks.PROCESSING_QUEUE) == 3
+        assert sender.recover() == 3
+        sender.deliver()
+        assert [r["test_id"] for r in http_server.requests[0][2]["test_results"]] == [0, 1, 2, 3]
+        assert fake_redis_conn.llen(callbacks.PROCESSING_QUEUE) == 0
+
+    @pytest.mark.parametrize("record", [b"not json", b"[]", b'{"url": "http://localhost:1"}'])
+    def test_invalid_record_dead_letter(self, sender, fake_redis_conn, http_server, url, record):
+        fake_redis_conn.rpush(callbacks.CALLBACK_QUEUE, record)
+        _queue(fake_redis_conn, url, 1)
+        assert sender.deliver() == 1
+        assert len(http_server.requests) == 1
+        assert fake_redis_conn.lrange(callbacks.DEAD_LETTER_QUEUE, 0, -1) == [record]
+        assert fake_redis_conn.llen(callbacks.PROCESSING_QUEUE) == 0
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fakeredis
+import pytest
+
+from autotest_server import download
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers["Authorization"], self.client_address))
+        status_code = self.server.status_codes.pop(0) if self.server.status_codes else 200
+        body = self.server.body if status_code == 200 else b""
+        self.send_response(status_code)
+        if self.server.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(body), body))
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("localhost", 0), _Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.status_codes = []
+    server.body = b"content" * 100
+    server.chunked = False
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(http_server):
+    return f"http://localhost:{http_server.server_port}/files"
+
+
+@pytest.fixture
+def fake_redis_conn():
+    conn = fakeredis.FakeStrictRedis()
+    conn.hset("autotest:user_credentials", key="user", value=json.dumps({"auth_type": "Bearer", "credentials": "abc"}))
+    yield conn
+
+
+@pytest.fixture
+def downloader(fake_redis_conn):
+    downloader = download.Downloader(fake_redis_conn, timeout=5, retries=2, max_size=1000, spool_size=10)
+    yield downloader
+    downloader.session.close()
+
+
+class TestDownloader:
+    def test_content(self, downloader, http_server, url):
+        file, hash_ = downloader.download("user", url)
+        assert file.read() == http_server.body
+        assert hash_ == hashlib.sha256(http_server.body).hexdigest()
+
+    def test_authorization(self, downloader, http_server, url):
+        downloader.download("user", url)
+        assert http_server.requests[0][1] == "Bearer abc"
+
+    def test_connection_reused(self, downloader, http_server, url):
+        for _ in range(3):
+            downloader.download("user", url)
+        assert len({client_address for *_, client_address in http_server.requests}) == 1
+
+    def test_credentials_cached(self, downloader, fake_redis_conn, http_server, url):
+        downloader.download("user", url)
+        fake_redis_conn.delete("autotest:user_credentials")
+        downloader.download("user", url)
+        assert http_server.requests[1][1] == "Bearer abc"
+
+    def test_credentials_refreshed_when_rejected(self, downloader, fake_redis_conn, http_server, url):
+        downloader.download("user", url)
+        creds = json.dumps({"auth_type": "Bearer", "credentials": "def"})
+        fake_redis_conn.hset("autotest:user_credentials", key="user", value=creds)
+        http_server.status_codes = [401]
+        file, _ = downloader.download("user", url)
+        assert file.read() == http_server.body
+        assert [auth for _, auth, _ in http_server.requests] == ["Bearer abc", "Bearer abc", "Bearer def"]
+
+    def test_missing_credentials(self, downloader, http_server, url):
+        with pytest.raises(download.DownloadError, match="no credentials"):
+            downloader.download("other", url)
+        assert not http_server.requests
+
+    def test_retried(self, downloader, http_server, url):
+        http_server.status_codes = [503, 503]
+        file, _ = downloader.download("user", url)
+        assert file.read() == http_server.body
+        assert len(http_server.requests) == 3
+
+    def test_error(self, downloader, http_server, url):
+        http_server.status_codes = [404]
+        with pytest.raises(download.DownloadError):
+            downloader.download("user", url)
+
+    @pytest.mark.parametrize("chunked", [False, True])
+    def test_too_large(self, downloader, http_server, url, chunked):
+        http_server.body = b"x" * 1001
+        http_server.chunked = chunked
+        with pytest.raises(download.DownloadError, match="maximum download size"):
+            downloader.download("user", url)
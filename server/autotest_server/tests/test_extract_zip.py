@@ -0,0 +1,69 @@
+import grp
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+from ..utils import extract_zip_stream, ArchiveError
+
+
+def _archive(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, content in members.items():
+            if isinstance(content, tuple):
+                zf.writestr(*content)
+            else:
+                zf.writestr(name, content)
+    return data.getvalue()
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+class TestExtractZipStream:
+    def test_files_extracted(self, tmp_path):
+        extract_zip_stream(_archive({"a.txt": b"a", "dir/sub/b.txt": b"b" * 100000, "empty/": b""}), str(tmp_path))
+        assert (tmp_path / "a.txt").read_bytes() == b"a"
+        assert (tmp_path / "dir" / "sub" / "b.txt").read_bytes() == b"b" * 100000
+        assert (tmp_path / "empty").is_dir()
+
+    def test_file_object(self, tmp_path):
+        extract_zip_stream(io.BytesIO(_archive({"a.txt": b"a"})), str(tmp_path))
+        assert (tmp_path / "a.txt").read_bytes() == b"a"
+
+    def test_permissions(self, tmp_path):
+        group = grp.getgrgid(os.getgid()).gr_name
+        archive = _archive({"a.txt": b"a", "dir/b.txt": b"b", "empty/": b""})
+        extract_zip_stream(archive, str(tmp_path), dir_mode=0o750, file_mode=0o640, group=group)
+        for path in ("dir", "empty"):
+            assert _mode(tmp_path / path) == 0o750
+        for path in ("a.txt", "dir/b.txt"):
+            assert _mode(tmp_path / path) == 0o640
+            assert os.stat(tmp_path / path).st_gid == os.getgid()
+
+    @pytest.mark.parametrize("name", ["../a.txt", "/tmp/a.txt", "dir/../../a.txt"])
+    def test_unsafe_path(self, tmp_path, name):
+        destination = tmp_path / "dest"
+        destination.mkdir()
+        with pytest.raises(ArchiveError, match="unsafe path"):
+            extract_zip_stream(_archive({name: b"a"}), str(destination))
+        assert os.listdir(tmp_path) == ["dest"]
+
+    def test_symlink_extracted_as_file(self, tmp_path):
+        info = zipfile.ZipInfo("link")
+        info.external_attr = (stat.S_IFLNK | 0o777) << 16
+        extract_zip_stream(_archive({"link": (info, b"/etc/passwd")}), str(tmp_path))
+        assert not os.path.islink(tmp_path / "link")
+        assert (tmp_path / "link").read_bytes() == b"/etc/passwd"
+
+    def test_too_many_entries(self, tmp_path):
+        with pytest.raises(ArchiveError, match="entries"):
+            extract_zip_stream(_archive({f"{i}.txt": b"" for i in range(3)}), str(tmp_path), max_entries=2)
+
+    def test_too_large(self, tmp_path):
+        with pytest.raises(ArchiveError, match="larger than"):
+            extract_zip_stream(_archive({"a.txt": b"a" * 10, "b.txt": b"b" * 10}), str(tmp_path), max_size=15)
@@ -0,0 +1,127 @@
+from collections import Counter
+import os
+import time
+
+import fakeredis
+import pytest
+import rq
+
+from autotest_server import fair_share
+
+
+@pytest.fixture
+def fake_redis_conn():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = {"weight": 1, "max_concurrent": 0, "poll_interval": 1, "users": {}}
+    monkeypatch.setattr(fair_share, "fair_share_settings", lambda: settings)
+    return settings
+
+
+@pytest.fixture
+def worker(fake_redis_conn, settings):
+    return fair_share.FairShareWorker(["settings", "high", "low", "batch"], connection=fake_redis_conn)
+
+
+def _enqueue(conn, user, n):
+    name = fair_share.batch_queue_name(user)
+    conn.sadd(fair_share.BATCH_QUEUES_KEY, name)
+    queue = rq.Queue(name, connection=conn)
+    for i in range(n):
+        queue.enqueue_call("autotest_server.run_test", job_id=f"{user}-{i}")
+    return queue
+
+
+def _served(worker, n):
+    users = []
+    for _ in range(n):
+        job, _queue = worker.dequeue_job_and_maintain_ttl(None)
+        users.append(job.id.split("-")[0])
+    return users
+
+
+class TestBatchQueueName:
+    def test_per_user(self):
+        assert fair_share.batch_queue_name("a") != fair_share.batch_queue_name("b")
+
+    def test_key_hidden(self):
+        assert "secret" not in fair_share.batch_queue_name("secret")
+
+
+class TestFairShareWorker:
+    def test_batch_queues_in_place_of_batch(self, worker, fake_redis_conn):
+        queue = _enqueue(fake_redis_conn, "a", 1)
+        assert [q.name for q in worker.ordered_queues()] == ["settings", "high", "low", "batch", queue.name]
+
+    def test_round_robin(self, worker, fake_redis_conn):
+        _enqueue(fake_redis_conn, "a", 5)
+        _enqueue(fake_redis_conn, "b", 5)
+        served = _served(worker, 4)
+        assert Counter(served) == {"a": 2, "b": 2}
+        assert served[0] != served[1]
+
+    def test_weights(self, fake_redis_conn, settings):
+        settings["users"] = {"a": {"weight": 2}}
+        worker = fair_share.FairShareWorker(["batch"], connection=fake_redis_conn)
+        _enqueue(fake_redis_conn, "a", 10)
+        _enqueue(fake_redis_conn, "b", 10)
+        assert Counter(_served(worker, 6)) == {"a": 4, "b": 2}
+
+    def test_idle_user_does_not_catch_up(self, worker, fake_redis_conn):
+        _enqueue(fake_redis_conn, "a", 10)
+        _served(worker, 5)
+        _enqueue(fake_redis_conn, "b", 10)
+        assert "a" in _served(worker, 3)
+
+    def test_max_concurrent(self, fake_redis_conn, settings):
+        settings["users"] = {"a": {"max_concurrent": 1}}
+        worker = fair_share.FairShareWorker(["batch"], connection=fake_redis_conn)
+        queue = _enqueue(fake_redis_conn, "a", 2)
+        _enqueue(fake_redis_conn, "b", 1)
+        queue.started_job_registry.add(rq.job.Job.fetch("a-1", connection=fake_redis_conn), -1)
+        assert [q.name for q in worker.fair_share_order()] == [fair_share.batch_queue_name("b")]
+
+    def test_default_max_concurrent(self, fake_redis_conn, settings):
+        settings["max_concurrent"] = 1
+        settings["users"] = {"a": {"weight": 2}}
+        worker = fair_share.FairShareWorker(["batch"], connection=fake_redis_conn)
+        queue = _enqueue(fake_redis_conn, "a", 2)
+        _enqueue(fake_redis_conn, "b", 1)
+        queue.started_job_registry.add(rq.job.Job.fetch("a-1", connection=fake_redis_conn), -1)
+        assert [q.name for q in worker.fair_share_order()] == [fair_share.batch_queue_name("b")]
+
+    def test_empty_queues_last(self, worker, fake_redis_conn):
+        empty = _enqueue(fake_redis_conn, "a", 0)
+        full = _enqueue(fake_redis_conn, "b", 1)
+        assert worker.fair_share_order() == [full, empty]
+
+    def test_legacy_batch_queue_served(self, worker, fake_redis_conn):
+        rq.Queue("batch", connection=fake_redis_conn).enqueue_call("autotest_server.run_test", job_id="legacy-0")
+        assert _served(worker, 1) == ["legacy"]
+
+    def test_other_queues_first(self, worker, fake_redis_conn):
+        _enqueue(fake_redis_conn, "a", 1)
+        rq.Queue("low", connection=fake_redis_conn).enqueue_call("autotest_server.run_test", job_id="low-0")
+        assert _served(worker, 2) == ["low", "a"]
+
+    def test_drain_counted(self, worker, fake_redis_conn):
+        _enqueue(fake_redis_conn, "a", 2)
+        rq.Queue("low", connection=fake_redis_conn).enqueue_call("autotest_server.run_test", job_id="low-0")
+        _served(worker, 3)
+        minute = int(time.time() // 60)
+        keys = [fair_share.drain_key(name, m) for name in ("batch", "low") for m in (minute - 1, minute)]
+        assert sum(int(n or 0) for n in fake_redis_conn.mget(keys[:2])) == 2
+        assert sum(int(n or 0) for n in fake_redis_conn.mget(keys[2:])) == 1
+
+
+class TestFairShareSimpleWorker:
+    def test_job_run_in_worker_process(self, fake_redis_conn, settings):
+        name = fair_share.batch_queue_name("a")
+        fake_redis_conn.sadd(fair_share.BATCH_QUEUES_KEY, name)
+        job = rq.Queue(name, connection=fake_redis_conn).enqueue("os.getpid")
+        worker = fair_share.FairShareSimpleWorker(["batch"], connection=fake_redis_conn)
+        worker.work(burst=True)
+        assert job.return_value() == os.getpid()
@@ -0,0 +1,65 @@
+import fakeredis
+import pytest
+
+from autotest_server import result_cache
+
+
+@pytest.fixture
+def fake_redis_conn():
+    yield fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    settings = {"ttl": 60, "max_entries": 2}
+    monkeypatch.setattr(result_cache, "result_cache_settings", lambda: settings)
+    return settings
+
+
+class TestCacheKey:
+    def test_inputs(self):
+        key = result_cache.cache_key(1, "archive", "etag", "1", ["student", "instructor"], {"A": "1"})
+        assert key == result_cache.cache_key(1, "archive", "etag", "1", ["instructor", "student"], {"A": "1"})
+        assert key != result_cache.cache_key(1, "archive", "etag", "2", ["instructor", "student"], {"A": "1"})
+        assert key != result_cache.cache_key(1, "archive", "etag", "1", ["instructor", "student"], {"A": "2"})
+
+    def test_settings_id(self):
+        # settings with identical bodies can have different test files
+        key = result_cache.cache_key(1, "archive", "etag", "2", ["student"], {})
+        assert key != result_cache.cache_key(2, "archive", "etag", "2", ["student"], {})
+        assert key == result_cache.cache_key("1", "archive", "etag", "2", ["student"], {})
+
+
+class TestResultCache:
+    def test_miss(self, fake_redis_conn, settings):
+        assert result_cache.get(fake_redis_conn, "a") is None
+        assert fake_redis_conn.hget("autotest:metrics", "result_cache_misses") == b"1"
+
+    def test_hit(self, fake_redis_conn, settings):
+        results = [{"time": 10, "feedback": [{"id": 3}]}]
+        result_cache.put(fake_redis_conn, "a", results, {"3": b"data"})
+        assert result_cache.get(fake_redis_conn, "a") == (results, {"3": b"data"})
+        assert fake_redis_conn.hget("autotest:metrics", "result_cache_hits") == b"1"
+
+    def test_expires(self, fake_redis_conn, settings):
+        result_cache.put(fake_redis_conn, "a", [], {})
+        assert 0 < fake_redis_conn.ttl("autotest:result_cache:a") <= 60
+
+    def test_expiry_refreshed_when_used(self, fake_redis_conn, settings):
+        result_cache.put(fake_redis_conn, "a", [], {})
+        fake_redis_conn.expire("autotest:result_cache:a", 5)
+        result_cache.get(fake_redis_conn, "a")
+        assert 5 < fake_redis_conn.ttl("autotest:result_cache:a") <= 60
+
+    def test_least_recently_used_evicted(self, fake_redis_conn, settings, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(result_cache.time, "time", lambda: now[0])
+        for key in ("a", "b"):
+            now[0] += 1
+            result_cache.put(fake_redis_conn, key, [], {})
+        now[0] += 1
+        result_cache.get(fake_redis_conn, "a")
+        now[0] += 1
+        result_cache.put(fake_redis_conn, "c", [], {})
+        assert not fake_redis_conn.exists("autotest:result_cache:b")
+        assert fake_redis_conn.exists("autotest:result_cache:a", "autotest:result_cache:c") == 2
@@ -0,0 +1,89 @@
+import json
+
+import fakeredis
+import pytest
+
+from autotest_server import settings_store
+
+
+@pytest.fixture
+def fake_redis_conn():
+    yield fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def legacy_settings(fake_redis_conn):
+    body = {"testers": [{"test_data": [{"timeout": 10}, {"timeout": 20}]}]}
+    legacy = {**body, "_user": "user", "_env_status": "ready", "_last_access": 100, "_files": "/files"}
+    fake_redis_conn.hset("autotest:settings", key=1, value=json.dumps(legacy))
+    return body
+
+
+class TestGetMetadata:
+    def test_fields(self, fake_redis_conn):
+        fake_redis_conn.hset("autotest:settings_meta:1", mapping={"user": "user", "env_status": "setup"})
+        assert settings_store.get_metadata(fake_redis_conn, 1, "env_status", "error") == {
+            "env_status": "setup",
+            "error": None,
+        }
+
+    def test_missing(self, fake_redis_conn):
+        assert settings_store.get_metadata(fake_redis_conn, 1, "user") is None
+
+    def test_legacy_settings_migrated(self, fake_redis_conn, legacy_settings):
+        assert settings_store.get_metadata(fake_redis_conn, 1, "user", "files", "last_access", "timeout") == {
+            "user": "user",
+            "files": "/files",
+            "last_access": "100",
+            "timeout": "30",
+        }
+        assert json.loads(fake_redis_conn.hget("autotest:settings", 1)) == legacy_settings
+
+
+class TestWriteSettings:
+    def test_version_incremented(self, fake_redis_conn):
+        for _ in range(2):
+            with fake_redis_conn.pipeline() as pipe:
+                settings_store.write_settings(pipe, 1, {}, {"user": "user"})
+                pipe.execute()
+        assert fake_redis_conn.hget("autotest:settings_meta:1", "version") == b"2"
+
+    def test_etag(self, fake_redis_conn):
+        etags = []
+        for body in ({"testers": []}, {"testers": []}, {"testers": [{}]}):
+            with fake_redis_conn.pipeline() as pipe:
+                settings_store.write_settings(pipe, 1, body, {"user": "user"})
+                pipe.execute()
+            etags.append(fake_redis_conn.hget("autotest:settings_meta:1", "etag"))
+        assert etags[0] == etags[1] != etags[2]
+
+    def test_fields_deleted(self, fake_redis_conn):
+        fake_redis_conn.hset("autotest:settings_meta:1", mapping={"user": "user", "error": "failed"})
+        with fake_redis_conn.pipeline() as pipe:
+            settings_store.write_settings(pipe, 1, {}, {"env_status": "ready"}, delete=("error",))
+            pipe.execute()
+        assert not fake_redis_conn.hexists("autotest:settings_meta:1", "error")
+
+    def test_groups(self, fake_redis_conn):
+        body = {"testers": [{"test_data": [{"category": ["instructor"], "timeout": 10}]}, {"test_data": [{}]}]}
+        with fake_redis_conn.pipeline() as pipe:
+            settings_store.write_settings(pipe, 1, body, {"user": "user"})
+            pipe.execute()
+        meta = settings_store.get_metadata(fake_redis_conn, 1, "timeout", "groups")
+        assert meta["timeout"] == "10"
+        assert json.loads(meta["groups"]) == [[["instructor"], 10], [[], 0]]
+
+    def test_runtimes_cleared(self, fake_redis_conn):
+        fake_redis_conn.hset("autotest:runtimes:1", mapping={"0:total": 1, "0:count": 1})
+        with fake_redis_conn.pipeline() as pipe:
+            settings_store.write_settings(pipe, 1, {}, {"user": "user"})
+            pipe.execute()
+        assert not fake_redis_conn.exists("autotest:runtimes:1")
+
+
+class TestRequestedGroups:
+    def test_categories(self):
+        groups = [(["instructor"], 10), (["student", "instructor"], 20), (["student"], 30)]
+        assert settings_store.requested_groups(groups, ["instructor"]) == [0, 1]
+        assert settings_store.requested_groups(groups, ["student"]) == [1, 2]
+        assert settings_store.requested_groups(groups, []) == []
@@ -1,12 +1,17 @@
+import errno
+import grp
 import json
 import resource
 import os
+import stat
 import zipfile
 import shutil
 from io import BytesIO
-from typing import Type, Optional, Tuple, List, Generator
+from typing import Type, Optional, Tuple, List, Generator, Union, IO
 from .config import _Config
 
+ZIP_CHUNK_SIZE = 64 * 1024
+
 
 def loads_partial_json(json_string: str, expected_type: Optional[Type] = None) -> Tuple[List, bool]:
     """
@@ -79,21 +84,89 @@ def get_resource_settings(config: _Config) -> list[tuple[int, tuple[int, int]]]:
     return resource_settings
 
 
-def extract_zip_stream(zip_byte_stream: bytes, destination: str) -> None:
+class ArchiveError(Exception):
+    pass
+
+
+def archive_limits(config: _Config) -> Tuple[int, int]:
+    """Returns the maximum total size and number of entries of an extracted zip archive specified in config file."""
+    settings = {"max_size": 4 * 1024**3, "max_entries": 100000, **config.get("archives", {})}
+    return settings["max_size"], settings["max_entries"]
+
+
+def _safe_member_path(destination: str, name: str) -> str:
     """
-    Extract files in a zip archive's content <zip_byte_stream> to <destination>, a path to a local directory.
+    Return the path that the zip archive member called name should be extracted to in destination. Raise an
+    ArchiveError if that path would be outside of destination.
     """
-    with zipfile.ZipFile(BytesIO(zip_byte_stream)) as zf:
-        for fname in zf.namelist():
-            *dpaths, bname = fname.split(os.sep)
-            dest = os.path.join(destination, *dpaths)
-            filename = os.path.join(dest, bname)
-            if filename.endswith("/"):
-                os.makedirs(filename, exist_ok=True)
-            else:
-                os.makedirs(dest, exist_ok=True)
-                with open(filename, "wb") as f:
-                    f.write(zf.read(fname))
+    parts = name.replace("\\", "/").split("/")
+    if name.startswith("/") or ".." in parts or any(os.path.splitdrive(part)[0] for part in parts):
+        raise ArchiveError(f"unsafe path in zip archive: {name}")
+    return os.path.join(destination, *(part for part in parts if part not in ("", ".")))
+
+
+def extract_zip_stream(
+    zip_byte_stream: Union[bytes, IO[bytes]],
+    destination: str,
+    dir_mode: Optional[int] = None,
+    file_mode: Optional[int] = None,
+    group: Optional[str] = None,
+    max_size: Optional[int] = None,
+    max_entries: Optional[int] = None,
+) -> None:
+    """
+    Extract files in a zip archive's content <zip_byte_stream> (or a seekable file containing the archive) to
+    <destination>, a path to a local directory.
+
+    Files are copied to disk in chunks and, if given, <dir_mode>, <file_mode> and <group> are applied to each directory
+    and file as it is created. Symbolic links in the archive are extracted as regular files containing their target.
+    Raise an ArchiveError if a member would be extracted outside of <destination> or if the archive contains more than
+    <max_entries> members or more than <max_size> bytes of uncompressed content.
+    """
+    if isinstance(zip_byte_stream, bytes):
+        zip_byte_stream = BytesIO(zip_byte_stream)
+    gid = -1 if group is None else grp.getgrnam(group).gr_gid
+    created = {os.path.normpath(destination)}
+
+    def makedirs(path: str) -> None:
+        if path in created:
+            return
+        makedirs(os.path.dirname(path))
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+        if dir_mode is not None:
+            os.chmod(path, dir_mode)
+        if gid != -1:
+            os.chown(path, -1, gid)
+        created.add(path)
+
+    with zipfile.ZipFile(zip_byte_stream) as zf:
+        members = zf.infolist()
+        if max_entries is not None and len(members) > max_entries:
+            raise ArchiveError(f"zip archive contains more than {max_entries} entries")
+        if max_size is not None and sum(info.file_size for info in members) > max_size:
+            raise ArchiveError(f"zip archive content is larger than {max_size} bytes")
+        total = 0
+        for info in members:
+            path = os.path.normpath(_safe_member_path(destination, info.filename))
+            if info.is_dir():
+                makedirs(path)
+                continue
+            makedirs(os.path.dirname(path))
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with zf.open(info) as src, os.fdopen(fd, "wb") as dst:
+                if file_mode is not None:
+                    os.fchmod(fd, file_mode)
+                if gid != -1:
+                    os.fchown(fd, -1, gid)
+                # the sizes in the archive's headers are not trusted: stop once more than max_size bytes are written
+                while chunk := src.read(ZIP_CHUNK_SIZE):
+                    total += len(chunk)
+                    if max_size is not None and total > max_size:
+                        raise ArchiveError(f"zip archive content is larger than {max_size} bytes")
+                    dst.write(chunk)
 
 
 def recursive_iglob(root_dir: str) -> Generator[Tuple[str, str], None, None]:
@@ -132,3 +205,28 @@ def copy_tree(src: str, dst: str, exclude: Tuple = tuple()) -> List[Tuple[str, s
             shutil.copy2(file_or_dir, target)
         copied.append((fd, target))
     return copied
+
+
+def link_tree(src: str, dst: str) -> None:
+    """
+    Recursively hard link all files in the path indicated by src into the path indicated by dst. Directories are
+    created with the same mode and group as the directories in src. Files in dst are replaced and files that cannot be
+    linked because dst is on a different filesystem are copied instead (with the same mode and group).
+    """
+    for fd, file_or_dir in recursive_iglob(src):
+        target = os.path.join(dst, os.path.relpath(file_or_dir, src))
+        if fd == "d":
+            os.makedirs(target, exist_ok=True)
+            src_stat = os.stat(file_or_dir)
+            os.chmod(target, stat.S_IMODE(src_stat.st_mode))
+            os.chown(target, -1, src_stat.st_gid)
+            continue
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(file_or_dir, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(file_or_dir, target)
+            os.chown(target, -1, os.stat(file_or_dir).st_gid)
@@ -0,0 +1,78 @@
+"""
+Compare the time taken to set up student files from a zip archive with the single pass extract_zip_stream and with the
+previous implementation (extract every member in memory, then walk the tree again to set permissions).
+
+Run from the server directory:
+
+    python -m benchmarks.extract_zip [--files 5000] [--size 2048] [--repeat 5] [--dir DIR]
+"""
+
+import argparse
+import grp
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from typing import Callable, Dict
+
+from autotest_server.utils import extract_zip_stream, recursive_iglob
+
+
+def legacy_setup(zip_byte_stream: bytes, destination: str, group: str) -> None:
+    with zipfile.ZipFile(io.BytesIO(zip_byte_stream)) as zf:
+        for fname in zf.namelist():
+            *dpaths, bname = fname.split(os.sep)
+            dest = os.path.join(destination, *dpaths)
+            filename = os.path.join(dest, bname)
+            if filename.endswith("/"):
+                os.makedirs(filename, exist_ok=True)
+            else:
+                os.makedirs(dest, exist_ok=True)
+                with open(filename, "wb") as f:
+                    f.write(zf.read(fname))
+    for fd, file_or_dir in recursive_iglob(destination):
+        os.chmod(file_or_dir, 0o770)
+        shutil.chown(file_or_dir, group=group)
+
+
+def streaming_setup(zip_byte_stream: bytes, destination: str, group: str) -> None:
+    extract_zip_stream(zip_byte_stream, destination, dir_mode=0o770, file_mode=0o770, group=group)
+
+
+def make_archive(n_files: int, size: int) -> bytes:
+    data = io.BytesIO()
+    content = os.urandom(size // 2) * 2
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i in range(n_files):
+            zf.writestr(f"dir{i % 50}/sub{i % 7}/file{i}.txt", content)
+    return data.getvalue()
+
+
+def bench(setups: Dict[str, Callable], archive: bytes, group: str, repeat: int, dir_: str) -> Dict[str, float]:
+    """Return the fastest of repeat runs of each setup function, alternating between them to even out noise"""
+    times = {name: [] for name in setups}
+    for _ in range(repeat):
+        for name, setup in setups.items():
+            with tempfile.TemporaryDirectory(dir=dir_) as destination:
+                start = time.perf_counter()
+                setup(archive, destination, group)
+                times[name].append(time.perf_counter() - start)
+    return {name: min(times_) for name, times_ in times.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5000, help="number of files in the archive")
+    parser.add_argument("--size", type=int, default=2048, help="size of each file in bytes")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs (the fastest is reported)")
+    parser.add_argument("--dir", help="directory to extract to (use one on the same filesystem as the workspace)")
+    args = parser.parse_args()
+
+    group_ = grp.getgrgid(os.getgid()).gr_name
+    archive_ = make_archive(args.files, args.size)
+    print(f"{args.files} files of {args.size} bytes ({len(archive_)} byte archive)")
+    results = bench({"legacy": legacy_setup, "streaming": streaming_setup}, archive_, group_, args.repeat, args.dir)
+    for name, seconds in results.items():
+        print(f"{name:>10}: {seconds * 1000:.1f} ms")
@@ -7,6 +7,7 @@ import grp
 import json
 import subprocess
 import getpass
+import hashlib
 import redis
 from autotest_server.config import config
 from autotest_server import run_test_command
@@ -82,7 +83,11 @@ def install_all_testers():
         skeleton = json.load(f)
         skeleton["definitions"]["installed_testers"]["enum"] = list(settings.keys())
         skeleton["definitions"]["tester_schemas"]["oneOf"] = list(settings.values())
-        REDIS_CONNECTION.set("autotest:schema", json.dumps(skeleton))
+        schema = json.dumps(skeleton)
+        with REDIS_CONNECTION.pipeline() as pipe:
+            pipe.set("autotest:schema", schema)
+            pipe.set("autotest:schema_version", hashlib.sha256(schema.encode()).hexdigest())
+            pipe.execute()
 
 
 def install():
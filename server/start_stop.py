@@ -1,5 +1,4 @@
 import argparse
-import json
 import os
 import shutil
 import time
@@ -8,6 +7,7 @@ import sys
 import signal
 import subprocess
 from autotest_server.config import config
+from autotest_server import settings_store
 from redis.retry import Retry
 from redis.exceptions import TimeoutError, ConnectionError
 from redis.backoff import FullJitterBackoff
@@ -52,6 +52,23 @@ stderr_logfile_backups=10
 
 """
 
+CALLBACK_CONTENT = """[program:callback_sender]
+command={python} -m autotest_server.callbacks
+process_name=callback_sender
+numprocs=1
+directory={directory}
+stopsignal=TERM
+autostart=true
+autorestart=true
+stdout_logfile={stdout_logfile}
+stdout_logfile_maxbytes=1MB
+stdout_logfile_backups=10
+stderr_logfile={stderr_logfile}
+stderr_logfile_maxbytes=1MB
+stderr_logfile_backups=10
+
+"""
+
 REDIS_CONNECTION = redis.Redis.from_url(
     config["redis_url"],
     decode_responses=True,
@@ -61,6 +78,12 @@ REDIS_CONNECTION = redis.Redis.from_url(
 )
 
 
+def _worker_class(worker_data):
+    if worker_data.get("fork", True):
+        return "autotest_server.fair_share.FairShareWorker"
+    return "autotest_server.fair_share.FairShareSimpleWorker"
+
+
 def create_enqueuer_wrapper(rq):
     with open(_CONF_FILE, "w") as f:
         f.write(HEADER)
@@ -68,7 +91,7 @@ def create_enqueuer_wrapper(rq):
             c = CONTENT.format(
                 worker_user=worker_data["user"],
                 rq=rq,
-                worker_args=f'--url {config["redis_url"]}',
+                worker_args=f'--url {config["redis_url"]} --worker-class {_worker_class(worker_data)}',
                 queues=" ".join(worker_data["queues"]),
                 numprocs=1,
                 directory=os.path.dirname(os.path.realpath(__file__)),
@@ -76,6 +99,14 @@ def create_enqueuer_wrapper(rq):
                 stderr_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/{worker_data["user"]}_stderr.log'),
             )
             f.write(c)
+        f.write(
+            CALLBACK_CONTENT.format(
+                python=sys.executable,
+                directory=os.path.dirname(os.path.realpath(__file__)),
+                stdout_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/callback_sender_stdout.log'),
+                stderr_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/callback_sender_stderr.log'),
+            )
+        )
 
 
 def start(rq, supervisord, extra_args):
@@ -97,18 +128,18 @@ def stat(rq, extra_args):
 
 
 def clean(age, dry_run):
-    for settings_id, settings in dict(REDIS_CONNECTION.hgetall("autotest:settings") or {}).items():
-        settings = json.loads(settings)
-        last_access_timestamp = settings.get("_last_access")
-        access = int(time.time() - (last_access_timestamp or 0))
+    for settings_id in REDIS_CONNECTION.hkeys(settings_store.SETTINGS_KEY):
+        meta = settings_store.get_metadata(REDIS_CONNECTION, settings_id, "last_access") or {}
+        last_access_timestamp = meta.get("last_access")
+        access = int(time.time() - int(last_access_timestamp or 0))
         if last_access_timestamp is None or (access > (age * SECONDS_PER_DAY)):
             dir_path = os.path.join(config["workspace"], "scripts", str(settings_id))
             if dry_run and os.path.isdir(dir_path):
                 last_access = "UNKNOWN" if last_access_timestamp is None else access // SECONDS_PER_DAY
                 print(f"{dir_path} -> last accessed {last_access or '< 1'} days ago")
             else:
-                settings["_error"] = "the settings for this test have expired, please re-upload the settings."
-                REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(settings))
+                error = "the settings for this test have expired, please re-upload the settings."
+                REDIS_CONNECTION.hset(settings_store.meta_key(settings_id), "error", error)
                 if os.path.isdir(dir_path):
                     shutil.rmtree(dir_path)
 